@@ -1,32 +1,1252 @@
 import requests
+import concurrent.futures
+import copy
+import threading
+from urllib3.util.retry import Retry
 import json
 import csv
 import datetime
 import os
+import io
+import hashlib
+import gzip
+import mmap
+import codecs
+import time
+import math
+import re
+import functools
+import collections
+import sys
+import atexit
+
+def endpoint_template(method, path):
+    # "METHOD path/{id}", the key the profile, the limiter and the fake server count requests by:
+    # the query string is dropped and every id segment, first or negative, becomes {id}
+    return method+' '+re.sub(r'(^|/)-?[0-9]+(?=/|$)', r'\1{id}', path.split('?')[0])
+
+def received_size(r):
+    # the bytes of the body as they came over the wire, before requests decodes the gzip
+    try:
+        return r.raw.tell()
+    except (AttributeError, OSError):
+        return len(r.content)
+
+class AdaptiveLimiter:
+    # AIMD on the number of requests in flight: +1 per window of successful requests,
+    # halved (at most once per window) on a server error, a timeout or when the smoothed
+    # latency of an endpoint gets well above its usual one, a low percentile of its last requests
+    def __init__(self, maximum, minimum=1, initial=None, tolerance=3.0, slack=0.05, window=50, percentile=0.1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or max(minimum, maximum // 2))
+        self.tolerance = tolerance
+        self.slack = slack
+        self.window = window
+        self.percentile = percentile
+        self.in_flight = 0
+        self.latencies = {}
+        self.samples = {}
+        self.baselines = {}
+        self.since_decrease = 0
+        self.decreases = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        # for the callers that wait their own way, the asyncio transport
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, seconds, failed=False, endpoint=None):
+        with self.condition:
+            self.in_flight -= 1
+            self.since_decrease += 1
+            congested = failed
+            if not failed:
+                latency = self.latencies.get(endpoint, seconds) * 0.8 + seconds * 0.2
+                self.latencies[endpoint] = latency
+                # one fast outlier does not stay the reference, and a server that got slower for
+                # good becomes the reference once it fills the window
+                samples = self.samples.get(endpoint)
+                if samples is None:
+                    samples = self.samples[endpoint] = collections.deque(maxlen=self.window)
+                samples.append(seconds)
+                rank = int(len(samples) * self.percentile)
+                baseline = sorted(samples)[rank]
+                self.baselines[endpoint] = baseline
+                # judged once the fastest sample is not the reference any more
+                congested = rank > 0 and latency > self.tolerance * baseline and latency - baseline > self.slack
+            if congested and self.since_decrease >= int(self.limit):
+                self.limit = max(self.minimum, self.limit / 2)
+                self.since_decrease = 0
+                self.decreases += 1
+            elif not congested:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def resize(self, maximum):
+        # the limit starts at the new maximum unless the server already asked to slow down
+        with self.condition:
+            self.maximum = maximum
+            if not self.decreases:
+                self.limit = float(maximum)
+            self.limit = max(self.minimum, min(self.limit, maximum))
+            self.condition.notify_all()
+
+    def level(self):
+        return int(self.limit)
+
+class MetabaseTransport:
+    RETRY_STATUSES = frozenset([502, 503, 504])
+    RETRY_METHODS = frozenset(['GET', 'PUT', 'DELETE'])
+
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=300, retries=3, backoff_factor=0.5, max_reads=None, max_writes=None, rps=None, compress_requests=None):
+        self.timeout = (connect_timeout, read_timeout)
+        # Responses are always asked gzipped, the request bodies only above this size (in bytes)
+        # and only if the server, or the proxy in front of it, accepts a gzipped body
+        self.compress_requests = compress_requests
+        # Only idempotent verbs are retried on a bad gateway or a reset connection,
+        # a POST may already have been applied by the server
+        retry = Retry(
+                        total=retries, connect=retries, read=retries, status=retries,
+                        backoff_factor=backoff_factor,
+                        status_forcelist=self.RETRY_STATUSES,
+                        allowed_methods=self.RETRY_METHODS,
+                        raise_on_status=False
+                     )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Reads and writes have their own budget, so a burst of slow writes does not starve the lookups.
+        # The writes get the number of jobs of the import that sizes them, unless max_writes is set
+        self.max_writes = max_writes
+        self.limiters = {
+                            'read': AdaptiveLimiter(max_reads or pool_size),
+                            'write': AdaptiveLimiter(max_writes or max(1, pool_size // 2))
+                        }
+        self.rps = rps
+        self.pace_lock = threading.Lock()
+        self.next_start = 0
+
+    def size_writes(self, jobs):
+        if self.max_writes is None and jobs != self.limiters['write'].maximum:
+            self.limiters['write'].resize(max(1, jobs))
+
+    def pace(self):
+        if not self.rps:
+            return
+        with self.pace_lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + 1.0 / self.rps
+        if start > now:
+            time.sleep(start - now)
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        limiter = self.limiters['read' if method == 'GET' else 'write']
+        limiter.acquire()
+        start = time.perf_counter()
+        failed = True
+        try:
+            self.pace()
+            if data is not None and self.compress_requests is not None and len(data) >= self.compress_requests:
+                data = gzip.compress(data.encode('utf-8'))
+                headers = dict(headers or {})
+                headers['Content-Encoding'] = 'gzip'
+            start = time.perf_counter()
+            r = self.session.request(method, url, data=data, headers=headers, timeout=self.timeout, stream=stream)
+            failed = r.status_code >= 500
+            return r
+        finally:
+            limiter.release(time.perf_counter() - start, failed, self.endpoint(method, url))
+
+    def endpoint(self, method, url):
+        return endpoint_template(method, url)
+
+    def concurrency(self):
+        return {'read': self.limiters['read'].level(), 'write': self.limiters['write'].level()}
+
+    def stats(self):
+        stats = {'requests': 0, 'connections_opened': 0, 'connections_reused': 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections_opened'] += pool.num_connections
+        stats['connections_reused'] = max(stats['requests'] - stats['connections_opened'], 0)
+        stats['concurrency'] = self.concurrency()
+        stats['backoffs'] = self.limiters['read'].decreases + self.limiters['write'].decreases
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+        return "http: %d requests, %d connections opened, %d reused, concurrency %d reads/%d writes, %d backoffs" % (stats['requests'], stats['connections_opened'], stats['connections_reused'], stats['concurrency']['read'], stats['concurrency']['write'], stats['backoffs'])
+
+    def close(self):
+        self.session.close()
+
+class JsonStream:
+    # Parses a JSON document arriving in chunks of text: items() yields the elements of the
+    # top-level list, or of the list or object under key in the top-level object ([key, value]
+    # pairs for an object), each one as soon as it is complete. The other members of the
+    # top-level object are kept in rest
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, chunks, key=None, close=None):
+        self.chunks = iter(chunks)
+        self.key = key
+        self.close = close
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.ended = False
+        self.rest = {}
+
+    def fill(self, size=0):
+        # Reads at least one more chunk, and up to size characters in the buffer
+        if self.ended:
+            return False
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        read = False
+        while not read or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+                read = True
+            except StopIteration:
+                self.ended = True
+                break
+        return read
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                break
+        return self.buffer[self.pos:self.pos+1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected '+char+' in the JSON document at '+repr(self.buffer[self.pos:self.pos+20]))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                [value, end] = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number may go on in the next chunk
+                if (end < len(self.buffer) and self.buffer[end] not in '.eE+-') or self.ended:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.ended:
+                    raise
+            # doubling the buffer keeps the parsing of a value split over many chunks linear
+            self.fill(2 * (len(self.buffer) - self.pos))
+
+    def separator(self, end):
+        if self.peek() == ',':
+            self.pos += 1
+            return True
+        self.expect(end)
+        return False
+
+    def items(self):
+        try:
+            if self.key is not None:
+                self.expect('{')
+                found = False
+                while self.peek() != '}':
+                    k = self.value()
+                    self.expect(':')
+                    if k == self.key:
+                        found = True
+                        break
+                    self.rest[k] = self.value()
+                    if not self.separator('}'):
+                        return
+                if not found:
+                    return
+            container = self.peek()
+            if container not in ['[', '{']:
+                raise ValueError('expected a list or an object in the JSON document')
+            self.pos += 1
+            end = ']' if container == '[' else '}'
+            if self.peek() == end:
+                self.pos += 1
+            else:
+                more = True
+                while more:
+                    if container == '{':
+                        k = self.value()
+                        self.expect(':')
+                        yield [k, self.value()]
+                    else:
+                        yield self.value()
+                    more = self.separator(end)
+            if self.key is not None:
+                while self.separator('}'):
+                    k = self.value()
+                    self.expect(':')
+                    self.rest[k] = self.value()
+        finally:
+            if self.close:
+                self.close()
+
+class MetabaseProfile:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.endpoints = {}
+        self.phases = {}
+        self.concurrency = {}
+
+    def record_request(self, method, query_name, seconds, sent, received, failed=False):
+        key = endpoint_template(method, query_name)
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = {'durations': [], 'sent': 0, 'received': 0, 'errors': 0}
+                self.endpoints[key] = endpoint
+            endpoint['durations'].append(seconds)
+            endpoint['sent'] += sent
+            endpoint['received'] += received
+            if failed:
+                endpoint['errors'] += 1
+
+    def record_concurrency(self, levels):
+        with self.lock:
+            for name in levels.keys():
+                level = self.concurrency.get(name)
+                if level is None:
+                    self.concurrency[name] = {'min': levels[name], 'max': levels[name], 'last': levels[name]}
+                    continue
+                level['min'] = min(level['min'], levels[name])
+                level['max'] = max(level['max'], levels[name])
+                level['last'] = levels[name]
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            self.phases.setdefault(name, []).append(seconds)
+
+    def timed(self, name, function, *args):
+        # The conversions are recursive, only the outermost call of a phase is timed
+        if getattr(self.local, name, False):
+            return function(*args)
+        setattr(self.local, name, True)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+            setattr(self.local, name, False)
+
+    def take_phases(self):
+        with self.lock:
+            phases = self.phases
+            self.phases = {}
+        return phases
+
+    def merge_phases(self, phases):
+        with self.lock:
+            for name in phases.keys():
+                self.phases.setdefault(name, []).extend(phases[name])
+
+    def percentile(self, durations, p):
+        durations = sorted(durations)
+        return durations[max(math.ceil(p * len(durations)) - 1, 0)]
+
+    def summarize(self, durations):
+        return {
+                    'calls': len(durations),
+                    'total': sum(durations),
+                    'p50': self.percentile(durations, 0.5),
+                    'p95': self.percentile(durations, 0.95),
+                    'max': max(durations)
+               }
+
+    def report(self):
+        with self.lock:
+            report = {'endpoints': {}, 'phases': {}, 'concurrency': copy.deepcopy(self.concurrency)}
+            for key in self.endpoints.keys():
+                endpoint = self.endpoints[key]
+                report['endpoints'][key] = self.summarize(endpoint['durations'])
+                report['endpoints'][key]['sent_bytes'] = endpoint['sent']
+                report['endpoints'][key]['received_bytes'] = endpoint['received']
+                report['endpoints'][key]['errors'] = endpoint['errors']
+            for name in self.phases.keys():
+                report['phases'][name] = self.summarize(self.phases[name])
+        return report
+
+    def table(self):
+        report = self.report()
+        lines = ["%-45s %7s %9s %9s %9s %9s %11s %11s" % ('endpoint / phase', 'calls', 'total (s)', 'p50 (ms)', 'p95 (ms)', 'max (ms)', 'sent (KiB)', 'recv (KiB)')]
+        rows = []
+        for key in report['endpoints'].keys():
+            rows.append([key, report['endpoints'][key]])
+        for name in report['phases'].keys():
+            rows.append(['(phase) '+name, report['phases'][name]])
+        rows.sort(key=lambda row: -row[1]['total'])
+        for [key, r] in rows:
+            line = "%-45s %7d %9.3f %9.1f %9.1f %9.1f" % (key, r['calls'], r['total'], r['p50'] * 1000, r['p95'] * 1000, r['max'] * 1000)
+            if 'sent_bytes' in r:
+                line += " %11d %11d" % (r['sent_bytes'] // 1024, r['received_bytes'] // 1024)
+            lines.append(line)
+        for name in sorted(report['concurrency'].keys()):
+            level = report['concurrency'][name]
+            lines.append("concurrency %s: %d (min %d, max %d)" % (name, level['last'], level['min'], level['max']))
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        with open(filename, 'w') as jsonfile:
+            jsonfile.write(json.dumps(self.report(), indent=2, sort_keys=True))
+
+def profiled(phase):
+    def decorate(method):
+        @functools.wraps(method)
+        def timed(self, *args):
+            return self.profile.timed(phase, method, self, *args)
+        return timed
+    return decorate
+
+class DatabaseRegistry:
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.databases = None
+        self.name2id = {}
+
+    def is_loaded(self):
+        return self.databases is not None
+
+    def load(self, databases):
+        self.databases = {}
+        self.name2id = {}
+        for database in databases:
+            self.add(database)
+
+    def add(self, database):
+        self.databases[database['id']] = database
+        self.name2id.setdefault(database['name'], database['id'])
+
+    def remove(self, database_id):
+        database = self.databases.pop(database_id, None)
+        if database and self.name2id.get(database['name']) == database_id:
+            del self.name2id[database['name']]
+            for d in self.databases.values():
+                if d['name'] == database['name']:
+                    self.name2id[d['name']] = d['id']
+                    break
+
+    def database_name2id(self, name):
+        return self.name2id.get(name)
+
+    def get(self, name):
+        return self.databases.get(self.name2id.get(name))
+
+    def all(self):
+        return list(self.databases.values())
+
+    def names(self):
+        return list(self.name2id.keys())
+
+class DashboardCache:
+    # Hydrated dashboards bucketed by the database their cards use (None for the
+    # dashboards without cards, 'mixed' for the ones using several databases)
+    # lock is held by the hydration and the reads of the buckets, the writes of the import
+    # workers only record which buckets are stale, under marks_lock, and never wait for a hydration
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.marks_lock = threading.Lock()
+        self.buckets = None
+        self.stale = set()
+        self.reset = False
+
+    def invalidate(self, database_id=None):
+        with self.marks_lock:
+            if database_id is None:
+                self.reset = True
+                return
+            # a dashboard of this database may come from, or go to, the None and 'mixed' buckets
+            self.stale.update([database_id, None, 'mixed'])
+
+    def is_fresh(self, database_id=None):
+        with self.marks_lock:
+            return self.buckets is not None and not self.reset and database_id not in self.stale and None not in self.stale
+
+    def take_marks(self):
+        # the marks a hydration handles, the ones recorded while it runs are kept for the next one
+        with self.marks_lock:
+            marks = [self.reset or self.buckets is None, self.stale]
+            self.reset = False
+            self.stale = set()
+            return marks
+
+    def load(self, hydrated):
+        buckets = {}
+        for [key, dash] in hydrated:
+            buckets.setdefault(key, []).append(dash)
+        self.buckets = buckets
+
+    def add(self, hydrated):
+        for [key, dash] in hydrated:
+            self.buckets.setdefault(key, []).append(dash)
+
+    def drop_stale(self, existing_ids, stale):
+        for key in list(self.buckets.keys()):
+            if key in stale:
+                del self.buckets[key]
+            else:
+                self.buckets[key] = [d for d in self.buckets[key] if d['id'] in existing_ids]
+
+    def known_ids(self):
+        ids = set()
+        for dashboards in self.buckets.values():
+            for d in dashboards:
+                ids.add(d['id'])
+        return ids
+
+    def of_database(self, database_id):
+        dashboards = list(self.buckets.get(None, []))
+        if database_id is not None:
+            dashboards += self.buckets.get(database_id, [])
+        return dashboards
+
+class SchemaIndex:
+    SCHEMA = ['tables_by_id', 'tables_loaded', 'fields_missing', 'fields_by_id', 'fields_id2names', 'fields_names2field', 'tables_id2name', 'tables_name2id']
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self, kind=None):
+        if kind in [None, 'schema']:
+            self.database = None
+            self.complete = False
+            self.tables_by_id = {}
+            self.tables_loaded = set()
+            self.fields_missing = set()
+            self.fields_by_id = {}
+            self.fields_id2names = {}
+            self.fields_names2field = {}
+            self.tables_id2name = {}
+            self.tables_name2id = {}
+        if kind is None:
+            self.objects_id2name = {}
+            self.objects_name2id = {}
+        elif kind != 'schema':
+            self.objects_id2name.pop(kind, None)
+            self.objects_name2id.pop(kind, None)
+
+    def has_schema(self):
+        return self.database is not None
+
+    def load_database(self, database, complete=True, tables=None):
+        # complete: the payload has the fields of every table, otherwise only the table list.
+        # tables: the tables when they are not in the payload, as they are parsed from a stream.
+        # The maps are built apart then swapped in: a lookup running meanwhile finds the
+        # previous schema, never a half filled one
+        if tables is None:
+            tables = database.get('tables') or []
+        loaded = SchemaIndex()
+        for table in tables:
+            loaded.add_table(table, complete)
+        for name in self.SCHEMA:
+            setattr(self, name, getattr(loaded, name))
+        self.database = database
+        self.complete = complete
+
+    def add_table(self, table, with_fields=True):
+        self.tables_id2name.setdefault(table['id'], table['name'])
+        self.tables_name2id.setdefault(table['name'], table['id'])
+        if not with_fields or table['id'] in self.tables_loaded:
+            return
+        for field in table.get('fields') or []:
+            self.add_field(table['name'], field)
+        self.tables_by_id[table['id']] = table
+        self.tables_loaded.add(table['id'])
+
+    def tables(self):
+        return list(self.tables_by_id.values())
+
+    def has_table_fields(self, table_id):
+        return self.complete or table_id in self.tables_loaded
+
+    def table(self, table_id):
+        return self.tables_by_id.get(table_id)
+
+    def add_field(self, table_name, field):
+        if field['id'] in self.fields_by_id:
+            return
+        self.fields_by_id[field['id']] = field
+        self.fields_id2names[field['id']] = [table_name, field['name']]
+        self.fields_names2field.setdefault((table_name, field['name']), field)
+
+    def update_field(self, field):
+        # The indexed dict is shared with the database payload so both stay in sync
+        known = self.fields_by_id.get(field.get('id'))
+        if known is None:
+            return
+        if field.get('name', known['name']) != known['name']:
+            self.invalidate('schema')
+            return
+        known.update(field)
+
+    def field_id2names(self, field_id):
+        return self.fields_id2names.get(field_id)
+
+    def field_names2field(self, table_name, field_name):
+        return self.fields_names2field.get((table_name, field_name))
+
+    def table_id2name(self, table_id):
+        return self.tables_id2name.get(table_id)
+
+    def table_name2id(self, table_name):
+        return self.tables_name2id.get(table_name)
+
+    def has_objects(self, kind):
+        return kind in self.objects_id2name
+
+    def load_objects(self, kind, objects):
+        # swapped in once complete as well, the objects may come from a stream
+        id2name = {}
+        name2id = {}
+        for o in objects:
+            id2name.setdefault(o['id'], o['name'])
+            name2id[o['name']] = o['id']
+        self.objects_name2id[kind] = name2id
+        self.objects_id2name[kind] = id2name
+
+    def add_object(self, kind, obj):
+        self.objects_id2name.setdefault(kind, {}).setdefault(obj['id'], obj['name'])
+        self.objects_name2id.setdefault(kind, {})[obj['name']] = obj['id']
+
+    def remove_object(self, kind, obj_id):
+        name = self.objects_id2name.get(kind, {}).pop(obj_id, None)
+        if name is not None and self.objects_name2id[kind].get(name) == obj_id:
+            self.objects_name2id[kind].pop(name)
+
+    def object_id2name(self, kind, obj_id):
+        return self.objects_id2name.get(kind, {}).get(obj_id)
+
+    def object_name2id(self, kind, name):
+        return self.objects_name2id.get(kind, {}).get(name)
+
+class ImportScheduler:
+    # Objects may only wait for kinds imported before or with them, the other
+    # references (a card linking to a dashboard) are resolved as before, if they exist
+    RANKS = {'metric': 0, 'snippet': 1, 'card': 2, 'dashboard': 3}
+
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+        self.tasks = {}
+        self.order = []
+
+    def add(self, key, run, references=()):
+        if key in self.tasks:
+            return False
+        self.tasks[key] = [run, set(references)]
+        self.order.append(key)
+        return True
+
+    def dependencies(self, key):
+        deps = set()
+        for ref in self.tasks[key][1]:
+            if ref == key or ref not in self.tasks:
+                continue
+            if ref[0] == key[0] and key[0] != 'card':
+                continue
+            if self.RANKS[ref[0]] > self.RANKS[key[0]]:
+                continue
+            deps.add(ref)
+        return deps
+
+    def graph(self):
+        waiting = {}
+        dependents = {}
+        for key in self.order:
+            waiting[key] = self.dependencies(key)
+            for d in waiting[key]:
+                dependents.setdefault(d, []).append(key)
+        self.check_cycles(waiting, dependents)
+        return [waiting, dependents]
+
+    def run(self):
+        [waiting, dependents] = self.graph()
+
+        results = {}
+        errors = {}
+        def fail(key, error):
+            errors[key] = error
+            for d in dependents.get(key, []):
+                if d not in errors:
+                    fail(d, ValueError('depends on '+key[0]+' '+key[1]+' which failed'))
+
+        ready = [key for key in self.order if not waiting[key]]
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while ready or running:
+                for key in ready:
+                    running[executor.submit(self.tasks[key][0])] = key
+                ready = []
+                done, pending = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    try:
+                        results[key] = future.result()
+                    except Exception as e:
+                        fail(key, e)
+                        continue
+                    for d in dependents.get(key, []):
+                        waiting[d].discard(key)
+                        if not waiting[d] and d not in errors:
+                            ready.append(d)
+        return [results, errors]
+
+    def check_cycles(self, waiting, dependents):
+        counts = {}
+        for key in waiting.keys():
+            counts[key] = len(waiting[key])
+        todo = [key for key in counts.keys() if not counts[key]]
+        seen = 0
+        while todo:
+            key = todo.pop()
+            seen += 1
+            for d in dependents.get(key, []):
+                counts[d] -= 1
+                if not counts[d]:
+                    todo.append(d)
+        if seen < len(counts):
+            cycle = [key[0]+' '+key[1] for key in counts.keys() if counts[key]]
+            raise ValueError('circular references between: '+', '.join(cycle))
+
+class ImportSources:
+    # The files the objects of an import are read from when their turn comes: a dashboard
+    # file is parsed once for the cards embedded in it, and dropped after its last object
+    def __init__(self, api, entries):
+        self.api = api
+        self.lock = threading.Lock()
+        self.readers = {}
+        self.parsed = {}
+        for entry in entries:
+            key = tuple(entry['source'][0:2])
+            self.readers[key] = self.readers.get(key, 0) + 1
+
+    def load(self, entry):
+        [dirname, filename, position] = entry['source']
+        key = (dirname, filename)
+        with self.lock:
+            obj = self.parsed.get(key)
+        if obj is None:
+            obj = self.api.export_store(dirname).read_json(filename)
+        with self.lock:
+            readers = self.readers.get(key, 1) - 1
+            if readers > 0:
+                self.readers[key] = readers
+                obj = self.parsed.setdefault(key, obj)
+            else:
+                self.readers.pop(key, None)
+                self.parsed.pop(key, None)
+        if position is not None:
+            obj = obj['ordered_cards'][position]['card']
+        if readers > 0:
+            obj = copy.deepcopy(obj)
+        return obj
+
+class ExportDirectory:
+    # The export as a directory, one file per object
+    compression = True
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def path(self, name):
+        return self.dirname+'/'+name
+
+    def names(self, prefix=''):
+        return sorted([name for name in os.listdir(self.dirname) if name.startswith(prefix)])
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def open(self, name):
+        # .gz files are decompressed while they are read
+        if name.endswith('.gz'):
+            return gzip.open(self.path(name), 'rt', newline = '', encoding = 'utf-8')
+        return open(self.path(name), 'r', newline = '')
+
+    def read_text(self, name):
+        with self.open(name) as textfile:
+            return textfile.read()
+
+    def read_json(self, name):
+        with self.open(name) as jsonfile:
+            return json.load(jsonfile)
+
+    def write(self, name, content):
+        if isinstance(content, bytes):
+            with open(self.path(name), 'wb') as gzfile:
+                gzfile.write(content)
+            return
+        with open(self.path(name), 'w', newline = '') as textfile:
+            textfile.write(content)
+
+    def replace(self, name, content):
+        self.write(name+'.tmp', content)
+        os.replace(self.path(name+'.tmp'), self.path(name))
+
+    def remove(self, name):
+        os.remove(self.path(name))
+
+    def flush(self):
+        return
+
+    def journal_path(self):
+        return self.path('import_journal.jsonl')
+
+class ExportBundle:
+    # The whole export in one append-only file: a header line, then one json line per file,
+    # {"file", "kind", "name", "content"} or {"file", "deleted"} once it is removed. Each export
+    # ends with an index line giving the offset and the length of the live files, so that an
+    # import maps the bundle and parses only the lines of the objects it reads.
+    SUFFIX = '.bundle'
+    HEADER = {'format': 'metabase-export-bundle', 'version': 1}
+    KINDS = ['card', 'dashboard', 'metric', 'snippet']
+    compression = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.file = None
+        self.map = None
+        self.dirty = False
+        if not os.path.exists(path):
+            with open(path, 'wb') as bundle:
+                bundle.write(self.line(self.HEADER))
+        self.load_index()
+
+    def line(self, record):
+        return (json.dumps(record, separators = (',', ':'), sort_keys = True)+"\n").encode('utf-8')
+
+    def remap(self):
+        if self.file:
+            self.file.flush()
+        if self.map is not None:
+            self.map.close()
+        with open(self.path, 'rb') as bundle:
+            self.map = mmap.mmap(bundle.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def load_index(self):
+        self.remap()
+        start = self.map.find(b'\n') + 1
+        try:
+            header = json.loads(self.map[:start])
+        except ValueError:
+            header = {}
+        if header.get('format') != self.HEADER['format']:
+            raise ValueError(self.path+' is not an export bundle')
+        self.end = len(self.map)
+        last = self.map.rfind(b'\n', 0, self.end - 1) + 1
+        if last >= start:
+            try:
+                record = json.loads(self.map[last:self.end])
+            except ValueError:
+                record = {}
+            if 'index' in record:
+                self.index = record['index']
+                return
+        # no index at the end, the export was interrupted: the lines are read again up to the
+        # last complete one and what follows it is dropped
+        offset = start
+        while offset < len(self.map):
+            end = self.map.find(b'\n', offset)
+            if end < 0:
+                break
+            try:
+                record = json.loads(self.map[offset:end])
+            except ValueError:
+                break
+            if record.get('deleted'):
+                self.index.pop(record['file'], None)
+            elif 'file' in record:
+                self.index[record['file']] = [offset, end + 1 - offset, record['kind'], record['name']]
+            offset = end + 1
+        self.end = offset
+        if self.end < len(self.map):
+            self.map.close()
+            self.map = None
+            with open(self.path, 'r+b') as bundle:
+                bundle.truncate(self.end)
+            self.remap()
+        self.dirty = True
+
+    def record(self, name):
+        with self.lock:
+            if name not in self.index:
+                raise FileNotFoundError(self.path+': '+name)
+            [offset, length] = self.index[name][:2]
+            if offset + length > len(self.map):
+                self.remap()
+            return json.loads(self.map[offset:offset+length])
+
+    def append(self, record):
+        data = self.line(record)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'ab')
+            self.file.write(data)
+            if record.get('deleted'):
+                del self.index[record['file']]
+            else:
+                self.index[record['file']] = [self.end, len(data), record['kind'], record['name']]
+            self.end += len(data)
+            self.dirty = True
+
+    def names(self, prefix=''):
+        with self.lock:
+            return sorted([name for name in self.index.keys() if name.startswith(prefix)])
+
+    def exists(self, name):
+        return name in self.index
+
+    def open(self, name):
+        return io.StringIO(self.read_text(name))
+
+    def read_text(self, name):
+        content = self.record(name)['content']
+        if isinstance(content, str):
+            return content
+        return json.dumps(content, indent=2, sort_keys=True)
+
+    def read_json(self, name):
+        content = self.record(name)['content']
+        if isinstance(content, str):
+            return json.loads(content)
+        return content
+
+    def write(self, name, content):
+        if isinstance(content, bytes):
+            raise ValueError(self.path+': the files of an export bundle are not compressed')
+        kind = name
+        obj_name = None
+        if name.endswith('.json'):
+            # the objects are kept parsed, on one line
+            content = json.loads(content)
+            if name.split('_')[0] in self.KINDS:
+                kind = name.split('_')[0]
+                obj_name = content.get('name')
+        self.append({'file': name, 'kind': kind, 'name': obj_name, 'content': content})
+
+    def replace(self, name, content):
+        self.write(name, content)
+
+    def remove(self, name):
+        self.append({'file': name, 'deleted': True})
+
+    def flush(self):
+        # the lines of the replaced and removed files are dropped once they are half of the bundle
+        with self.lock:
+            if not self.dirty:
+                return
+            live = sum([entry[1] for entry in self.index.values()])
+            if live * 2 < self.end:
+                self.compact()
+            else:
+                if self.file is None:
+                    self.file = open(self.path, 'ab')
+                self.file.write(self.line({'index': self.index}))
+                self.file.flush()
+            self.remap()
+            self.end = len(self.map)
+            self.dirty = False
+
+    def compact(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.remap()
+        index = {}
+        with open(self.path+'.tmp', 'wb') as bundle:
+            bundle.write(self.line(self.HEADER))
+            for name in sorted(self.index.keys()):
+                [offset, length, kind, obj_name] = self.index[name]
+                index[name] = [bundle.tell(), length, kind, obj_name]
+                bundle.write(self.map[offset:offset+length])
+            bundle.write(self.line({'index': index}))
+        self.map.close()
+        self.map = None
+        os.replace(self.path+'.tmp', self.path)
+        self.index = index
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def journal_path(self):
+        return self.path+'.journal.jsonl'
+
+class ImportJournal:
+    # Append-only record of the objects an import has completed, one json line per object
+    def __init__(self, filename, database_name, resume=False):
+        self.filename = filename
+        self.database_name = database_name
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.alive = {}
+        self.alive_lock = threading.Lock()
+        lines = self.read_lines()
+        if resume:
+            for entry in lines:
+                if entry.get('database') == self.database_name:
+                    self.entries[(entry['kind'], entry['name'])] = entry
+        else:
+            # a new import of this database starts a new journal, the entries of the other databases are kept
+            with open(self.filename, 'w') as journal:
+                for entry in lines:
+                    if entry.get('database') != self.database_name:
+                        journal.write(json.dumps(entry)+"\n")
+        self.file = open(self.filename, 'a')
+
+    def read_lines(self):
+        entries = []
+        if not os.path.exists(self.filename):
+            return entries
+        with open(self.filename) as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # the last line of an interrupted run may be incomplete
+                    continue
+        return entries
+
+    def completed(self, kind, name, obj_hash):
+        entry = self.entries.get((kind, name))
+        return entry is not None and entry['hash'] == obj_hash
+
+    def object_id(self, kind, name):
+        entry = self.entries.get((kind, name))
+        if entry is None:
+            return None
+        return entry['id']
+
+    def checked_id(self, kind, name, list_alive):
+        # the recorded id, once the list of this kind on the server, list_alive() as {id: name} and
+        # loaded once for all the entries, confirmed that the server still has this object
+        obj_id = self.object_id(kind, name)
+        if obj_id is None:
+            return None
+        with self.alive_lock:
+            if kind not in self.alive:
+                self.alive[kind] = list_alive()
+            alive = self.alive[kind]
+        return obj_id if alive.get(obj_id) == name else None
+
+    def record(self, kind, name, obj_hash, obj_id):
+        entry = {'database': self.database_name, 'kind': kind, 'name': name, 'hash': obj_hash, 'id': obj_id}
+        with self.lock:
+            self.file.write(json.dumps(entry)+"\n")
+            self.file.flush()
+            self.entries[(kind, name)] = entry
+        with self.alive_lock:
+            if obj_id is not None and kind in self.alive:
+                self.alive[kind][obj_id] = name
+
+    def close(self):
+        self.file.close()
+
+class PermissionsBatch:
+    GRAPHS = {'database': 'permissions/graph', 'collection': 'collection/graph'}
+
+    def __init__(self, api, retries=3):
+        self.api = api
+        self.retries = retries
+        self.groups_name2id = None
+        self.changes = {'database': {}, 'collection': {}}
+        self.graphs = {}
+        self.results = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+
+    def group_name2id(self, group_name):
+        if group_name == 'all':
+            return '1'
+        if self.groups_name2id is None:
+            self.groups_name2id = {}
+            for g in self.api.get_groups() or []:
+                self.groups_name2id[g['name']] = g['id']
+        group_id = self.groups_name2id.get(group_name)
+        if not group_id:
+            raise ValueError("group "+group_name+" not found")
+        return str(group_id)
+
+    def set_database(self, group_name, database_name, schema_data, native_sql):
+        group_id = self.group_name2id(group_name)
+        database_id = self.api.database_name2id(database_name)
+        if not database_id:
+            raise ValueError("database "+database_name+" not found")
+        if native_sql:
+            right = {'native': 'write'}
+            if schema_data:
+                right['schemas'] = 'all'
+        else:
+            right = {'native': 'none', 'schemas': 'none'}
+        self.changes['database'][(group_id, str(database_id))] = right
+
+    def set_collection(self, group_name, collection_name, right):
+        if not right in ['read', 'write', 'none']:
+            raise ValueError('right not read/write/none')
+        group_id = self.group_name2id(group_name)
+        if collection_name == 'root':
+            collection_id = 'root'
+        else:
+            collection_id = self.api.collection_name2id(collection_name)
+        if not collection_id:
+            raise ValueError("collection "+collection_name+" not found")
+        self.changes['collection'][(group_id, str(collection_id))] = right
+
+    def load(self, kind):
+        self.api.create_session_if_needed()
+        if self.api.stream_responses:
+            # only the groups the batch changes are kept from the graph
+            wanted = set([group_id for [group_id, key] in self.changes[kind].keys()])
+            stream = self.api.query_stream('GET', self.GRAPHS[kind], key='groups')
+            groups = {}
+            for [group_id, group] in stream.items():
+                if group_id in wanted:
+                    groups[group_id] = group
+            self.graphs[kind] = stream.rest
+            self.graphs[kind]['groups'] = groups
+            return self.graphs[kind]
+        self.graphs[kind] = self.api.query('GET', self.GRAPHS[kind])
+        return self.graphs[kind]
+
+    def changed_groups(self, graph, changes):
+        groups = {}
+        for [group_id, key] in changes.keys():
+            current = graph['groups'].get(group_id, {})
+            if current.get(key) == changes[(group_id, key)]:
+                continue
+            group = groups.get(group_id)
+            if group is None:
+                group = copy.deepcopy(current)
+                groups[group_id] = group
+            group[key] = changes[(group_id, key)]
+        return groups
+
+    def commit(self):
+        # One PUT per graph holding only the groups that change; when another client
+        # updated the graph meanwhile, it is read again and the changes reapplied
+        for kind in ['database', 'collection']:
+            changes = self.changes[kind]
+            if not changes:
+                continue
+            graph = self.graphs.get(kind) or self.load(kind)
+            attempt = 0
+            while True:
+                groups = self.changed_groups(graph, changes)
+                if not groups:
+                    self.results[kind] = graph
+                    break
+                # Metabase answers a revision conflict with a plain text message instead of the graph
+                try:
+                    res = self.api.query('PUT', self.GRAPHS[kind], {'revision': graph['revision'], 'groups': groups})
+                except ConnectionError as e:
+                    res = e
+                if isinstance(res, dict) and res.get('groups') is not None:
+                    self.graphs[kind] = res
+                    self.results[kind] = res
+                    break
+                revision = graph['revision']
+                graph = self.load(kind)
+                attempt += 1
+                if graph['revision'] == revision or attempt > self.retries:
+                    if isinstance(res, ConnectionError):
+                        raise res
+                    raise ConnectionError(self.GRAPHS[kind]+" (PUT): "+str(res))
+            self.changes[kind] = {}
+        return self.results
 
 class MetabaseApi:
-    def __init__(self, apiurl, username, password, debug=False):
+    def __init__(self, apiurl, username, password, debug=False, transport=None, concurrency=8, profile=None, lazy_schema=True, stream_responses=False):
         self.apiurl = apiurl
         self.username = username
         self.password = password
         self.debug = debug
+        self.concurrency = concurrency
+        self.lazy_schema = lazy_schema
+        self.stream_responses = stream_responses
+        self.transport = transport
+        if self.transport is None:
+            self.transport = MetabaseTransport()
+        self.profile = profile
+        if self.profile is None:
+            self.profile = MetabaseProfile()
         
         self.metabase_session = None
         self.database_export = None
-        self.cards_export = None
-        self.metrics_export = None
+        self.database_registry = DatabaseRegistry()
+        self.databases_lock = threading.Lock()
+        self.schema_index = SchemaIndex()
+        self.schema_lock = threading.Lock()
         self.dashboards_name2id = None
-        self.cards_name2id = {}
-        self.snippets_name2id = {}
+        self.dashboards_lock = threading.Lock()
+        self.dashboard_cache = DashboardCache()
+        self.snippets_name2id = None
+        self.snippets_lock = threading.Lock()
         self.collections_name2id = {}
-        self.metrics_name2id = {}
+        self.collections_lock = threading.Lock()
+        self.remote_state = None
+        self.journal = None
+        self.bulk_dashcards = None
+        self.reports = {}
+        self.export_stores = {}
+        self.stores_lock = threading.Lock()
+        self.reports_lock = threading.Lock()
         
+    def tenant(self):
+        # Another database of the same instance: the session, the transport, the profile and the
+        # instance-wide caches (databases, hydrated dashboards, collections) are shared
+        api = MetabaseApi(self.apiurl, self.username, self.password, self.debug, self.transport, self.concurrency, self.profile, self.lazy_schema, self.stream_responses)
+        api.metabase_session = self.metabase_session
+        api.database_registry = self.database_registry
+        api.databases_lock = self.databases_lock
+        api.dashboard_cache = self.dashboard_cache
+        api.collections_name2id = self.collections_name2id
+        api.collections_lock = self.collections_lock
+        api.export_stores = self.export_stores
+        api.bulk_dashcards = self.bulk_dashcards
+        api.stores_lock = self.stores_lock
+        return api
+
     def query (self, method, query_name, json_data = None):
         json_str = None
         if json_data is not None:
             json_str = json.dumps(json_data)
         
-        headers =  { "Content-Type": "application/json;charset=utf-8" }
+        headers =  { "Content-Type": "application/json;charset=utf-8", "Accept-Encoding": "gzip, deflate" }
         
         if self.metabase_session is not None:
             headers["X-Metabase-Session"] = self.metabase_session
@@ -38,38 +1258,64 @@ class MetabaseApi:
             print(headers)
             print(json_str)
         
-        if method == 'POST':
-            r = requests.post(
-                                query_url ,
-                                data = json_str,
-                                headers= headers
-                             )
-        elif method == 'GET':
-            r = requests.get(
-                                query_url,
-                                data = json_str,
-                                headers= headers
-                            )
-        elif method == 'PUT':
-            r = requests.put(
-                                query_url,
-                                data = json_str,
-                                headers= headers
-                            )
-        elif method == 'DELETE':
-            r = requests.delete(
-                                query_url,
-                                data = json_str,
-                                headers= headers
-                                )
-        else:
-            raise ConnectionError('unkown method: '+method+' (GET,POST,DELETE allowed)')
-        
+        if method not in ['GET', 'POST', 'PUT', 'DELETE']:
+            raise ConnectionError('unkown method: '+method+' (GET,POST,PUT,DELETE allowed)')
+
+        start = time.perf_counter()
+        try:
+            r = self.transport.request(method, query_url, json_str, headers)
+        except Exception:
+            self.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), 0, True)
+            raise
+        self.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), received_size(r), r.status_code >= 400)
+        self.profile.record_concurrency(self.transport.concurrency())
+
+        return self.parse_response(method, query_url, r.text)
+
+    def query_stream(self, method, query_name, json_data = None, key = None):
+        # Same request as query, but the body is parsed while it is received: the returned
+        # JsonStream yields the items of the list (or of the list or object under key) one by one
+        json_str = None
+        if json_data is not None:
+            json_str = json.dumps(json_data)
+        headers =  { "Content-Type": "application/json;charset=utf-8", "Accept-Encoding": "gzip, deflate" }
+        if self.metabase_session is not None:
+            headers["X-Metabase-Session"] = self.metabase_session
+        query_url = self.apiurl+query_name
+        if (self.debug):
+            print(method+' '+query_url+' (streamed)')
+
+        start = time.perf_counter()
+        try:
+            r = self.transport.request(method, query_url, json_str, headers, True)
+        except Exception:
+            self.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), 0, True)
+            raise
+        if r.status_code >= 400:
+            self.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), received_size(r), True)
+            self.parse_response(method, query_url, r.text)
+            raise ConnectionError(query_url+" ("+method+"): "+r.text)
+
+        def chunks():
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            for chunk in r.iter_content(65536):
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', True)
+
+        def close():
+            received = received_size(r)
+            r.close()
+            self.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), received)
+            self.profile.record_concurrency(self.transport.concurrency())
+
+        return JsonStream(chunks(), key, close)
+
+    def parse_response(self, method, query_url, text):
         if self.debug:
-            print(r.text)
+            print(text)
         
         try:
-            query_response = r.json()
+            query_response = json.loads(text)
             if query_response.get('errors'):
                 raise ConnectionError(query_response)
             if query_response.get('_status') == 500:
@@ -77,12 +1323,12 @@ class MetabaseApi:
             if query_response.get('via'):
                 raise ConnectionError(query_response)
         except AttributeError:
-            if r.text.find('endpoint') > -1:
-                raise ConnectionError(query_url+" ("+method+"): "+r.text)
+            if text.find('endpoint') > -1:
+                raise ConnectionError(query_url+" ("+method+"): "+text)
             return query_response
         except ValueError:
-            if (r.text):
-                raise ConnectionError(r.text)
+            if (text):
+                raise ConnectionError(text)
             return {}
         
         return query_response
@@ -102,34 +1348,48 @@ class MetabaseApi:
         self.create_session()
 
     def get_databases(self, full_info=False):
+        if not full_info:
+            return self.load_databases().all()
         self.create_session_if_needed()
-        url = 'database'
-        if (full_info):
-            url += '?include=tables'
-        databases = self.query('GET', url)
+        databases = self.query('GET', 'database?include=tables')
         if isinstance(databases, list):
             return databases
         return databases['data']
 
+    def load_databases(self):
+        # The list of databases only changes through create_database and delete_database,
+        # it is fetched once and shared by every lookup
+        with self.databases_lock:
+            if not self.database_registry.is_loaded():
+                self.create_session_if_needed()
+                databases = self.query('GET', 'database')
+                if not isinstance(databases, list):
+                    databases = databases['data']
+                self.database_registry.load(databases)
+        return self.database_registry
+
     def create_database(self, name, engine, details, is_full_sync=True, is_on_demand=False, auto_run_queries=True):
         self.create_session_if_needed()
         data = self.get_database(name, False, False)
         if data:
             return data
-        return self.query('POST', 'database', {"name": name, 'engine': engine, "details": details, "is_full_sync": is_full_sync, "is_on_demand": is_on_demand, "auto_run_queries": auto_run_queries})
+        res = self.query('POST', 'database', {"name": name, 'engine': engine, "details": details, "is_full_sync": is_full_sync, "is_on_demand": is_on_demand, "auto_run_queries": auto_run_queries})
+        with self.databases_lock:
+            if isinstance(res, dict) and res.get('id') and res.get('name'):
+                self.database_registry.add(res)
+            else:
+                self.database_registry.invalidate()
+        return res
 
     def get_database(self, name, full_info=False, check_if_exists=True):
-        name2database = {}
-        for database in self.get_databases():
-            name2database[database['name']] = database
-        data = name2database.get(name)
+        registry = self.load_databases()
+        data = registry.get(name)
         if not data and not check_if_exists:
             return {}
         if not data:
-            raise ValueError("Database \"" + name + "\" does not exist. Existing databases are: " + ', '.join(name2database.keys()))
+            raise ValueError("Database \"" + name + "\" does not exist. Existing databases are: " + ', '.join(registry.names()))
         if not full_info:
             return data
-
         return self.query('GET', 'database/'+str(data['id'])+'?include=tables.fields')
 
     def delete_database(self, name):
@@ -137,7 +1397,10 @@ class MetabaseApi:
         data = self.get_database(name, False, False)
         if not data:
             return
-        return self.query('DELETE', 'database/'+str(data['id']), {'id': data['id']})
+        res = self.query('DELETE', 'database/'+str(data['id']), {'id': data['id']})
+        with self.databases_lock:
+            self.database_registry.remove(data['id'])
+        return res
 
     def sync_scan_database(self, name):
         self.create_session_if_needed()
@@ -147,6 +1410,8 @@ class MetabaseApi:
 
         self.query('POST', 'database/'+str(data['id'])+'/sync_schema', {'id': data['id']});
         self.query('POST', 'database/'+str(data['id'])+'/rescan_values', {'id': data['id']});
+        with self.schema_lock:
+            self.schema_index.invalidate('schema')
 
     def get_all_tables(self):
         self.create_session_if_needed()
@@ -161,94 +1426,151 @@ class MetabaseApi:
             return {}
 
     def get_table(self, database_name, table_name):
-        for t in self.get_tables_of_database(database_name):
-            if t['name'] == table_name:
-                return t
-        table = {}
+        table_id = self.table_name2id(database_name, table_name)
+        if table_id is None:
+            return None
+        return self.load_tables(database_name, [table_id]).table(table_id)
 
     def get_field(self, database_name, table_name, field_name):
-        table = self.get_table(database_name, table_name)
-        try:
-            for f in table['fields']:
-                if f['name'] == field_name:
-                    return f
-        except TypeError:
-            return {}
-        return {}
+        return self.field_tablenameandfieldname2field(database_name, table_name, field_name) or {}
 
     def delete_session(self):
         self.query('DELETE', 'session', {'metabase-session-id': self.metabase_session})
         self.metabase_session = None
 
+    def load_schema(self, database_name, full=None):
+        # By default only the table list is read, the fields of a table are fetched the first
+        # time one of them is looked up (load_tables). full reads every field at once, as the
+        # exports need them all
+        if full is None:
+            full = not self.lazy_schema
+        index = self.schema_index
+        if (full and not index.complete) or not index.has_schema():
+            # load_tables adds its tables under the same lock, and a second thread finds the schema loaded
+            with self.schema_lock:
+                if full and not index.complete:
+                    self.load_full_schema(database_name)
+                elif not index.has_schema():
+                    data = self.get_database(database_name)
+                    index.load_database(self.query('GET', 'database/'+str(data['id'])+'?include=tables'), False)
+        return index
+
+    def load_full_schema(self, database_name):
+        # called with schema_lock held
+        data = self.get_database(database_name)
+        query_name = 'database/'+str(data['id'])+'?include=tables.fields'
+        if self.stream_responses:
+            # each table goes into the index as soon as it is parsed, the other members of
+            # the database are in stream.rest once the tables are read
+            stream = self.query_stream('GET', query_name, key='tables')
+            self.schema_index.load_database(stream.rest, True, stream.items())
+        else:
+            self.schema_index.load_database(self.query('GET', query_name))
+        self.database_export = self.schema_index.database
+        return self.schema_index
+
+    def load_tables(self, database_name, table_ids):
+        index = self.load_schema(database_name)
+        missing = [t for t in set(table_ids) if t and not index.has_table_fields(t)]
+        if not missing:
+            return index
+        # past half of the tables, one full read is cheaper
+        if len(missing) > len(index.tables_id2name) // 2:
+            return self.load_schema(database_name, True)
+
+        def load_table(table_id):
+            return self.query('GET', 'table/'+str(table_id)+'/query_metadata')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrency, len(missing))) as executor:
+            tables = list(executor.map(load_table, missing))
+        with self.schema_lock:
+            for table in tables:
+                index.add_table(table)
+        return index
+
+    def load_field_table(self, database_name, field_id):
+        # field/{id} tells which table to load for a field id not seen yet
+        index = self.schema_index
+        if not isinstance(field_id, int) or field_id in index.fields_missing:
+            return None
+        try:
+            field = self.query('GET', 'field/'+str(field_id))
+        except ConnectionError:
+            field = None
+        if not isinstance(field, dict) or not field.get('table_id'):
+            index.fields_missing.add(field_id)
+            return None
+        return self.load_tables(database_name, [field['table_id']]).field_id2names(field_id)
+
+    def load_objects(self, database_name, kind):
+        if not self.schema_index.has_objects(kind):
+            if kind == 'card':
+                self.schema_index.load_objects(kind, self.iter_cards(database_name))
+            elif kind == 'metric':
+                self.schema_index.load_objects(kind, self.get_metrics(database_name))
+            else:
+                raise ValueError('unknown object kind '+kind)
+        return self.schema_index
+
     def field_id2tablenameandfieldname(self, database_name, field_id):
-        if self.database_export is None:
-            self.database_export = self.get_database(database_name, True)
+        index = self.load_schema(database_name)
         if not field_id:
             return ['', '']
-        for table in self.database_export['tables']:
-            for field in table['fields']:
-                if field['id'] == field_id:
-                    return [table['name'], field['name']]
-        return ['', '']
+        names = index.field_id2names(field_id)
+        if not names and not index.complete:
+            names = self.load_field_table(database_name, field_id)
+        if not names:
+            return ['', '']
+        return names
 
     def table_id2name(self, database_name, table_id):
-        if self.database_export is None:
-            self.database_export = self.get_database(database_name, True)
+        index = self.load_schema(database_name)
         if not table_id:
             return ['', '']
-        for table in self.database_export['tables']:
-            if table['id'] == table_id:
-                return table['name']
-        return ''
+        name = index.table_id2name(table_id)
+        if name is None:
+            return ''
+        return name
 
     def card_id2name(self, database_name, card_id):
-        if self.cards_export is None:
-            self.cards_export = self.get_cards(database_name)
-        for card in self.cards_export:
-            if card['id'] == card_id:
-                return card['name']
-        return ''
+        name = self.load_objects(database_name, 'card').object_id2name('card', card_id)
+        if name is None:
+            return ''
+        return name
 
     def metric_id2name(self, database_name, metric_id):
-        if self.metrics_export is None:
-            self.metrics_export = self.get_metrics(database_name)
-        for metric in self.metrics_export:
-            if metric['id'] == metric_id:
-                return metric['name']
-        return ''
+        name = self.load_objects(database_name, 'metric').object_id2name('metric', metric_id)
+        if name is None:
+            return ''
+        return name
 
     def field_tablenameandfieldname2field(self, database_name, table_name, field_name):
-        if self.database_export is None:
-            self.database_export = self.get_database(database_name, True)
+        index = self.load_schema(database_name)
         if not table_name or not field_name:
             return None
-        if not self.database_export.get('tables'):
-            return None
-        for table in self.database_export['tables']:
-            if table['name'] == table_name:
-                for field in table['fields']:
-                    if field['name'] == field_name:
-                        return field
-        return None
+        field = index.field_names2field(table_name, field_name)
+        if field is None and not index.has_table_fields(index.table_name2id(table_name)):
+            field = self.load_tables(database_name, [index.table_name2id(table_name)]).field_names2field(table_name, field_name)
+        return field
 
     def table_name2id(self, database_name, table_name):
-        if self.database_export is None:
-            self.database_export = self.get_database(database_name, True)
+        index = self.load_schema(database_name)
         if not table_name:
             return None
-        if not self.database_export.get('tables'):
-            return None
-        for table in self.database_export['tables']:
-            if table['name'] == table_name:
-                return table['id']
-        return None
+        return index.table_name2id(table_name)
 
     def export_fields(self, database_name):
-        self.database_export = self.get_database(database_name, True)
+        # the foreign keys need every table, the rows are made from the index once it is loaded
+        with self.schema_lock:
+            self.load_full_schema(database_name)
+        return self.fields_export_rows(database_name)
+
+    def fields_export_rows(self, database_name):
         result = []
-        if not self.database_export.get('tables'):
+        tables = self.schema_index.tables()
+        if not tables:
             return None
-        for table in self.database_export['tables']:
+        for table in tables:
             table_name = table['name']
             for field in table['fields']:
                 field_id = field['fk_target_field_id']
@@ -267,39 +1589,117 @@ class MetabaseApi:
                               })
         return result
 
-    def export_fields_to_csv(self, database_name, dirname):
+    def export_fields_to_csv(self, database_name, dirname, incremental=False, compress=False):
         export = self.export_fields(database_name)
         if not export:
-            return
-        with open(dirname+"/fields.csv", 'w', newline = '') as csvfile:
-            my_writer = csv.writer(csvfile, delimiter = ',', lineterminator='\n')
-            need_header = True
-            export.sort(key=lambda x: [x['table_name'],x['field_name']])
-            for row in export:
-                if need_header:
-                    my_writer.writerow(row.keys())
-                    need_header = False
-                my_writer.writerow(row.values())
+            return False
+        return self.write_fields_csv(dirname, export, incremental, compress)
+
+    def write_fields_csv(self, dirname, export, incremental=False, compress=False):
+        csvfile = io.StringIO(newline = '')
+        my_writer = csv.writer(csvfile, delimiter = ',', lineterminator='\n')
+        need_header = True
+        export.sort(key=lambda x: [x['table_name'],x['field_name']])
+        for row in export:
+            if need_header:
+                my_writer.writerow(row.keys())
+                need_header = False
+            my_writer.writerow(row.values())
+        content = csvfile.getvalue()
+        store = self.export_store(dirname)
+        compress = compress and store.compression
+        export = ["fields.csv", content]
+        if compress:
+            export = self.compress_export(export)
+        if incremental and store.exists(export[0]) and store.read_text(export[0]) == content:
+            return False
+        self.write_export(dirname, export)
+        # only one of fields.csv and fields.csv.gz is kept, the import reads whichever is there
+        other = "fields.csv" if compress else "fields.csv.gz"
+        if store.exists(other):
+            store.remove(other)
+        store.flush()
+        return True
 
     def import_fields_from_csv(self, database_name, dirname):
+        return self.update_fields(database_name, self.read_fields_csv(dirname))
+
+    def fields_csv_name(self, dirname):
+        for filename in ["fields.csv", "fields.csv.gz"]:
+            if self.export_store(dirname).exists(filename):
+                return filename
+        return None
+
+    def read_fields_csv(self, dirname):
         fields = []
-        with open(dirname+"/fields.csv", newline='') as csvfile:
+        with self.export_store(dirname).open(self.fields_csv_name(dirname) or "fields.csv") as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
                 fields.append(row)
-        return self.update_fields(database_name, fields)
+        return fields
+
+    def write_jobs(self, jobs):
+        # the jobs a caller asks for size the write budget of the transport, by default it keeps its own
+        if jobs is None:
+            return self.concurrency
+        self.transport.size_writes(jobs)
+        return jobs
+
+    def update_fields(self, database_name, fields, jobs=None):
+        jobs = self.write_jobs(jobs)
+        self.load_schema(database_name)
+        return self.put_fields(self.fields_to_update(database_name, fields), jobs)
+
+    def put_fields(self, tables, jobs=None):
+        jobs = self.write_jobs(jobs)
+
+        def update_table(datas):
+            output = []
+            for data in datas:
+                res = self.run_steps(self.put_field_steps(data))
+                if res is not None:
+                    output.append(res)
+            return output
 
-    def update_fields(self, database_name, fields):
         output = []
-        for f in fields:
-            output.append(output.append(self.update_field(database_name, f)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for res in executor.map(update_table, tables.values()):
+                output += res
         return output
 
-    def update_field(self, database_name, field):
+    def fields_to_update(self, database_name, fields):
+        self.reports['fields'] = {'unchanged': 0, 'updated': 0, 'failed': 0, 'missing': 0}
+        index = self.load_schema(database_name)
+        self.load_tables(database_name, [index.table_name2id(f[k]) for f in fields for k in ['table_name', 'foreign_table'] if f.get(k)])
+        tables = {}
+        for f in fields:
+            [field_from_api, data] = self.field_update_data(database_name, f)
+            if not data:
+                self.report_count('fields', 'missing')
+            elif self.field_unchanged(field_from_api, data):
+                self.report_count('fields', 'unchanged')
+            else:
+                tables.setdefault(f['table_name'], []).append(data)
+        return tables
+
+    def field_unchanged(self, field_from_api, data):
+        for k in data.keys():
+            if k in ['id', 'table_name', 'field_name'] or k not in field_from_api:
+                continue
+            # The csv export writes empty strings for the unset values
+            current = field_from_api[k]
+            if not current:
+                current = None
+            if (str(current) if current is not None else None) != (str(data[k]) if data[k] else None):
+                return False
+        return True
+
+    def field_update_data(self, database_name, field):
         field_from_api = self.field_tablenameandfieldname2field(database_name, field['table_name'], field['field_name'])
         if not field_from_api:
-            return None
+            return [None, None]
         fk = self.field_tablenameandfieldname2field(database_name, field['foreign_table'], field['foreign_field'])
+        field = field.copy()
         field.pop('foreign_table')
         field.pop('foreign_field')
         data = {'id': str(field_from_api['id'])}
@@ -310,51 +1710,108 @@ class MetabaseApi:
                 data[k] = None
         if fk :
             data['fk_target_field_id'] = fk['id']
-        return self.query('PUT', 'field/'+data['id'], data)
+        return [field_from_api, data]
+
+    def update_field(self, database_name, field):
+        [field_from_api, data] = self.field_update_data(database_name, field)
+        if not data:
+            return None
+        return self.put_field(data)
+
+    def put_field(self, data):
+        return self.field_updated(self.query('PUT', 'field/'+data['id'], data))
+
+    def put_field_steps(self, data):
+        # the field is counted in the report, one that fails does not stop the others
+        try:
+            res = self.field_updated((yield ['PUT', 'field/'+data['id'], data]))
+        except (ConnectionError, ValueError) as e:
+            self.report_count('fields', 'failed')
+            print("field "+str(data.get('table_name'))+"."+str(data.get('field_name'))+" not updated: "+str(e))
+            return None
+        self.report_count('fields', 'updated')
+        return res
+
+    def field_updated(self, res):
+        with self.schema_lock:
+            if isinstance(res, dict) and res.get('id'):
+                self.schema_index.update_field(res)
+            else:
+                self.schema_index.invalidate('schema')
+        return res
 
     def database_name2id(self, database_name):
-        self.create_session_if_needed()
-        data = self.query('GET', 'database')
-        if isinstance(data, list):
-            newdata = {}
-            newdata['data'] = data
-            data = newdata
-        for d in data['data']:
-            if d['name'] == database_name:
-                return d['id']
-        return None
+        return self.load_databases().database_name2id(database_name)
 
     def get_snippets(self, database_name):
         database_id = self.database_name2id(database_name)
         return self.query('GET', 'native-query-snippet')
 
     def get_cards(self, database_name):
+        return list(self.iter_cards(database_name))
+
+    def iter_cards(self, database_name):
+        # streamed, each card is handed over as soon as it is parsed
         database_id = self.database_name2id(database_name)
-        return self.query('GET', 'card?f=database&model_id='+str(database_id))
+        if self.stream_responses:
+            return self.query_stream('GET', 'card?f=database&model_id='+str(database_id)).items()
+        return iter(self.query('GET', 'card?f=database&model_id='+str(database_id)))
 
     def get_collections(self):
         self.create_session_if_needed()
         return self.query('GET', 'collection')
 
     def get_dashboard(self, database_name, dashboard_name):
-        dashboard_id = self.dashboard_name2id(dashboard_name, dashboard_name)
+        dashboard_id = self.dashboard_name2id(database_name, dashboard_name)
         return self.query('GET', 'dashboard/'+str(dashboard_id))
 
+    def dashboard_database_key(self, dashboard):
+        database_ids = set()
+        for c in dashboard['ordered_cards']:
+            if c['card'].get('database_id'):
+                database_ids.add(c['card']['database_id'])
+        if not database_ids:
+            return None
+        if len(database_ids) > 1:
+            return 'mixed'
+        return database_ids.pop()
+
+    def hydrate_dashboards(self, database_id=None):
+        # Only the dashboards of the buckets invalidated by a write are fetched again
+        cache = self.dashboard_cache
+        with cache.lock:
+            if cache.is_fresh(database_id):
+                return cache
+            [reset, stale] = cache.take_marks()
+            self.create_session_if_needed()
+            dashboards_light = self.query('GET', 'dashboard')
+            if reset:
+                todo = dashboards_light
+            else:
+                cache.drop_stale(set([d['id'] for d in dashboards_light]), stale)
+                known = cache.known_ids()
+                todo = [d for d in dashboards_light if d['id'] not in known]
+            hydrated = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for res in executor.map(lambda d: self.query('GET', 'dashboard/'+str(d['id'])), todo):
+                    hydrated.append([self.dashboard_database_key(res), res])
+            if reset:
+                cache.load(hydrated)
+            else:
+                cache.add(hydrated)
+        return cache
+
+    def dashboards_of_database(self, database_id):
+        cache = self.hydrate_dashboards(database_id)
+        with cache.lock:
+            return cache.of_database(database_id)
+
+    def invalidate_dashboards(self, database_name):
+        self.dashboard_cache.invalidate(self.database_name2id(database_name))
+
     def get_dashboards(self, database_name):
         database_id = self.database_name2id(database_name)
-        dashbords_light = self.query('GET', 'dashboard')
-        dashboards = []
-        for d in dashbords_light:
-            res = self.query('GET', 'dashboard/'+str(d['id']))
-            good_db = True
-            for c in res['ordered_cards']:
-                if c['card'].get('database_id') and c['card'].get('database_id') != database_id:
-                    good_db = False
-                    continue
-            if not good_db:
-                continue
-            dashboards.append(res)
-        return dashboards
+        return copy.deepcopy(self.dashboards_of_database(database_id))
 
     def get_metrics(self, database_name):
         database_id = self.database_name2id(database_name)
@@ -366,45 +1823,73 @@ class MetabaseApi:
         return metrics
 
     def dashboard_name2id(self, database_name, dashboard_name):
-        if not self.dashboards_name2id:
-            self.dashboards_name2id = {}
-            for d in self.get_dashboards(database_name):
-                if self.dashboards_name2id.get(d['name']):
-                    print("dashboard "+d['name']+" not unique (already registered with id "+str(self.dashboards_name2id.get(d['name']))+" and trying to create it with id "+str(d['id'])+")")
+        # the list of the server wins once it is loaded, the journal spares loading it when resuming
+        if self.dashboards_name2id is None:
+            journal_id = self.journal_id('dashboard', dashboard_name)
+            if journal_id:
+                return journal_id
+        with self.dashboards_lock:
+            return self.load_dashboards_name2id(database_name).get(dashboard_name)
+
+    def load_dashboards_name2id(self, database_name):
+        # called with dashboards_lock held
+        if self.dashboards_name2id is None:
+            dashboards_name2id = {}
+            for d in self.dashboards_of_database(self.database_name2id(database_name)):
+                if dashboards_name2id.get(d['name']):
+                    print("dashboard "+d['name']+" not unique (already registered with id "+str(dashboards_name2id.get(d['name']))+" and trying to create it with id "+str(d['id'])+")")
                     continue
-                self.dashboards_name2id[d['name']] = d['id']
-        return self.dashboards_name2id.get(dashboard_name)
+                dashboards_name2id[d['name']] = d['id']
+            self.dashboards_name2id = dashboards_name2id
+        return self.dashboards_name2id
 
     def dashboard_id2name(self, database_name, dashboard_id):
-        self.dashboard_name2id(database_name, "a")
-        for dname in self.dashboards_name2id.keys():
-            if self.dashboards_name2id[dname] == dashboard_id:
-                return dname
+        with self.dashboards_lock:
+            dashboards_name2id = self.load_dashboards_name2id(database_name)
+            for dname in dashboards_name2id.keys():
+                if dashboards_name2id[dname] == dashboard_id:
+                    return dname
         return None
 
+    def register_dashboard(self, created):
+        with self.dashboards_lock:
+            if isinstance(created, dict) and created.get('id') and self.dashboards_name2id is not None:
+                self.dashboards_name2id[created['name']] = created['id']
+            else:
+                self.dashboards_name2id = None
+
     def snippet_name2id(self, database_name, snippet_name):
-        if not self.snippets_name2id:
-            for s in self.get_snippets(database_name):
-                self.snippets_name2id[s['name']] = s['id']
-        return self.snippets_name2id.get(snippet_name)
+        with self.snippets_lock:
+            if self.snippets_name2id is None:
+                snippets_name2id = {}
+                for s in self.get_snippets(database_name):
+                    snippets_name2id[s['name']] = s['id']
+                self.snippets_name2id = snippets_name2id
+            return self.snippets_name2id.get(snippet_name)
+
+    def register_snippet(self, created):
+        with self.snippets_lock:
+            if isinstance(created, dict) and created.get('id') and self.snippets_name2id is not None:
+                self.snippets_name2id[created['name']] = created['id']
+            else:
+                self.snippets_name2id = None
 
     def card_name2id(self, database_name, card_name):
-        if not self.cards_name2id:
-            for c in self.get_cards(database_name):
-                self.cards_name2id[c['name']] = c['id']
-        return self.cards_name2id.get(card_name)
+        if not self.schema_index.has_objects('card'):
+            journal_id = self.journal_id('card', card_name)
+            if journal_id:
+                return journal_id
+        return self.load_objects(database_name, 'card').object_name2id('card', card_name)
 
     def collection_name2id(self, collection_name):
-        if not self.collections_name2id:
-            for c in self.get_collections():
-                self.collections_name2id[c['name']] = c['id']
-        return self.collections_name2id.get(collection_name)
+        with self.collections_lock:
+            if not self.collections_name2id:
+                for c in self.get_collections():
+                    self.collections_name2id[c['name']] = c['id']
+            return self.collections_name2id.get(collection_name)
 
     def metric_name2id(self, database_name, metric_name):
-        if not self.metrics_name2id:
-            for c in self.get_metrics(database_name):
-                self.metrics_name2id[c['name']] = c['id']
-        return self.metrics_name2id.get(metric_name)
+        return self.load_objects(database_name, 'metric').object_name2id('metric', metric_name)
 
     def collection_name2id_or_create_it(self, collection_name):
         cid = self.collection_name2id(collection_name)
@@ -425,10 +1910,13 @@ class MetabaseApi:
         if not param.get('color'):
             param['color'] = '#509ee3'
         cid = self.collection_name2id(collection_name)
-        self.collections_name2id = {}
         if cid:
-            return self.query('PUT', 'collection/'+str(cid), param)
-        return self.query('POST', 'collection', param)
+            res = self.query('PUT', 'collection/'+str(cid), param)
+        else:
+            res = self.query('POST', 'collection', param)
+        with self.collections_lock:
+            self.collections_name2id.clear()
+        return res
 
     def convert_pcnames2id(self, database_name, collection_name, fieldname, pcnames):
         if pcnames[0] != '%':
@@ -443,6 +1931,9 @@ class MetabaseApi:
         if fieldname == 'database_name':
             return [new_k, self.database_name2id(database_name)]
         if fieldname == 'collection_name':
+            # without a target collection the objects go to the root one
+            if not collection_name:
+                return [new_k, None]
             return [new_k, self.collection_name2id_or_create_it(collection_name)]
         if fieldname == 'card_name':
             return [new_k, self.card_name2id(database_name, names)]
@@ -469,6 +1960,7 @@ class MetabaseApi:
             return [new_k, table_id]
         raise ValueError('Unknown '+str(fieldname)+' %'+str(new_k)+'% type')
 
+    @profiled('convert_names2ids')
     def convert_names2ids(self, database_name, collection_name, obj):
         obj_res = obj
         if isinstance(obj, list):
@@ -498,6 +1990,7 @@ class MetabaseApi:
                         obj_res[k] = self.convert_names2ids(database_name, collection_name, obj[k])
         return obj_res
 
+    @profiled('convert_ids2names')
     def convert_ids2names(self, database_name, obj, previous_key):
         obj_res = obj
         if isinstance(obj, list):
@@ -586,12 +2079,221 @@ class MetabaseApi:
 
     def export_dashboards_to_json(self, database_name, dirname):
         export = self.get_dashboards(database_name)
-        for dash in export:
-            if len(dash['ordered_cards']):
-                dash = self.clean_object(dash)
-                with open(dirname+"/dashboard_"+dash['name'].replace('/', '')+".json", 'w', newline = '') as jsonfile:
-                    jsonfile.write(json.dumps(self.convert_ids2names(database_name, dash, None), indent=2, sort_keys=True))
+        self.write_object_exports(database_name, dirname, 'dashboard_', [dash for dash in export if len(dash['ordered_cards'])])
+
+    def export_object(self, database_name, prefix, obj):
+        obj = self.clean_object(obj)
+        filename = prefix+obj['name'].replace('/', '')+".json"
+        return [filename, json.dumps(self.convert_ids2names(database_name, obj, None), indent=2, sort_keys=True)]
+
+    def export_store(self, dirname):
+        # A path ending in .bundle is a single file export bundle, anything else a directory.
+        # The stores are kept, a bundle is indexed once
+        with self.stores_lock:
+            if dirname not in self.export_stores:
+                if dirname.endswith(ExportBundle.SUFFIX):
+                    self.export_stores[dirname] = ExportBundle(dirname)
+                else:
+                    self.export_stores[dirname] = ExportDirectory(dirname)
+            return self.export_stores[dirname]
+
+    def write_export(self, dirname, export):
+        [filename, content] = export
+        self.export_store(dirname).write(filename, content)
+
+    def unique_export(self, export, obj_id, used):
+        # names only differing by a / give the same file, the object id keeps them apart
+        [filename, content] = export
+        if filename in used:
+            renamed = filename[:-len('.json')]+'_'+str(obj_id)+'.json'
+            print('warning: '+filename+' is already exported, writing '+renamed)
+            filename = renamed
+        used.add(filename)
+        return [filename, content]
+
+    def write_object_exports(self, database_name, dirname, prefix, objs):
+        used = set()
+        for obj in objs:
+            obj_id = obj.get('id')
+            self.write_export(dirname, self.unique_export(self.export_object(database_name, prefix, obj), obj_id, used))
+        self.export_store(dirname).flush()
+
+    def compress_export(self, export):
+        # mtime=0 so an unchanged export gives the same file
+        [filename, content] = export
+        return [filename+".gz", gzip.compress(content.encode('utf-8'), mtime=0)]
+
+    def conversion_state(self):
+        return {'database_export': self.database_export, 'schema_index': self.schema_index, 'dashboards_name2id': self.dashboards_name2id}
+
+    def restore_conversion_state(self, state):
+        self.database_export = state['database_export']
+        self.schema_index = state['schema_index']
+        self.dashboards_name2id = state['dashboards_name2id']
+
+    def export_version(self, obj):
+        versions = [str(obj.get('updated_at'))]
+        for c in obj.get('ordered_cards') or []:
+            versions.append(str(c.get('updated_at')))
+            if c.get('card'):
+                versions.append(str(c['card'].get('updated_at')))
+        return '|'.join(versions)
+
+    def read_export_manifest(self, dirname):
+        try:
+            return self.export_store(dirname).read_json("manifest.json")
+        except (FileNotFoundError, ValueError):
+            return {}
 
+    def write_export_manifest(self, dirname, manifest):
+        self.export_store(dirname).replace("manifest.json", json.dumps(manifest, indent=2, sort_keys=True))
+
+    def fetch_remote_objects(self, database_name):
+        self.create_session_if_needed()
+        self.load_schema(database_name)
+        fetchers = {'card': self.get_cards, 'dashboard': self.get_dashboards, 'metric': self.get_metrics, 'snippet': self.get_snippets}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(fetchers)) as executor:
+            futures = {}
+            for kind in fetchers.keys():
+                futures[kind] = executor.submit(fetchers[kind], database_name)
+            objects = {}
+            for kind in futures.keys():
+                objects[kind] = futures[kind].result()
+        return self.seed_remote_objects(database_name, objects)
+
+    def seed_remote_objects(self, database_name, objects):
+        # Every lookup convert_ids2names needs is loaded now, so the conversion does no I/O
+        # (with a lazy schema, the tables the objects are built on are fetched in one batch)
+        self.load_tables(database_name, self.object_tables(objects['card'] + objects['metric'], set()))
+        self.schema_index.load_objects('card', objects['card'])
+        self.schema_index.load_objects('metric', objects['metric'])
+        self.dashboard_name2id(database_name, None)
+        return objects
+
+    def object_tables(self, obj, tables):
+        if isinstance(obj, list):
+            for o in obj:
+                self.object_tables(o, tables)
+        elif isinstance(obj, dict):
+            for k in obj.keys():
+                if k in ['source-table', 'table_id'] and isinstance(obj[k], int):
+                    tables.add(obj[k])
+                else:
+                    self.object_tables(obj[k], tables)
+        return tables
+
+    def object_hash(self, obj):
+        return hashlib.sha256(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_remote_state(self, database_name):
+        return self.build_remote_state(database_name, self.fetch_remote_objects(database_name))
+
+    def build_remote_state(self, database_name, objects):
+        self.remote_state = {}
+        for kind in objects.keys():
+            self.remote_state[kind] = {}
+            for obj in objects[kind]:
+                normalized = json.loads(self.export_object(database_name, kind+'_', obj)[1])
+                self.remote_state[kind][normalized['name']] = self.object_hash(normalized)
+        return self.remote_state
+
+    def is_unchanged(self, kind, obj):
+        if self.remote_state is None or obj.get('delete'):
+            return False
+        return self.remote_state.get(kind, {}).get(obj.get('name')) == self.object_hash(obj)
+
+    def merge_worker_phases(self, results):
+        for [export, phases] in results:
+            self.profile.merge_phases(phases)
+            yield export
+
+    def report_count(self, report, key, n=1):
+        with self.reports_lock:
+            counts = self.reports.setdefault(report, {})
+            counts[key] = counts.get(key, 0) + n
+
+    def export_all_to_json(self, database_name, dirname, jobs=None, incremental=False, compress=False):
+        # the conversion workers get the whole schema, they cannot fetch tables themselves
+        self.create_session_if_needed()
+        self.load_schema(database_name, True)
+        return self.write_exports(database_name, dirname, self.fetch_remote_objects(database_name), jobs, incremental, compress)
+
+    def write_exports(self, database_name, dirname, exports, jobs=None, incremental=False, compress=False):
+        exports['dashboard'] = [d for d in exports['dashboard'] if len(d['ordered_cards'])]
+        store = self.export_store(dirname)
+        compress = compress and store.compression
+
+        previous_manifest = self.read_export_manifest(dirname)
+        previous_hashes = {}
+        for kind in previous_manifest.keys():
+            for entry in previous_manifest[kind].values():
+                previous_hashes[entry['file']] = entry['hash']
+        manifest = {}
+        report = {'written': 0, 'skipped': 0, 'deleted': 0}
+        used = set()
+
+        # the conversion stays in this process unless more than one job is asked for, a pool of processes
+        # has to start and receive the whole schema before it converts anything
+        converter = None
+        if jobs is not None and jobs > 1:
+            converter = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_export_worker_init, initargs=(self.apiurl, self.conversion_state()))
+        writes = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+            try:
+                for kind in ['card', 'dashboard', 'metric', 'snippet']:
+                    prefix = kind+'_'
+                    manifest[kind] = {}
+                    todo = []
+                    entries = []
+                    for obj in exports[kind]:
+                        entry = {'name': obj['name'], 'updated_at': self.export_version(obj)}
+                        previous = previous_manifest.get(kind, {}).get(str(obj['id']))
+                        if incremental and previous and previous['updated_at'] == entry['updated_at'] and previous['file'].endswith('.gz') == compress and store.exists(previous['file']):
+                            manifest[kind][str(obj['id'])] = previous
+                            used.add(previous['file'][:-len('.gz')] if compress else previous['file'])
+                            report['skipped'] += 1
+                            continue
+                        manifest[kind][str(obj['id'])] = entry
+                        entries.append(entry)
+                        todo.append(obj)
+                    ids = [obj['id'] for obj in todo]
+                    if converter:
+                        chunksize = max(1, len(todo) // (jobs * 4))
+                        results = self.merge_worker_phases(converter.map(_export_worker_convert, [database_name] * len(todo), [prefix] * len(todo), todo, chunksize=chunksize))
+                    else:
+                        results = (self.export_object(database_name, prefix, obj) for obj in todo)
+                    for [entry, obj_id, export] in zip(entries, ids, results):
+                        export = self.unique_export(export, obj_id, used)
+                        entry['hash'] = hashlib.sha256(export[1].encode('utf-8')).hexdigest()
+                        if compress:
+                            export = self.compress_export(export)
+                        entry['file'] = export[0]
+                        if incremental and previous_hashes.get(entry['file']) == entry['hash'] and store.exists(entry['file']):
+                            report['skipped'] += 1
+                            continue
+                        report['written'] += 1
+                        writes.append(writer.submit(self.write_export, dirname, export))
+            finally:
+                if converter:
+                    converter.shutdown()
+        for w in writes:
+            w.result()
+
+        files = set()
+        for kind in manifest.keys():
+            for entry in manifest[kind].values():
+                files.add(entry['file'])
+        for filename in set(previous_hashes.keys()) - files:
+            if store.exists(filename):
+                store.remove(filename)
+                report['deleted'] += 1
+        # an export that changed nothing leaves the manifest, and a bundle, as they were
+        if manifest != previous_manifest:
+            self.write_export_manifest(dirname, manifest)
+        store.flush()
+        return report
+
+    @profiled('clean_object')
     def clean_object(self, object):
         if 'updated_at' in object:
             del object['updated_at']
@@ -624,66 +2326,103 @@ class MetabaseApi:
         return object
 
     def export_snippet_to_json(self, database_name, dirname):
-        export = self.get_snippets(database_name)
-        for sn in export:
-            sn = self.clean_object(sn)
-            with open(dirname+"/snippet_"+sn['name'].replace('/', '')+".json", 'w', newline = '') as jsonfile:
-                jsonfile.write(json.dumps(self.convert_ids2names(database_name, sn, None), indent=2, sort_keys=True))
+        self.write_object_exports(database_name, dirname, 'snippet_', self.get_snippets(database_name))
 
     def export_cards_to_json(self, database_name, dirname):
-        export = self.get_cards(database_name)
-        for card in export:
-            card = self.clean_object(card)
-            with open(dirname+"/card_"+card['name'].replace('/', '')+".json", 'w', newline = '') as jsonfile:
-                jsonfile.write(json.dumps(self.convert_ids2names(database_name, card, None), indent=2, sort_keys=True))
+        self.write_object_exports(database_name, dirname, 'card_', self.iter_cards(database_name))
 
     def export_metrics_to_json(self, database_name, dirname):
-        export = self.get_metrics(database_name)
-        for metric in export:
-            metric = self.clean_object(metric)
-            with open(dirname+"/metric_"+metric['name'].replace('/', '')+".json", 'w', newline = '') as jsonfile:
-                jsonfile.write(json.dumps(self.convert_ids2names(database_name, metric, None), indent=2, sort_keys=True))
+        self.write_object_exports(database_name, dirname, 'metric_', self.get_metrics(database_name))
+
+    def run_steps(self, steps):
+        # The writes of an import are generators yielding their requests, [method, query_name, data],
+        # and receiving the responses: this runs them with query, metabase_async.AsyncMetabaseApi
+        # runs the same generators on its event loop. A ConnectionError is raised in the generator
+        response = None
+        error = None
+        while True:
+            try:
+                if error is not None:
+                    request = steps.throw(error)
+                else:
+                    request = steps.send(response)
+            except StopIteration as e:
+                return e.value
+            response = None
+            error = None
+            try:
+                response = self.query(*request)
+            except ConnectionError as e:
+                error = e
 
     def dashboard_import(self, database_name, dash_from_json):
+        return self.run_steps(self.dashboard_import_steps(database_name, dash_from_json))
+
+    def dashboard_import_steps(self, database_name, dash_from_json):
         dashid = self.dashboard_name2id(database_name, dash_from_json['name'])
+        self.invalidate_dashboards(database_name)
         if dashid:
-            return self.query('PUT', 'dashboard/'+str(dashid), dash_from_json)
-        self.dashboards_name2id = None
-        return self.query('POST', 'dashboard', dash_from_json)
+            return (yield ['PUT', 'dashboard/'+str(dashid), dash_from_json])
+        res = yield ['POST', 'dashboard', dash_from_json]
+        self.register_dashboard(res)
+        return res
 
     def snippet_import(self, database_name, snippet_from_json):
+        return self.run_steps(self.snippet_import_steps(database_name, snippet_from_json))
+
+    def snippet_import_steps(self, database_name, snippet_from_json):
         if not snippet_from_json.get('description'):
             snippet_from_json['description'] = None
         snippetid = self.snippet_name2id(database_name, snippet_from_json['name'])
         if snippetid:
-            return self.query('PUT', 'native-query-snippet/'+str(snippetid), snippet_from_json)
-        self.snippets_name2id = {}
-        return self.query('POST', 'native-query-snippet', snippet_from_json)
+            return (yield ['PUT', 'native-query-snippet/'+str(snippetid), snippet_from_json])
+        res = yield ['POST', 'native-query-snippet', snippet_from_json]
+        self.register_snippet(res)
+        return res
 
     def card_import(self, database_name, card_from_json):
+        return self.run_steps(self.card_import_steps(database_name, card_from_json))
+
+    def card_import_steps(self, database_name, card_from_json):
         if not card_from_json.get('description'):
             card_from_json['description'] = None
         cardid = self.card_name2id(database_name, card_from_json['name'])
         if cardid:
             if card_from_json.get('delete'):
-                return self.query('DELETE', 'card/'+str(cardid))
-            return self.query('PUT', 'card/'+str(cardid), card_from_json)
+                res = yield ['DELETE', 'card/'+str(cardid), None]
+                self.schema_index.remove_object('card', cardid)
+                return res
+            return (yield ['PUT', 'card/'+str(cardid), card_from_json])
         if card_from_json.get('delete'):
             return None
-        self.cards_name2id = {}
-        return self.query('POST', 'card', card_from_json)
+        res = yield ['POST', 'card', card_from_json]
+        self.register_object('card', res)
+        return res
 
     def metric_import(self, database_name, metric_from_json):
+        return self.run_steps(self.metric_import_steps(database_name, metric_from_json))
+
+    def metric_import_steps(self, database_name, metric_from_json):
         metricid = self.metric_name2id(database_name, metric_from_json['name'])
         metric_from_json['revision_message'] = "Import du "+datetime.datetime.now().isoformat()
         if metricid:
-            return self.query('PUT', 'metric/'+str(metricid), metric_from_json)
-        self.metrics_name2id = {}
-        return self.query('POST', 'metric', metric_from_json)
+            return (yield ['PUT', 'metric/'+str(metricid), metric_from_json])
+        res = yield ['POST', 'metric', metric_from_json]
+        self.register_object('metric', res)
+        return res
+
+    def register_object(self, kind, created):
+        if not self.schema_index.has_objects(kind):
+            return
+        if isinstance(created, dict) and created.get('id') and created.get('name'):
+            self.schema_index.add_object(kind, created)
+        else:
+            self.schema_index.invalidate(kind)
 
     def dashboard_delete_all_cards(self, database_name, dashboard_name):
         dash = self.get_dashboard(database_name, dashboard_name)
         res = []
+        self.invalidate_dashboards(database_name)
         for c in dash['ordered_cards']:
             res.append(self.query('DELETE', 'dashboard/'+str(dash['id'])+'/cards?dashcardId='+str(c['id'])))
         return res
@@ -694,18 +2433,17 @@ class MetabaseApi:
         if cardid:
             ordered_card_from_json['cardId'] = cardid
             ordered_card_from_json.pop('card')
+        self.invalidate_dashboards(database_name)
         return self.query('POST', 'dashboard/'+str(dashid)+'/cards', ordered_card_from_json)
 
     def import_snippets_from_json(self, database_name, dirname, collection_name = None):
         res = []
-        jsondata = self.get_json_data('snippet_', dirname)
-        if len(jsondata):
+        jsondata = self.iter_json_data('snippet_', dirname)
+        if jsondata:
             errors = None
             for snippet in jsondata:
                 try:
-                    data = self.convert_names2ids(database_name, collection_name, snippet)
-                    del data["collection_id"]
-                    res.append(self.snippet_import(database_name, data))
+                    res.append(self.import_object(database_name, 'snippet', snippet, collection_name))
                 except ValueError as e:
                     if not errors:
                         errors = ValueError(snippet['name']+": "+ str(e))
@@ -717,16 +2455,13 @@ class MetabaseApi:
 
     def import_cards_from_json(self, database_name, dirname, collection_name = None):
         res = []
-        jsondata = self.get_json_data('card_', dirname)
-        for dash in self.get_json_data('dashboard_', dirname):
-            for embed_card in dash['ordered_cards']:
-                if embed_card and embed_card['card']:
-                    jsondata.append(embed_card['card'])
-        if len(jsondata):
+        [entries, refs] = self.scan_import(dirname, ['card'])
+        if len(entries):
+            self.check_references(database_name, entries, refs)
             errors = None
-            for card in jsondata:
+            for [kind, card, source] in self.iter_import_objects(dirname, ['card']):
                 try:
-                    res.append(self.card_import(database_name, self.convert_names2ids(database_name, collection_name, card)))
+                    res.append(self.import_object(database_name, 'card', card, collection_name))
                 except ValueError as e:
                     if not errors:
                         errors = ValueError(card['name']+": "+ str(e))
@@ -737,29 +2472,26 @@ class MetabaseApi:
         return res
 
     def importfiles_from_dirname(self, prefix, dirname):
-        files = []
-        for file in os.listdir(dirname):
-            if file.find(prefix) > -1:
-                files.append(dirname+'/'+file)
-        return files
+        return self.export_store(dirname).names(prefix)
 
     def get_json_data(self, prefix, dirname):
-        jsondata = []
+        return list(self.iter_json_data(prefix, dirname))
+
+    def iter_json_data(self, prefix, dirname):
+        store = self.export_store(dirname)
         for filename in self.importfiles_from_dirname(prefix, dirname):
-            with open(filename, 'r', newline = '') as jsonfile:
-                data = json.load(jsonfile)
-                if len(data):
-                    jsondata.append(data)
-        return jsondata
+            data = store.read_json(filename)
+            if len(data):
+                yield data
 
     def import_metrics_from_json(self, database_name, dirname, collection_name = None):
         res = []
-        jsondata = self.get_json_data('metric_', dirname)
+        jsondata = self.iter_json_data('metric_', dirname)
         if jsondata:
             errors = None
             for metric in jsondata:
                 try:
-                    res.append(self.metric_import(database_name, self.convert_names2ids(database_name, None, metric)))
+                    res.append(self.import_object(database_name, 'metric', metric))
                 except ValueError as e:
                     if not errors:
                         errors = ValueError(metric['name']+": "+ str(e))
@@ -771,16 +2503,660 @@ class MetabaseApi:
 
     def import_dashboards_from_json(self, database_name, dirname, collection_name = None):
         res = [[], [], []]
-        jsondata = self.get_json_data('dashboard_', dirname)
-        if len(jsondata):
-            jsondata = self.convert_names2ids(database_name, collection_name, jsondata)
-            for dash in jsondata:
-                res[0].append(self.dashboard_import(database_name, dash))
-                self.dashboard_delete_all_cards(database_name, dash['name'])
-                for ocard in dash['ordered_cards']:
-                    res[1].append(self.dashboard_import_card(database_name, dash['name'], ocard))
+        for dash in self.iter_json_data('dashboard_', dirname):
+            imported = self.import_object(database_name, 'dashboard', dash, collection_name)
+            if imported:
+                [dash_res, cards_res] = imported
+                res[0].append(dash_res)
+                res[1] += cards_res
+        return res
+
+    def import_converted_dashboard(self, database_name, dash):
+        return self.run_steps(self.import_converted_dashboard_steps(database_name, dash))
+
+    def import_converted_dashboard_steps(self, database_name, dash):
+        dash_res = yield from self.dashboard_import_steps(database_name, dash)
+        cards_res = yield from self.dashboard_sync_cards_steps(database_name, dash['name'], dash['ordered_cards'])
+        return [dash_res, cards_res]
+
+    DASHCARD_LAYOUT_KEYS = ['card_id', 'row', 'col', 'sizeX', 'sizeY', 'size_x', 'size_y', 'series', 'parameter_mappings', 'visualization_settings']
+
+    def dashcard_changed(self, existing, desired):
+        for k in self.DASHCARD_LAYOUT_KEYS:
+            if k == 'series':
+                # the server answers with the whole cards of the series, the export has them cleaned
+                if k in desired and self.series_ids(existing.get(k)) != self.series_ids(desired[k]):
+                    return True
+            elif k in desired and existing.get(k) != desired[k]:
+                return True
+        return False
+
+    def series_ids(self, series):
+        return [s.get('id') for s in series or []]
+
+    def dashcards_series_by_id(self, database_name, ordered_cards):
+        # the cards of a series are sent by id, the one they have on this server
+        res = []
+        for dashcard in ordered_cards:
+            if dashcard.get('series'):
+                dashcard = dict(dashcard)
+                dashcard['series'] = [{'id': self.card_name2id(database_name, s['name']) or s.get('id')} if s.get('name') else s for s in dashcard['series']]
+            res.append(dashcard)
         return res
 
+    def dashcard_card(self, dashcard):
+        # card_id once converted for the server, card_name in the exported form
+        if 'card_id' in dashcard:
+            return dashcard['card_id']
+        return dashcard.get('card_name')
+
+    def dashcards_match(self, existing_cards, desired_cards):
+        # Same card at the same place first, then the same card moved elsewhere
+        matches = [None] * len(desired_cards)
+        available = list(existing_cards)
+        for match_position in [True, False]:
+            for i in range(len(desired_cards)):
+                if matches[i] is not None:
+                    continue
+                desired = desired_cards[i]
+                for existing in available:
+                    if self.dashcard_card(existing) != self.dashcard_card(desired):
+                        continue
+                    if match_position and [existing.get('row'), existing.get('col')] != [desired.get('row'), desired.get('col')]:
+                        continue
+                    matches[i] = existing
+                    available.remove(existing)
+                    break
+        return [matches, available]
+
+    def dashcards_plan(self, existing_cards, ordered_cards):
+        [matches, removed] = self.dashcards_match(existing_cards, ordered_cards)
+        plan = {'layout': [], 'added': [], 'removed': removed, 'changed': False}
+        for i in range(len(ordered_cards)):
+            dashcard = ordered_cards[i].copy()
+            dashcard.pop('card', None)
+            if matches[i] is None:
+                if dashcard.get('card_id'):
+                    dashcard['cardId'] = dashcard['card_id']
+                plan['added'].append(dashcard)
+                continue
+            plan['changed'] = plan['changed'] or self.dashcard_changed(matches[i], dashcard)
+            dashcard['id'] = matches[i]['id']
+            plan['layout'].append(dashcard)
+        return plan
+
+    def dashcards_bulk_layout(self, plan):
+        # Recent servers create the cards with a negative id and delete the missing ones in one call
+        new_cards = []
+        for i in range(len(plan['added'])):
+            new_card = plan['added'][i].copy()
+            new_card['id'] = -1 - i
+            new_cards.append(new_card)
+        return {'cards': plan['layout'] + new_cards}
+
+    def dashcards_bulk_applied(self, res, plan):
+        # Servers before 0.47 answer {"status": "ok"} and only move the existing cards, the
+        # recent ones answer with the cards the dashboard now has
+        if not isinstance(res, dict) or not isinstance(res.get('cards'), list):
+            return False
+        expected = sorted([str(self.dashcard_card(c)) for c in plan['layout'] + plan['added']])
+        return sorted([str(self.dashcard_card(c)) for c in res['cards']]) == expected
+
+    def dashboard_sync_cards(self, database_name, dashboard_name, ordered_cards):
+        return self.run_steps(self.dashboard_sync_cards_steps(database_name, dashboard_name, ordered_cards))
+
+    def dashboard_sync_cards_steps(self, database_name, dashboard_name, ordered_cards):
+        dash_url = 'dashboard/'+str(self.dashboard_name2id(database_name, dashboard_name))
+        ordered_cards = self.dashcards_series_by_id(database_name, ordered_cards)
+        dash = yield ['GET', dash_url, None]
+        plan = self.dashcards_plan(dash['ordered_cards'], ordered_cards)
+        if not plan['changed'] and not plan['added'] and not plan['removed']:
+            return []
+
+        self.invalidate_dashboards(database_name)
+        url = 'dashboard/'+str(dash['id'])+'/cards'
+        if (plan['added'] or plan['removed']) and self.bulk_dashcards is not False:
+            try:
+                res = yield ['PUT', url, self.dashcards_bulk_layout(plan)]
+                if self.dashcards_bulk_applied(res, plan):
+                    self.bulk_dashcards = True
+                    return [res]
+                # the server does not create nor delete cards this way, the next dashboards go card by card
+                self.bulk_dashcards = False
+            except ConnectionError:
+                pass
+            # the cards are compared again with what the dashboard has after the attempt
+            dash = yield ['GET', dash_url, None]
+            plan = self.dashcards_plan(dash['ordered_cards'], ordered_cards)
+        res = []
+        for c in plan['removed']:
+            res.append((yield ['DELETE', url+'?dashcardId='+str(c['id']), None]))
+        for c in plan['added']:
+            res.append((yield ['POST', url, c]))
+        if plan['changed']:
+            res.append((yield ['PUT', url, {'cards': plan['layout']}]))
+        return res
+
+    def object_name2id(self, database_name, kind, name):
+        if kind == 'metric':
+            return self.metric_name2id(database_name, name)
+        if kind == 'snippet':
+            return self.snippet_name2id(database_name, name)
+        if kind == 'card':
+            return self.card_name2id(database_name, name)
+        if kind == 'dashboard':
+            return self.dashboard_name2id(database_name, name)
+        raise ValueError('unknown object kind '+kind)
+
+    def import_object(self, database_name, kind, obj, collection_name = None):
+        return self.run_steps(self.import_object_steps(database_name, kind, obj, collection_name))
+
+    def import_object_steps(self, database_name, kind, obj, collection_name = None):
+        obj_hash = None
+        if self.journal:
+            obj_hash = self.object_hash(obj)
+            # an object the server lost since it was recorded is imported again
+            if self.journal.completed(kind, obj['name'], obj_hash) and (obj.get('delete') or self.journal_id(kind, obj['name'])):
+                self.report_count('import', 'resumed')
+                return None
+        if self.is_unchanged(kind, obj):
+            self.report_count('import', 'unchanged')
+            res = None
+        else:
+            if self.object_name2id(database_name, kind, obj['name']):
+                self.report_count('import', 'updated')
+            else:
+                self.report_count('import', 'created')
+            res = yield from self.import_converted_object_steps(database_name, kind, obj, collection_name)
+        if self.journal:
+            self.journal.record(kind, obj['name'], obj_hash, self.imported_id(database_name, kind, obj, res))
+        return res
+
+    def import_converted_object(self, database_name, kind, obj, collection_name = None):
+        return self.run_steps(self.import_converted_object_steps(database_name, kind, obj, collection_name))
+
+    def import_converted_object_steps(self, database_name, kind, obj, collection_name = None):
+        if kind == 'metric':
+            return (yield from self.metric_import_steps(database_name, self.convert_names2ids(database_name, None, obj)))
+        if kind == 'snippet':
+            data = self.convert_names2ids(database_name, collection_name, obj)
+            del data["collection_id"]
+            return (yield from self.snippet_import_steps(database_name, data))
+        if kind == 'card':
+            return (yield from self.card_import_steps(database_name, self.convert_names2ids(database_name, collection_name, obj)))
+        if kind == 'dashboard':
+            return (yield from self.import_converted_dashboard_steps(database_name, self.convert_names2ids(database_name, collection_name, obj)))
+        raise ValueError('unknown object kind '+kind)
+
+    def imported_id(self, database_name, kind, obj, res):
+        if obj.get('delete'):
+            return None
+        if kind == 'dashboard' and isinstance(res, list) and res:
+            res = res[0]
+        if isinstance(res, dict) and res.get('id'):
+            return res['id']
+        # unchanged objects keep the id they have on the server
+        return self.object_name2id(database_name, kind, obj['name'])
+
+    def open_journal(self, database_name, dirname, resume = False):
+        self.close_journal()
+        self.journal = ImportJournal(self.export_store(dirname).journal_path(), database_name, resume)
+        return self.journal
+
+    def close_journal(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def journal_id(self, kind, name):
+        # The object may have been deleted or recreated on the server since it was recorded, the
+        # id is only used once the server answers with an object of this name for it
+        if self.journal is None:
+            return None
+        return self.journal.checked_id(kind, name, lambda: self.journal_alive_ids(kind))
+
+    def journal_alive_ids(self, kind):
+        # one list per kind, whatever the number of journaled ids to check
+        database_name = self.journal.database_name
+        if kind not in ['card', 'metric', 'snippet', 'dashboard']:
+            raise ValueError('unknown object kind '+kind)
+        alive = {}
+        try:
+            if kind == 'card':
+                objects = self.iter_cards(database_name)
+            elif kind == 'metric':
+                objects = self.get_metrics(database_name)
+            elif kind == 'snippet':
+                objects = self.get_snippets(database_name)
+            else:
+                objects = self.query('GET', 'dashboard')
+            for obj in objects:
+                if not obj.get('archived'):
+                    alive[obj['id']] = obj['name']
+        except ConnectionError:
+            # none of the recorded ids is trusted, the names are resolved by the lists of the import
+            return {}
+        return alive
+
+    def object_references(self, obj, references = None):
+        if references is None:
+            references = set()
+        if isinstance(obj, list):
+            if len(obj) > 1 and obj[0] == 'metric' and isinstance(obj[1], str) and obj[1][0:4] == '%%||':
+                references.add(('metric', obj[1][4:]))
+            for o in obj:
+                self.object_references(o, references)
+        elif isinstance(obj, dict):
+            for k in obj.keys():
+                if k in ['card_name', 'pseudo_table_card_name', 'dashboard_name'] and isinstance(obj[k], str) and obj[k][0:1] == '%':
+                    sep = obj[k].find('%', 1)
+                    if sep > -1 and obj[k][sep+1:]:
+                        references.add((k.split('_')[-2], obj[k][sep+1:]))
+                else:
+                    self.object_references(obj[k], references)
+        return references
+
+    def scan_references(self, obj, refs = None):
+        # The names convert_names2ids will look up, by kind; source_card are the cards used as
+        # source of a question, which have to exist. The tokens in keys are only looked up if they
+        # can be, so they just add their table to the ones to load
+        if refs is None:
+            refs = {'table': set(), 'required_table': set(), 'field': set(), 'metric': set(), 'card': set(), 'source_card': set(), 'dashboard': set()}
+        if isinstance(obj, list):
+            if len(obj) > 1 and obj[0] in ['field', 'metric'] and isinstance(obj[1], str) and obj[1][0:1] == '%':
+                self.scan_token(None, obj[1], refs)
+            else:
+                for o in obj:
+                    self.scan_references(o, refs)
+        elif isinstance(obj, dict):
+            for k in obj.keys():
+                if k[0:1] == '%':
+                    self.scan_token(None, k, refs, False)
+                    self.scan_references(obj[k], refs)
+                elif k in ['field_name', 'table_name', 'card_name', 'pseudo_table_card_name', 'dashboard_name'] and isinstance(obj[k], str) and obj[k][0:1] == '%':
+                    self.scan_token(k, obj[k], refs)
+                else:
+                    self.scan_references(obj[k], refs)
+        return refs
+
+    def scan_token(self, fieldname, pcnames, refs, required = True):
+        sep = pcnames.find('%', 1)
+        if sep == -1:
+            return
+        [new_k, names] = pcnames[1:sep], pcnames[sep+1:]
+        if new_k == 'JSONCONV':
+            try:
+                self.scan_references(json.loads(names), refs)
+            except ValueError:
+                pass
+            return
+        if not names:
+            return
+        if not required:
+            refs['table'].add(names.split('|')[0])
+        elif fieldname == 'card_name':
+            refs['card'].add(names)
+        elif fieldname == 'pseudo_table_card_name':
+            refs['source_card'].add(names)
+        elif fieldname == 'dashboard_name':
+            refs['dashboard'].add(names)
+        else:
+            resplit = names.split('|')
+            if len(resplit) == 3:
+                refs['metric'].add(resplit[2])
+            elif len(resplit) == 2:
+                refs['table'].add(resplit[0])
+                refs['field'].add((resplit[0], resplit[1]))
+            elif len(resplit) == 1:
+                refs['table'].add(names)
+                refs['required_table'].add(names)
+
+    def resolve_references(self, database_name, entries, refs):
+        # First pass of an import: the tables every object refers to are loaded in one batch and
+        # the references that cannot be resolved are returned together, so that the conversions
+        # of the second pass only read the caches. The objects being imported count as resolved
+        if refs is None:
+            return []
+        imported = set([(entry['kind'], entry['name']) for entry in entries])
+        index = self.load_schema(database_name)
+        self.load_tables(database_name, [index.table_name2id(t) for t in refs['table']])
+        unresolved = []
+        for t in sorted(refs['required_table']):
+            if index.table_name2id(t) is None:
+                unresolved.append('table '+t)
+        for [t, f] in sorted(refs['field']):
+            if not self.field_tablenameandfieldname2field(database_name, t, f):
+                unresolved.append('field '+t+'/'+f)
+        for m in sorted(refs['metric']):
+            if ('metric', m) not in imported and not self.metric_name2id(database_name, m):
+                unresolved.append('metric '+m)
+        for c in sorted(refs['source_card']):
+            if ('card', c) not in imported and not self.card_name2id(database_name, c):
+                unresolved.append('card '+c)
+        return unresolved
+
+    def check_references(self, database_name, entries, refs):
+        unresolved = self.resolve_references(database_name, entries, refs)
+        if unresolved:
+            raise ValueError("unresolved references: "+', '.join(unresolved))
+
+    def import_all_from_json(self, database_name, dirname, collection_name = None, cards_collection_name = None, jobs = None, incremental = False, journal = False, resume = False):
+        jobs = self.write_jobs(jobs)
+        collections = self.import_collections(collection_name, cards_collection_name)
+        [entries, refs] = self.scan_import(dirname)
+        if journal or resume:
+            self.open_journal(database_name, dirname, resume)
+        try:
+            # Fill every name cache before the workers start, they only update them afterwards.
+            # When resuming, the ids recorded in the journal spare the cards and dashboards lists
+            # if every name left to resolve is in it
+            lookups = self.import_lookups(entries)
+            self.create_session_if_needed()
+            self.load_schema(database_name)
+            if 'card' in lookups:
+                self.load_objects(database_name, 'card')
+            self.load_objects(database_name, 'metric')
+            self.snippet_name2id(database_name, None)
+            if 'dashboard' in lookups:
+                self.dashboard_name2id(database_name, None)
+            for c in set(collections.values()):
+                if c:
+                    self.collection_name2id_or_create_it(c)
+            self.check_references(database_name, entries, refs)
+            self.remote_state = None
+            if incremental:
+                self.load_remote_state(database_name)
+
+            scheduler = self.import_scheduler(dirname, jobs, lambda kind, obj: self.import_object(database_name, kind, obj, collections[kind]), entries)
+            try:
+                [results, errors] = scheduler.run()
+            finally:
+                self.remote_state = None
+        finally:
+            self.close_journal()
+        return self.import_results(results, errors)
+
+    def import_lookups(self, entries):
+        if self.journal is None:
+            return set(['card', 'dashboard'])
+        kinds = set()
+        for entry in entries:
+            if self.journal.completed(entry['kind'], entry['name'], entry['hash']):
+                continue
+            for [ref_kind, name] in set([(entry['kind'], entry['name'])]) | entry['references']:
+                if self.journal.object_id(ref_kind, name) is None:
+                    kinds.add(ref_kind)
+        return kinds
+
+    def import_collections(self, collection_name = None, cards_collection_name = None):
+        if cards_collection_name is None:
+            cards_collection_name = collection_name
+        return {'metric': None, 'snippet': collection_name, 'card': cards_collection_name, 'dashboard': collection_name}
+
+    def import_scheduler(self, dirname, jobs, run_object, entries = None):
+        # Each object is read from its file again when its turn comes, meanwhile only its entry is kept
+        if entries is None:
+            entries = self.scan_import(dirname)[0]
+        scheduler = ImportScheduler(jobs)
+        sources = ImportSources(self, entries)
+        for entry in entries:
+            scheduler.add((entry['kind'], entry['name']), functools.partial(self.run_import_entry, run_object, sources, entry), entry['references'])
+        return scheduler
+
+    def run_import_entry(self, run_object, sources, entry):
+        return run_object(entry['kind'], sources.load(entry))
+
+    def scan_import(self, dirname, kinds = ('metric', 'snippet', 'card', 'dashboard')):
+        # First pass over the import files, one object at a time: the entries keep what the
+        # scheduler and the journal need, refs the names the objects refer to
+        entries = []
+        refs = None
+        for [kind, obj, source] in self.iter_import_objects(dirname, kinds):
+            entries.append(self.import_entry(kind, obj, source))
+            if not obj.get('delete'):
+                refs = self.scan_references(obj, refs)
+        return [entries, refs]
+
+    def import_entry(self, kind, obj, source):
+        return {'kind': kind, 'name': obj['name'], 'source': source, 'hash': self.object_hash(obj), 'references': self.object_references(obj)}
+
+    def iter_import_objects(self, dirname, kinds = ('metric', 'snippet', 'card', 'dashboard')):
+        # The source of an object is its export and its file, and the position of the card for
+        # the cards embedded in a dashboard
+        store = self.export_store(dirname)
+        for kind in ['metric', 'snippet', 'card']:
+            if kind not in kinds:
+                continue
+            for filename in self.importfiles_from_dirname(kind+'_', dirname):
+                obj = store.read_json(filename)
+                if len(obj):
+                    yield [kind, obj, [dirname, filename, None]]
+        if 'card' not in kinds and 'dashboard' not in kinds:
+            return
+        for filename in self.importfiles_from_dirname('dashboard_', dirname):
+            dash = store.read_json(filename)
+            if not len(dash):
+                continue
+            if 'card' in kinds:
+                for i in range(len(dash['ordered_cards'])):
+                    embed_card = dash['ordered_cards'][i]
+                    if embed_card and embed_card['card'] and embed_card['card'].get('name'):
+                        yield ['card', copy.deepcopy(embed_card['card']), [dirname, filename, i]]
+            if 'dashboard' in kinds:
+                yield ['dashboard', dash, [dirname, filename, None]]
+
+    def import_results(self, results, errors):
+        if errors:
+            raise ValueError(" ;\n".join([key[0]+" "+key[1]+": "+str(errors[key]) for key in errors.keys()]))
+        res = {'metric': [], 'snippet': [], 'card': [], 'dashboard': []}
+        for key in results.keys():
+            res[key[0]].append(results[key])
+        return res
+
+    def plan_import(self, database_name, dirname, collection_name = None, cards_collection_name = None):
+        # Reads everything the import needs at once and decides, without writing, what each object needs
+        collections = self.import_collections(collection_name, cards_collection_name)
+        self.create_session_if_needed()
+        remote = self.fetch_remote_objects(database_name)
+        # ids and versions first, the normalization strips them
+        remote_versions = self.object_versions({'card': remote['card'], 'metric': remote['metric'], 'snippet': remote['snippet'], 'dashboard': self.query('GET', 'dashboard')})
+        remote_ids = {
+                        'card': self.schema_index.objects_name2id.get('card', {}).copy(),
+                        'metric': self.schema_index.objects_name2id.get('metric', {}).copy(),
+                        'snippet': dict([[s['name'], s['id']] for s in remote['snippet']]),
+                        'dashboard': dict(self.dashboards_name2id or {})
+                     }
+        current = {}
+        for kind in remote.keys():
+            current[kind] = {}
+            for obj in remote[kind]:
+                normalized = json.loads(self.export_object(database_name, kind+'_', obj)[1])
+                current[kind][normalized['name']] = normalized
+        plan = {
+                    'database': database_name,
+                    'directory': dirname,
+                    'collections': collections,
+                    'new_collections': sorted(set([c for c in collections.values() if c and not self.collection_name2id(c)])),
+                    'remote_ids': remote_ids,
+                    'remote_versions': remote_versions,
+                    'objects': [],
+                    'fields': []
+               }
+        seen = set()
+        imports = []
+        refs = None
+        for [kind, obj, source] in self.iter_import_objects(dirname):
+            if (kind, obj['name']) in seen:
+                continue
+            seen.add((kind, obj['name']))
+            imports.append(self.import_entry(kind, obj, source))
+            if not obj.get('delete'):
+                refs = self.scan_references(obj, refs)
+            existing = current.get(kind, {}).get(obj['name'])
+            entry = {'kind': kind, 'name': obj['name'], 'hash': self.object_hash(obj)}
+            if kind == 'card' and obj.get('delete'):
+                entry['action'] = 'delete' if existing else 'noop'
+            elif existing is None:
+                entry['action'] = 'create'
+            elif self.object_hash(existing) == entry['hash']:
+                entry['action'] = 'noop'
+            else:
+                entry['action'] = 'update'
+            if kind == 'dashboard' and entry['action'] != 'noop':
+                entry['dashcards'] = self.dashcards_summary((existing or {}).get('ordered_cards', []), obj['ordered_cards'])
+            entry['requests'] = self.plan_requests(entry)
+            plan['objects'].append(entry)
+        plan['unresolved'] = self.resolve_references(database_name, imports, refs)
+        if self.fields_csv_name(dirname):
+            tables = self.fields_to_update(database_name, self.read_fields_csv(dirname))
+            for datas in tables.values():
+                plan['fields'] += datas
+        plan['requests'] = self.plan_totals(plan)
+        return plan
+
+    def dashcards_summary(self, existing_cards, desired_cards):
+        [matches, removed] = self.dashcards_match(existing_cards, desired_cards)
+        summary = {'added': 0, 'removed': len(removed), 'changed': 0}
+        for i in range(len(desired_cards)):
+            if matches[i] is None:
+                summary['added'] += 1
+            elif self.dashcard_changed(matches[i], desired_cards[i]):
+                summary['changed'] += 1
+        return summary
+
+    def plan_requests(self, entry):
+        if entry['action'] == 'noop':
+            return {}
+        if entry['action'] == 'delete':
+            return {'DELETE': 1}
+        requests = {'POST': 0, 'PUT': 0}
+        requests['POST' if entry['action'] == 'create' else 'PUT'] += 1
+        if entry['kind'] == 'dashboard':
+            requests['GET'] = 1
+            if entry['dashcards']['added'] or entry['dashcards']['removed'] or entry['dashcards']['changed']:
+                requests['PUT'] += 1
+        return requests
+
+    def plan_totals(self, plan):
+        totals = {'GET': 0, 'POST': len(plan['new_collections']), 'PUT': len(plan['fields']), 'DELETE': 0}
+        for entry in plan['objects']:
+            for method in entry['requests'].keys():
+                totals[method] += entry['requests'][method]
+        return totals
+
+    def plan_summary(self, plan):
+        lines = []
+        for kind in ['metric', 'snippet', 'card', 'dashboard']:
+            actions = {'create': 0, 'update': 0, 'delete': 0, 'noop': 0}
+            for entry in plan['objects']:
+                if entry['kind'] == kind:
+                    actions[entry['action']] += 1
+            lines.append("%-10s %d to create, %d to update, %d to delete, %d unchanged" % (kind+'s:', actions['create'], actions['update'], actions['delete'], actions['noop']))
+        lines.append("%-10s %d to update" % ('fields:', len(plan['fields'])))
+        if plan['new_collections']:
+            lines.append("%-10s %s to create" % ('collections:', ', '.join(plan['new_collections'])))
+        if plan['unresolved']:
+            lines.append("%-10s %s" % ('unresolved:', ', '.join(plan['unresolved'])))
+        requests = plan['requests']
+        lines.append("requests:  %d GET, %d POST, %d PUT, %d DELETE" % (requests['GET'], requests['POST'], requests['PUT'], requests['DELETE']))
+        return "\n".join(lines)
+
+    def object_versions(self, lists):
+        # name and updated_at by id, enough to tell whether the objects changed on the server since a plan
+        versions = {}
+        for kind in lists.keys():
+            versions[kind] = dict([[str(o['id']), [o['name'], str(o.get('updated_at'))]] for o in lists[kind]])
+        return versions
+
+    def remote_versions(self, database_name):
+        return self.object_versions({
+                    'card': self.iter_cards(database_name), 'metric': self.get_metrics(database_name),
+                    'snippet': self.get_snippets(database_name), 'dashboard': self.query('GET', 'dashboard')
+                })
+
+    def remote_drift(self, plan, versions):
+        # the planned objects created, deleted, updated or renamed on the server since the plan
+        drift = []
+        for kind in versions.keys():
+            names = set([entry['name'] for entry in plan['objects'] if entry['kind'] == kind])
+            before = plan['remote_versions'].get(kind, {})
+            now = versions[kind]
+            for obj_id in sorted(set(before.keys()) | set(now.keys())):
+                if before.get(obj_id) == now.get(obj_id):
+                    continue
+                for version in [before.get(obj_id), now.get(obj_id)]:
+                    if version and version[0] in names:
+                        drift.append(kind+' '+version[0])
+                        break
+        return drift
+
+    def write_plan(self, plan, filename):
+        with open(filename, 'w') as jsonfile:
+            jsonfile.write(json.dumps(plan, indent=2, sort_keys=True))
+
+    def read_plan(self, filename):
+        with open(filename) as jsonfile:
+            return json.load(jsonfile)
+
+    def apply_plan(self, plan, jobs = None, sync_scan = False):
+        # The files must still be the ones the plan was computed from, and the planned objects
+        # the ones the server had then. With sync_scan, the database is synced and scanned between
+        # the fields and the objects, as the import does
+        jobs = self.write_jobs(jobs)
+        database_name = plan['database']
+        planned = {}
+        for entry in plan['objects']:
+            if entry['action'] != 'noop':
+                planned[(entry['kind'], entry['name'])] = entry
+        [entries, refs] = self.scan_import(plan['directory'])
+        objects = []
+        changed = []
+        for imported in entries:
+            entry = planned.get((imported['kind'], imported['name']))
+            if entry is None or entry.get('applied'):
+                continue
+            entry['applied'] = True
+            if imported['hash'] != entry['hash']:
+                changed.append(imported['kind']+' '+imported['name'])
+            objects.append(imported)
+        for key in planned.keys():
+            if not planned[key].pop('applied', False):
+                changed.append(key[0]+' '+key[1]+' (missing)')
+        if changed:
+            raise ValueError("the export changed since the plan was made: "+', '.join(changed))
+        if 'remote_versions' not in plan:
+            raise ValueError("the plan does not record the versions of the server objects, it has to be made again")
+        self.create_session_if_needed()
+        drift = self.remote_drift(plan, self.remote_versions(database_name))
+        if drift:
+            raise ValueError("the server changed since the plan was made: "+', '.join(drift))
+
+        # The ids read by the plan fill the name caches, only the schema and the collections are read again
+        self.load_schema(database_name)
+        remote_ids = plan['remote_ids']
+        for kind in ['card', 'metric']:
+            self.schema_index.load_objects(kind, [{'id': remote_ids[kind][name], 'name': name} for name in remote_ids[kind].keys()])
+        self.snippets_name2id = dict(remote_ids['snippet'])
+        self.dashboards_name2id = dict(remote_ids['dashboard'])
+        self.check_references(database_name, objects, refs)
+        for c in set(plan['collections'].values()):
+            if c:
+                self.collection_name2id_or_create_it(c)
+
+        tables = {}
+        for data in plan['fields']:
+            tables.setdefault(data['table_name'], []).append(data)
+        self.put_fields(tables, jobs)
+        if sync_scan:
+            # the sync drops the schema, it is read again in one request rather than table by table
+            self.sync_scan_database(database_name)
+            self.load_schema(database_name, True)
+
+        collections = plan['collections']
+        scheduler = self.import_scheduler(plan['directory'], jobs, lambda kind, obj: self.import_object(database_name, kind, obj, collections[kind]), objects)
+        [results, errors] = scheduler.run()
+        return self.import_results(results, errors)
+
     def get_users(self):
         self.create_session_if_needed()
         users = self.query('GET', 'user?status=all')
@@ -844,61 +3220,190 @@ class MetabaseApi:
             group = self.create_group(group_name)
             group_id = group['id']
         memberships = self.get_memberships()
-        for m in memberships[str(user_id)]:
+        for m in memberships.get(str(user_id), []):
             if m['group_id'] == group_id:
                 return m
         return self.query('POST', 'permissions/membership', {'group_id': group_id, 'user_id': user_id})
 
+    def provision(self, users = (), groups = (), memberships = (), update_passwords = False, jobs = None, raise_errors = True):
+        # users: [{'email': ..., 'password': ..., 'first_name': ...}], groups: [name], memberships: [[email, group_name]]
+        # report['failed_users'] gives the error of each user a write failed for
+        # The users, groups and memberships are fetched once and only the missing or different ones are written
+        self.create_session_if_needed()
+        report = {
+                    'users_created': 0, 'users_updated': 0, 'users_unchanged': 0, 'passwords': 0,
+                    'groups_created': 0, 'groups_unchanged': 0,
+                    'memberships_added': 0, 'memberships_unchanged': 0, 'failed': 0, 'failed_users': {}
+                 }
+        errors = {}
+        failed_users = report['failed_users']
+        users_email2user = {}
+        for u in self.get_users() or []:
+            users_email2user[u['email']] = u
+        groups_name2id = {}
+        for g in self.get_groups() or []:
+            groups_name2id[g['name']] = g['id']
+        existing_memberships = set()
+        current = self.get_memberships() or {}
+        for user_id in current.keys():
+            for m in current[user_id]:
+                existing_memberships.add((int(user_id), m['group_id']))
+
+        def fail(key, emails, e):
+            errors[key] = e
+            for email in emails:
+                failed_users.setdefault(email, key+": "+str(e))
+
+        def write(key, emails, method, url, data):
+            try:
+                return self.query(method, url, data)
+            except (ConnectionError, ValueError) as e:
+                fail(key, emails, e)
+                return None
+
+        # the jobs only size this executor, the write budget of the transport is shared with the other callers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or self.concurrency) as executor:
+            group_names = list(groups)
+            for [email, group_name] in memberships:
+                if group_name not in group_names:
+                    group_names.append(group_name)
+            created_groups = {}
+            for group_name in group_names:
+                if group_name in groups_name2id or group_name in created_groups:
+                    report['groups_unchanged'] += 1
+                    continue
+                created_groups[group_name] = executor.submit(write, 'group '+group_name, [m[0] for m in memberships if m[1] == group_name], 'POST', 'permissions/group', {'name': group_name})
+            for group_name in created_groups.keys():
+                group = created_groups[group_name].result()
+                if group:
+                    groups_name2id[group_name] = group['id']
+                    report['groups_created'] += 1
+
+            user_writes = {}
+            password_writes = []
+            for user in users:
+                existing = users_email2user.get(user['email'])
+                if not existing:
+                    user_writes[user['email']] = executor.submit(write, 'user '+user['email'], [user['email']], 'POST', 'user', user)
+                    continue
+                data = {}
+                for k in user.keys():
+                    if k not in ['email', 'password'] and existing.get(k) != user[k]:
+                        data[k] = user[k]
+                if data:
+                    user_writes[user['email']] = executor.submit(write, 'user '+user['email'], [user['email']], 'PUT', 'user/'+str(existing['id']), data)
+                else:
+                    report['users_unchanged'] += 1
+                if update_passwords and user.get('password'):
+                    password_writes.append(executor.submit(write, 'password '+user['email'], [user['email']], 'PUT', 'user/'+str(existing['id'])+'/password', {'email': user['email'], 'password': user['password']}))
+            for email in user_writes.keys():
+                res = user_writes[email].result()
+                if not res:
+                    continue
+                if email in users_email2user:
+                    report['users_updated'] += 1
+                else:
+                    report['users_created'] += 1
+                    users_email2user[email] = res
+            for w in password_writes:
+                if w.result() is not None:
+                    report['passwords'] += 1
+
+            membership_writes = []
+            for [email, group_name] in memberships:
+                user = users_email2user.get(email)
+                group_id = groups_name2id.get(group_name)
+                if not user or not group_id:
+                    if ('user '+email) not in errors and ('group '+group_name) not in errors:
+                        fail('membership '+email+' '+group_name, [email], ValueError('unknown user '+email))
+                    continue
+                if (user['id'], group_id) in existing_memberships:
+                    report['memberships_unchanged'] += 1
+                    continue
+                existing_memberships.add((user['id'], group_id))
+                membership_writes.append(executor.submit(write, 'membership '+email+' '+group_name, [email], 'POST', 'permissions/membership', {'group_id': group_id, 'user_id': user['id']}))
+            for w in membership_writes:
+                if w.result() is not None:
+                    report['memberships_added'] += 1
+
+        report['failed'] = len(errors)
+        self.reports['provision'] = report
+        if errors and raise_errors:
+            raise ValueError(" ;\n".join([key+": "+str(errors[key]) for key in errors.keys()]))
+        return report
+
     def permission_get_database(self):
         self.create_session_if_needed()
         return self.query('GET', 'permissions/graph')
 
     def permission_set_database(self, group_name, database_name, schema_data, native_sql):
-        if group_name == 'all':
-            group_id = '1'
-        else:
-            group_id = self.group_name2id(group_name)
-        if not group_id:
-            raise ValueError("group "+group_name+" not found")
-        database_id = self.database_name2id(database_name)
-        if not database_id:
-            raise ValueError("database "+database_name+" not found")
-        data = self.permission_get_database()
-        if not data['groups'].get(group_id):
-            data['groups'][group_id] = {}
-        data['groups'][group_id][database_id] = {}
-        if native_sql:
-            data['groups'][group_id][database_id]['native'] = 'write'
-            if schema_data:
-                data['groups'][group_id][database_id]['schemas'] = 'all'
-            else:
-                data['groups'][group_id][database_id].pop('schemas', None)
-        else:
-            data['groups'][group_id][database_id]['native'] = 'none'
-            data['groups'][group_id][database_id]['schemas'] = 'none'
-        return self.query('PUT', 'permissions/graph', data)
+        with self.permissions_batch() as batch:
+            batch.set_database(group_name, database_name, schema_data, native_sql)
+        return batch.results['database']
 
     def permission_get_collection(self):
         self.create_session_if_needed()
         return self.query('GET', 'collection/graph')
 
     def permission_set_collection(self, group_name, collection_name, right):
-        if not right in ['read', 'write', 'none']:
-            raise ValueError('right not read/write/none')
-        if group_name == 'all':
-            group_id = '1'
+        with self.permissions_batch() as batch:
+            batch.set_collection(group_name, collection_name, right)
+        return batch.results['collection']
+
+    def permissions_batch(self, retries=3):
+        return PermissionsBatch(self, retries)
+
+_export_worker_api = None
+
+def _export_worker_init(apiurl, state):
+    global _export_worker_api
+    _export_worker_api = MetabaseApi(apiurl, None, None)
+    _export_worker_api.restore_conversion_state(state)
+
+def _export_worker_convert(database_name, prefix, obj):
+    # The conversion timings travel back with the export to the parent's profile
+    export = _export_worker_api.export_object(database_name, prefix, obj)
+    return [export, _export_worker_api.profile.take_phases()]
+
+def script_options(flags = (), options = {}):
+    # The options shared by the scripts are taken out of sys.argv, leaving the positional
+    # arguments: a flag is True when given, an option converts the argument that follows it
+    flags = ['--profile'] + list(flags)
+    options = dict(options)
+    options['--profile-json'] = str
+    res = {}
+    for flag in flags:
+        res[flag[2:].replace('-', '_')] = False
+    for option in options.keys():
+        res[option[2:].replace('-', '_')] = None
+    i = 1
+    while i < len(sys.argv):
+        arg = sys.argv[i]
+        if arg in flags:
+            res[arg[2:].replace('-', '_')] = True
+            del sys.argv[i]
+        elif arg in options:
+            if i + 1 >= len(sys.argv):
+                sys.exit(arg+' expects a value')
+            try:
+                res[arg[2:].replace('-', '_')] = options[arg](sys.argv[i+1])
+            except ValueError:
+                sys.exit(arg+': invalid value '+sys.argv[i+1])
+            del sys.argv[i:i+2]
+        elif arg.startswith('--'):
+            sys.exit('unknown option '+arg)
         else:
-            group_id = self.group_name2id(group_name)
-        if not group_id:
-            raise ValueError("group "+group_name+" not found")
-        if collection_name == 'root':
-            collection_id = 'root'
-        else:
-            collection_id = self.collection_name2id(collection_name)
-        if not collection_id:
-            raise ValueError("collection "+collection_name+" not found")
-        data = self.permission_get_collection()
-        if not data['groups'].get(group_id):
-            data['groups'][group_id] = {}
-        data['groups'][group_id][collection_id] = right
-        return self.query('PUT', 'collection/graph', data)
+            i += 1
+    if res['profile_json']:
+        res['profile'] = True
+    return res
+
+def print_profile_at_exit(api, opts):
+    if not opts['profile']:
+        return
+
+    def print_profile():
+        print(api.profile.table())
+        if opts['profile_json']:
+            api.profile.dump(opts['profile_json'])
+    atexit.register(print_profile)
@@ -0,0 +1,477 @@
+import asyncio
+import copy
+import json
+import time
+import aiohttp
+import metabase
+
+class AsyncMetabaseTransport:
+    # The policy of metabase.MetabaseTransport: the idempotent verbs are retried on a bad gateway
+    # or a lost connection, reads and writes have their own AIMD limiter, and the aiohttp errors
+    # are raised as ConnectionError like the requests ones
+    def __init__(self, pool_size=100, max_in_flight=32, connect_timeout=10, read_timeout=300, retries=3, backoff_factor=0.5, max_reads=None, max_writes=None):
+        self.pool_size = pool_size
+        self.max_in_flight = max_in_flight
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.limiters = {
+                            'read': metabase.AdaptiveLimiter(max_reads or max_in_flight),
+                            'write': metabase.AdaptiveLimiter(max_writes or max(1, max_in_flight // 2))
+                        }
+        self.session = None
+        self.semaphore = None
+        self.condition = None
+
+    async def request(self, method, url, data=None, headers=None):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size), timeout=self.timeout)
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.condition = asyncio.Condition()
+        limiter = self.limiters['read' if method == 'GET' else 'write']
+        endpoint = metabase.endpoint_template(method, url)
+        attempt = 0
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(limiter.try_acquire)
+            start = time.perf_counter()
+            status = None
+            error = None
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, data=data, headers=headers) as r:
+                        text = await r.text()
+                        status = r.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                limiter.release(time.perf_counter() - start, status is None or status >= 500, endpoint)
+                async with self.condition:
+                    self.condition.notify_all()
+            retry = status is None or status in metabase.MetabaseTransport.RETRY_STATUSES
+            if retry and method in metabase.MetabaseTransport.RETRY_METHODS and attempt < self.retries:
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+                continue
+            if error is not None:
+                raise ConnectionError(url+" ("+method+"): "+(str(error) or type(error).__name__))
+            return text
+
+    def concurrency(self):
+        return {'read': self.limiters['read'].level(), 'write': self.limiters['write'].level()}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+class PreloadedMetabaseApi(metabase.MetabaseApi):
+    # Holds the state AsyncMetabaseApi loads, so that the conversions it runs
+    # on the event loop find every lookup in memory
+    def __init__(self, apiurl, username, password, debug=False, concurrency=8):
+        super().__init__(apiurl, username, password, debug, concurrency=concurrency)
+
+    def database_name2id(self, database_name):
+        return self.database_registry.database_name2id(database_name)
+
+class AsyncMetabaseApi:
+    def __init__(self, apiurl, username, password, debug=False, transport=None, concurrency=8):
+        self.apiurl = apiurl
+        self.username = username
+        self.password = password
+        self.debug = debug
+        self.transport = transport
+        if self.transport is None:
+            self.transport = AsyncMetabaseTransport()
+        self.api = PreloadedMetabaseApi(apiurl, username, password, debug, concurrency)
+        self.session_lock = asyncio.Lock()
+        self.databases_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        await self.transport.close()
+
+    @property
+    def reports(self):
+        return self.api.reports
+
+    @property
+    def profile(self):
+        return self.api.profile
+
+    async def query(self, method, query_name, json_data = None):
+        json_str = None
+        if json_data is not None:
+            json_str = json.dumps(json_data)
+
+        headers =  { "Content-Type": "application/json;charset=utf-8" }
+
+        if self.api.metabase_session is not None:
+            headers["X-Metabase-Session"] = self.api.metabase_session
+
+        query_url = self.apiurl+query_name
+
+        if (self.debug):
+            print(method+' '+query_url)
+            print(headers)
+            print(json_str)
+
+        if method not in ['GET', 'POST', 'PUT', 'DELETE']:
+            raise ConnectionError('unkown method: '+method+' (GET,POST,PUT,DELETE allowed)')
+
+        start = time.perf_counter()
+        try:
+            text = await self.transport.request(method, query_url, json_str, headers)
+        except Exception:
+            self.api.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), 0, True)
+            raise
+        self.api.profile.record_request(method, query_name, time.perf_counter() - start, len(json_str or ''), len(text.encode('utf-8')))
+        self.api.profile.record_concurrency(self.transport.concurrency())
+        return self.api.parse_response(method, query_url, text)
+
+    async def create_session(self):
+        json_response = await self.query('POST', 'session', {"username": self.username, "password": self.password})
+        try:
+            self.api.metabase_session = json_response["id"]
+        except KeyError:
+            if json_response.get('errors'):
+                raise ConnectionError(json_response['errors'])
+            raise ConnectionError("ERROR: enable to connect: " + str(json_response))
+
+    async def create_session_if_needed(self):
+        async with self.session_lock:
+            if self.api.metabase_session:
+                return
+            await self.create_session()
+
+    async def get_databases(self, full_info=False):
+        if not full_info:
+            return (await self.load_databases()).all()
+        await self.create_session_if_needed()
+        databases = await self.query('GET', 'database?include=tables')
+        if not isinstance(databases, list):
+            databases = databases['data']
+        return databases
+
+    async def load_databases(self):
+        async with self.databases_lock:
+            if not self.api.database_registry.is_loaded():
+                await self.create_session_if_needed()
+                databases = await self.query('GET', 'database')
+                if not isinstance(databases, list):
+                    databases = databases['data']
+                self.api.database_registry.load(databases)
+        return self.api.database_registry
+
+    async def database_name2id(self, database_name):
+        return (await self.load_databases()).database_name2id(database_name)
+
+    async def get_database(self, name, full_info=False, check_if_exists=True):
+        registry = await self.load_databases()
+        data = registry.get(name)
+        if not data and not check_if_exists:
+            return {}
+        if not data:
+            raise ValueError("Database \"" + name + "\" does not exist. Existing databases are: " + ', '.join(registry.names()))
+        if not full_info:
+            return data
+        return await self.query('GET', 'database/'+str(data['id'])+'?include=tables.fields')
+
+    async def load_schema(self, database_name):
+        if not self.api.schema_index.has_schema():
+            self.api.database_export = await self.get_database(database_name, True)
+            self.api.schema_index.load_database(self.api.database_export)
+        return self.api.schema_index
+
+    async def load_objects(self, database_name, kind):
+        if not self.api.schema_index.has_objects(kind):
+            if kind == 'card':
+                self.api.schema_index.load_objects(kind, await self.get_cards(database_name))
+            elif kind == 'metric':
+                self.api.schema_index.load_objects(kind, await self.get_metrics(database_name))
+            else:
+                raise ValueError('unknown object kind '+kind)
+        return self.api.schema_index
+
+    async def get_snippets(self, database_name):
+        await self.database_name2id(database_name)
+        return await self.query('GET', 'native-query-snippet')
+
+    async def get_cards(self, database_name):
+        database_id = await self.database_name2id(database_name)
+        return await self.query('GET', 'card?f=database&model_id='+str(database_id))
+
+    async def get_metrics(self, database_name):
+        database_id = await self.database_name2id(database_name)
+        metrics = []
+        for m in await self.query('GET', 'metric'):
+            if m['database_id'] == database_id:
+                metrics.append(m)
+        return metrics
+
+    async def get_collections(self):
+        await self.create_session_if_needed()
+        return await self.query('GET', 'collection')
+
+    async def hydrate_dashboards(self, database_id=None):
+        cache = self.api.dashboard_cache
+        if not cache.is_fresh(database_id):
+            cache.take_marks()
+            await self.create_session_if_needed()
+            dashboards_light = await self.query('GET', 'dashboard')
+            dashboards = await asyncio.gather(*[self.query('GET', 'dashboard/'+str(d['id'])) for d in dashboards_light])
+            cache.load([[self.api.dashboard_database_key(d), d] for d in dashboards])
+        return cache
+
+    async def get_dashboards(self, database_name):
+        database_id = await self.database_name2id(database_name)
+        return copy.deepcopy((await self.hydrate_dashboards(database_id)).of_database(database_id))
+
+    async def get_dashboard(self, database_name, dashboard_name):
+        dashboard_id = await self.dashboard_name2id(database_name, dashboard_name)
+        return await self.query('GET', 'dashboard/'+str(dashboard_id))
+
+    async def dashboard_name2id(self, database_name, dashboard_name):
+        if self.api.dashboards_name2id is None:
+            await self.hydrate_dashboards(await self.database_name2id(database_name))
+        return self.api.dashboard_name2id(database_name, dashboard_name)
+
+    async def snippet_name2id(self, database_name, snippet_name):
+        if self.api.snippets_name2id is None:
+            snippets_name2id = {}
+            for s in await self.get_snippets(database_name):
+                snippets_name2id[s['name']] = s['id']
+            self.api.snippets_name2id = snippets_name2id
+        return self.api.snippets_name2id.get(snippet_name)
+
+    async def collection_name2id(self, collection_name):
+        if not self.api.collections_name2id:
+            for c in await self.get_collections():
+                self.api.collections_name2id[c['name']] = c['id']
+        return self.api.collections_name2id.get(collection_name)
+
+    async def collection_name2id_or_create_it(self, collection_name):
+        cid = await self.collection_name2id(collection_name)
+        if cid:
+            return cid
+        await self.create_collection(collection_name)
+        return await self.collection_name2id(collection_name)
+
+    async def create_collection(self, collection_name, parent_collection_name = None, param_args = {}):
+        await self.create_session_if_needed()
+        param = param_args.copy()
+        param['name'] = collection_name
+        if parent_collection_name:
+            parent_id = await self.collection_name2id_or_create_it(parent_collection_name)
+            if parent_id:
+                param['parent_id'] = parent_id
+        if not param.get('color'):
+            param['color'] = '#509ee3'
+        cid = await self.collection_name2id(collection_name)
+        if cid:
+            res = await self.query('PUT', 'collection/'+str(cid), param)
+        else:
+            res = await self.query('POST', 'collection', param)
+        self.api.collections_name2id.clear()
+        return res
+
+    async def preload(self, database_name, collection_names = ()):
+        await self.load_databases()
+        await asyncio.gather(
+                                self.load_schema(database_name),
+                                self.load_objects(database_name, 'card'),
+                                self.load_objects(database_name, 'metric'),
+                                self.snippet_name2id(database_name, None),
+                                self.dashboard_name2id(database_name, None)
+                            )
+        for c in collection_names:
+            if c:
+                await self.collection_name2id_or_create_it(c)
+
+    async def fetch_remote_objects(self, database_name):
+        await self.load_databases()
+        await self.load_schema(database_name)
+        [cards, dashboards, metrics, snippets] = await asyncio.gather(
+                                self.get_cards(database_name),
+                                self.get_dashboards(database_name),
+                                self.get_metrics(database_name),
+                                self.get_snippets(database_name)
+                            )
+        objects = {'card': cards, 'dashboard': dashboards, 'metric': metrics, 'snippet': snippets}
+        return self.api.seed_remote_objects(database_name, objects)
+
+    async def load_remote_state(self, database_name):
+        return self.api.build_remote_state(database_name, await self.fetch_remote_objects(database_name))
+
+    async def export_all_to_json(self, database_name, dirname, jobs=None, incremental=False, compress=False):
+        exports = await self.fetch_remote_objects(database_name)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.api.write_exports, database_name, dirname, exports, jobs, incremental, compress)
+
+    async def export_cards_to_json(self, database_name, dirname):
+        await self.load_schema(database_name)
+        await self.load_objects(database_name, 'metric')
+        await self.dashboard_name2id(database_name, None)
+        export = await self.get_cards(database_name)
+        self.api.schema_index.load_objects('card', export)
+        self.api.write_object_exports(database_name, dirname, 'card_', export)
+
+    async def export_dashboards_to_json(self, database_name, dirname):
+        await self.load_schema(database_name)
+        await self.load_objects(database_name, 'card')
+        await self.load_objects(database_name, 'metric')
+        export = await self.get_dashboards(database_name)
+        self.api.write_object_exports(database_name, dirname, 'dashboard_', [dash for dash in export if len(dash['ordered_cards'])])
+
+    async def export_metrics_to_json(self, database_name, dirname):
+        await self.load_schema(database_name)
+        await self.load_objects(database_name, 'card')
+        export = await self.get_metrics(database_name)
+        self.api.schema_index.load_objects('metric', export)
+        self.api.write_object_exports(database_name, dirname, 'metric_', export)
+
+    async def export_snippet_to_json(self, database_name, dirname):
+        await self.load_schema(database_name)
+        await self.load_objects(database_name, 'card')
+        await self.load_objects(database_name, 'metric')
+        self.api.write_object_exports(database_name, dirname, 'snippet_', await self.get_snippets(database_name))
+
+    async def export_fields_to_csv(self, database_name, dirname, incremental=False, compress=False):
+        self.api.database_export = await self.get_database(database_name, True)
+        self.api.schema_index.load_database(self.api.database_export)
+        export = self.api.fields_export_rows(database_name)
+        if not export:
+            return False
+        return self.api.write_fields_csv(dirname, export, incremental, compress)
+
+    async def import_fields_from_csv(self, database_name, dirname):
+        return await self.update_fields(database_name, self.api.read_fields_csv(dirname))
+
+    async def update_fields(self, database_name, fields):
+        await self.load_schema(database_name)
+        tables = self.api.fields_to_update(database_name, fields)
+
+        async def update_table(datas):
+            output = []
+            for data in datas:
+                res = await self.run_steps(self.api.put_field_steps(data))
+                if res is not None:
+                    output.append(res)
+            return output
+
+        output = []
+        for res in await asyncio.gather(*[update_table(datas) for datas in tables.values()]):
+            output += res
+        return output
+
+    async def run_steps(self, steps):
+        # the same writes as metabase.MetabaseApi.run_steps, their requests awaited on the event loop
+        response = None
+        error = None
+        while True:
+            try:
+                if error is not None:
+                    request = steps.throw(error)
+                else:
+                    request = steps.send(response)
+            except StopIteration as e:
+                return e.value
+            response = None
+            error = None
+            try:
+                response = await self.query(*request)
+            except ConnectionError as e:
+                error = e
+
+    # The name caches the steps read are loaded first, the steps only do the writes
+
+    async def card_import(self, database_name, card_from_json):
+        await self.load_objects(database_name, 'card')
+        return await self.run_steps(self.api.card_import_steps(database_name, card_from_json))
+
+    async def metric_import(self, database_name, metric_from_json):
+        await self.load_objects(database_name, 'metric')
+        return await self.run_steps(self.api.metric_import_steps(database_name, metric_from_json))
+
+    async def snippet_import(self, database_name, snippet_from_json):
+        await self.snippet_name2id(database_name, None)
+        return await self.run_steps(self.api.snippet_import_steps(database_name, snippet_from_json))
+
+    async def dashboard_import(self, database_name, dash_from_json):
+        await self.dashboard_name2id(database_name, None)
+        return await self.run_steps(self.api.dashboard_import_steps(database_name, dash_from_json))
+
+    async def import_object(self, database_name, kind, obj, collection_name = None):
+        return await self.run_steps(self.api.import_object_steps(database_name, kind, obj, collection_name))
+
+    async def import_objects_from_json(self, database_name, dirname, kind, collection_name = None):
+        [entries, refs] = self.api.scan_import(dirname, [kind])
+        await self.preload(database_name, [collection_name])
+        self.api.check_references(database_name, entries, refs)
+        sources = metabase.ImportSources(self.api, entries)
+        res = []
+        errors = None
+        for entry in entries:
+            obj = sources.load(entry)
+            try:
+                res.append(await self.import_object(database_name, kind, obj, collection_name))
+            except ValueError as e:
+                if not errors:
+                    errors = ValueError(obj['name']+": "+ str(e))
+                else:
+                    errors = ValueError(obj['name']+": "+str(errors) + " ;\n" + str(e))
+        if errors:
+            raise errors
+        return res
+
+    async def import_metrics_from_json(self, database_name, dirname, collection_name = None):
+        return await self.import_objects_from_json(database_name, dirname, 'metric')
+
+    async def import_snippets_from_json(self, database_name, dirname, collection_name = None):
+        return await self.import_objects_from_json(database_name, dirname, 'snippet', collection_name)
+
+    async def import_cards_from_json(self, database_name, dirname, collection_name = None):
+        return await self.import_objects_from_json(database_name, dirname, 'card', collection_name)
+
+    async def import_dashboards_from_json(self, database_name, dirname, collection_name = None):
+        return await self.import_objects_from_json(database_name, dirname, 'dashboard', collection_name)
+
+    async def import_all_from_json(self, database_name, dirname, collection_name = None, cards_collection_name = None, incremental = False):
+        collections = self.api.import_collections(collection_name, cards_collection_name)
+        [entries, refs] = self.api.scan_import(dirname)
+        await self.preload(database_name, set(collections.values()))
+        # the preload holds every table with its fields, the references are checked in memory
+        self.api.check_references(database_name, entries, refs)
+        self.api.remote_state = None
+        if incremental:
+            await self.load_remote_state(database_name)
+
+        scheduler = self.api.import_scheduler(dirname, None, lambda kind, obj: self.import_object(database_name, kind, obj, collections[kind]), entries)
+        [waiting, dependents] = scheduler.graph()
+        tasks = {}
+        async def run(key):
+            for dep in waiting[key]:
+                try:
+                    await tasks[dep]
+                except Exception:
+                    raise ValueError('depends on '+dep[0]+' '+dep[1]+' which failed')
+            return await scheduler.tasks[key][0]()
+        for key in scheduler.order:
+            tasks[key] = asyncio.ensure_future(run(key))
+        try:
+            outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        finally:
+            self.api.remote_state = None
+        results = {}
+        errors = {}
+        for [key, outcome] in zip(tasks.keys(), outcomes):
+            if isinstance(outcome, Exception):
+                errors[key] = outcome
+            else:
+                results[key] = outcome
+        return self.api.import_results(results, errors)
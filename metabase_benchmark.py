@@ -0,0 +1,105 @@
+import json
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import metabase
+import metabase_fake_server
+
+SIZES = {
+    'small': {'tables': 10, 'fields': 10, 'cards': 20, 'dashboards': 5, 'cards_per_dashboard': 4, 'metrics': 2, 'snippets': 2},
+    'medium': {'tables': 100, 'fields': 20, 'cards': 200, 'dashboards': 40, 'cards_per_dashboard': 8, 'metrics': 10, 'snippets': 10},
+    'large': {'tables': 600, 'fields': 25, 'cards': 1500, 'dashboards': 200, 'cards_per_dashboard': 10, 'metrics': 50, 'snippets': 50},
+}
+
+STEPS = [
+    'export_fields_to_csv', 'export_cards_to_json', 'export_dashboards_to_json', 'export_metrics_to_json', 'export_snippet_to_json',
+    'import_fields_from_csv', 'import_metrics_from_json', 'import_snippets_from_json', 'import_cards_from_json', 'import_dashboards_from_json',
+    'export_all_to_json', 'import_all_from_json',
+]
+
+def measure(server, function, *args):
+    server.reset_counts()
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(*args)
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'requests': server.request_count(), 'wall': wall, 'peak_memory': peak}
+
+def run_size(size, latency=0):
+    # import_cards_from_json imports the cards in directory order, so the seeded
+    # cards do not use other cards as source
+    fake = metabase_fake_server.FakeMetabase()
+    fake.seed('bench', nested_cards=False, **SIZES[size])
+    fake.seed('bench_copy', with_objects=False, **SIZES[size])
+    fake.seed('bench_all', with_objects=False, **SIZES[size])
+    results = {}
+    exportdir = tempfile.mkdtemp()
+    alldir = tempfile.mkdtemp()
+    try:
+        with metabase_fake_server.FakeMetabaseServer(fake, latency=latency) as server:
+            # The export runs against the seeded database, the import into its empty copy
+            source = metabase.MetabaseApi(server.apiurl(), 'bench@example.org', 'bench')
+            target = metabase.MetabaseApi(server.apiurl(), 'bench@example.org', 'bench')
+            source.create_session()
+            target.create_session()
+            for step in STEPS:
+                # the export and the import of everything start with empty caches, and have
+                # their own directory and their own empty copy
+                if step in ['export_all_to_json', 'import_all_from_json']:
+                    api = metabase.MetabaseApi(server.apiurl(), 'bench@example.org', 'bench')
+                    api.create_session()
+                if step == 'export_all_to_json':
+                    results[step] = measure(server, api.export_all_to_json, 'bench', alldir)
+                elif step == 'import_all_from_json':
+                    results[step] = measure(server, api.import_all_from_json, 'bench_all', alldir, 'bench_all')
+                elif step.startswith('export'):
+                    results[step] = measure(server, getattr(source, step), 'bench', exportdir)
+                elif step in ['import_fields_from_csv', 'import_metrics_from_json']:
+                    results[step] = measure(server, getattr(target, step), 'bench_copy', exportdir)
+                else:
+                    results[step] = measure(server, getattr(target, step), 'bench_copy', exportdir, 'bench_copy')
+    finally:
+        shutil.rmtree(exportdir)
+        shutil.rmtree(alldir)
+    return results
+
+def print_results(results, baseline=None):
+    print("%-8s %-28s %9s %10s %12s" % ('size', 'step', 'requests', 'wall (s)', 'peak (KiB)'))
+    for size in results.keys():
+        for step in results[size].keys():
+            r = results[size][step]
+            line = "%-8s %-28s %9d %10.3f %12d" % (size, step, r['requests'], r['wall'], r['peak_memory'] // 1024)
+            b = (baseline or {}).get(size, {}).get(step)
+            if b:
+                line += "   requests %+d, wall %+.1f%%, peak %+.1f%%" % (
+                            r['requests'] - b['requests'],
+                            (r['wall'] - b['wall']) * 100 / max(b['wall'], 1e-9),
+                            (r['peak_memory'] - b['peak_memory']) * 100 / max(b['peak_memory'], 1)
+                        )
+            print(line)
+
+if __name__ == '__main__':
+    opts = metabase.script_options((), {'--sizes': lambda v: v.split(','), '--latency': float, '--save': str, '--compare': str})
+    if len(sys.argv) != 1:
+        print("usage: metabase_benchmark.py [--sizes small,medium,large] [--latency seconds] [--save results.json] [--compare baseline.json]")
+        sys.exit(1)
+    sizes = opts['sizes'] or ['small', 'medium']
+    latency = opts['latency'] or 0
+    save = opts['save']
+    compare = opts['compare']
+
+    results = {}
+    for size in sizes:
+        results[size] = run_size(size, latency)
+    baseline = None
+    if compare:
+        with open(compare) as jsonfile:
+            baseline = json.load(jsonfile)
+    print_results(results, baseline)
+    if save:
+        with open(save, 'w') as jsonfile:
+            jsonfile.write(json.dumps(results, indent=2, sort_keys=True))
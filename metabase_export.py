@@ -2,21 +2,30 @@ import metabase
 import sys
 import os
 
+opts = metabase.script_options(['--incremental', '--compress', '--stream'], {'--jobs': int})
+
 metabase_apiurl = sys.argv[1]
 metabase_username = sys.argv[2]
 metabase_password = sys.argv[3]
 metabase_base = sys.argv[4]
 metabase_exportdir = sys.argv[5]
 
-ametabase = metabase.MetabaseApi(metabase_apiurl, metabase_username, metabase_password)
+ametabase = metabase.MetabaseApi(metabase_apiurl, metabase_username, metabase_password, stream_responses=opts['stream'])
 #ametabase.debug = True
 
+metabase.print_profile_at_exit(ametabase, opts)
+
 try:
     os.mkdir("export")
 except:
     None
 
-ametabase.export_fields_to_csv(metabase_base, metabase_exportdir)
-ametabase.export_cards_to_json(metabase_base, metabase_exportdir)
-ametabase.export_dashboards_to_json(metabase_base, metabase_exportdir)
-ametabase.export_metrics_to_json(metabase_base, metabase_exportdir)
+fields_written = ametabase.export_fields_to_csv(metabase_base, metabase_exportdir, opts['incremental'], opts['compress'])
+report = ametabase.export_all_to_json(metabase_base, metabase_exportdir, opts['jobs'], opts['incremental'], opts['compress'])
+if fields_written:
+    report['written'] += 1
+else:
+    report['skipped'] += 1
+print("files: %d written, %d skipped, %d deleted" % (report['written'], report['skipped'], report['deleted']))
+
+print(ametabase.transport.summary())
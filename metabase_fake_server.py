@@ -0,0 +1,458 @@
+import copy
+import datetime
+import gzip
+import http.server
+import json
+import metabase
+import threading
+import time
+import urllib.parse
+import uuid
+
+class FakeMetabase:
+    # legacy_dashcards: PUT dashboard/:id/cards as before Metabase 0.47, it only moves the
+    # existing cards and answers {"status": "ok"}
+    def __init__(self, legacy_dashcards=False):
+        self.lock = threading.Lock()
+        self.legacy_dashcards = legacy_dashcards
+        self.next_ids = {}
+        self.databases = {}
+        self.tables = {}
+        self.fields = {}
+        self.cards = {}
+        self.dashboards = {}
+        self.dashcards = {}
+        self.metrics = {}
+        self.snippets = {}
+        self.collections = {}
+        self.users = {}
+        self.groups = {}
+        self.memberships = {}
+        self.sessions = set()
+        self.permissions_graph = {'revision': 1, 'groups': {}}
+        self.collections_graph = {'revision': 1, 'groups': {}}
+        self.create_group('All Users')
+        self.create_group('Administrators')
+
+    def new_id(self, kind):
+        self.next_ids[kind] = self.next_ids.get(kind, 0) + 1
+        return self.next_ids[kind]
+
+    def now(self):
+        return datetime.datetime.now().isoformat()
+
+    def create_group(self, name):
+        group = {'id': self.new_id('group'), 'name': name, 'member_count': 0}
+        self.groups[group['id']] = group
+        return group
+
+    def create_database(self, name, engine='sqlite', details=None):
+        database = {'id': self.new_id('database'), 'name': name, 'engine': engine, 'details': details or {}, 'is_full_sync': True}
+        self.databases[database['id']] = database
+        return database
+
+    def create_table(self, database_id, name):
+        table = {'id': self.new_id('table'), 'db_id': database_id, 'name': name, 'display_name': name, 'schema': 'main', 'active': True}
+        self.tables[table['id']] = table
+        return table
+
+    def create_field(self, table_id, name, fk_target_field_id=None):
+        field = {
+                    'id': self.new_id('field'), 'table_id': table_id, 'name': name, 'display_name': name, 'description': None,
+                    'semantic_type': 'type/FK' if fk_target_field_id else None, 'fk_target_field_id': fk_target_field_id,
+                    'visibility_type': 'normal', 'has_field_values': 'list', 'custom_position': 0,
+                    'effective_type': 'type/Text', 'base_type': 'type/Text', 'database_type': 'TEXT'
+                }
+        self.fields[field['id']] = field
+        return field
+
+    def create_object(self, store, kind, data):
+        obj = copy.deepcopy(data)
+        obj.pop('revision_message', None)
+        obj['id'] = self.new_id(kind)
+        obj['created_at'] = self.now()
+        obj['updated_at'] = obj['created_at']
+        obj['creator_id'] = 1
+        self.fingerprint(obj)
+        store[obj['id']] = obj
+        return obj
+
+    def update_object(self, obj, data):
+        for k in data.keys():
+            # the revision message goes to the revision history, not to the object
+            if k not in ['id', 'revision_message']:
+                obj[k] = copy.deepcopy(data[k])
+        obj['updated_at'] = self.now()
+        self.fingerprint(obj)
+        return obj
+
+    def fingerprint(self, obj):
+        # Metabase computes the fingerprints of the result metadata when a card is saved
+        for column in obj.get('result_metadata') or []:
+            column.setdefault('fingerprint', {'global': {'distinct-count': 1}})
+
+    def seed(self, database_name='bench', tables=10, fields=10, cards=20, dashboards=5, cards_per_dashboard=4, metrics=2, snippets=2, with_objects=True, nested_cards=True):
+        database = self.create_database(database_name)
+        table_ids = []
+        field_ids = {}
+        for t in range(tables):
+            table = self.create_table(database['id'], 'table_'+str(t))
+            table_ids.append(table['id'])
+            field_ids[table['id']] = []
+            for f in range(fields):
+                fk = None
+                if f == fields - 1 and t > 0:
+                    fk = field_ids[table_ids[0]][0]
+                field_ids[table['id']].append(self.create_field(table['id'], 'field_'+str(f), fk)['id'])
+        if not with_objects:
+            return database
+        collection = self.create_object(self.collections, 'collection', {'name': database_name, 'color': '#509ee3', 'parent_id': None})
+        metric_ids = []
+        for m in range(metrics):
+            table_id = table_ids[m % len(table_ids)]
+            metric_ids.append(self.create_object(self.metrics, 'metric', {
+                                    'name': database_name+' metric '+str(m), 'description': None, 'database_id': database['id'], 'table_id': table_id,
+                                    'definition': {'source-table': table_id, 'aggregation': [['count']], 'filter': ['not-null', ['field', field_ids[table_id][0], None]]}
+                                })['id'])
+        for s in range(snippets):
+            self.create_object(self.snippets, 'snippet', {'name': database_name+' snippet '+str(s), 'description': None, 'content': 'field_0 IS NOT NULL', 'collection_id': None})
+        card_ids = []
+        for c in range(cards):
+            table_id = table_ids[c % len(table_ids)]
+            fid = field_ids[table_id][c % len(field_ids[table_id])]
+            source = table_id
+            if nested_cards and c % 5 == 4 and card_ids:
+                source = 'card__'+str(card_ids[0])
+            aggregation = [['count']]
+            if metric_ids and c % 3 == 0:
+                aggregation = [['metric', metric_ids[c % len(metric_ids)]]]
+            card_ids.append(self.create_object(self.cards, 'card', {
+                                    'name': database_name+' card '+str(c), 'description': None, 'display': 'table',
+                                    'database_id': database['id'], 'table_id': table_id, 'collection_id': collection['id'], 'query_type': 'query',
+                                    'dataset_query': {'database': database['id'], 'type': 'query', 'query': {'source-table': source, 'filter': ['=', ['field', fid, None], 'value'], 'aggregation': aggregation}},
+                                    'visualization_settings': {'column_settings': {json.dumps(['ref', ['field', fid, None]]): {'column_title': 'title'}}},
+                                    'result_metadata': [{'id': fid, 'name': 'field', 'field_ref': ['field', fid, None], 'fingerprint': {'global': {'distinct-count': 1}}}]
+                                })['id'])
+        for d in range(dashboards):
+            dash = self.create_object(self.dashboards, 'dashboard', {'name': database_name+' dashboard '+str(d), 'description': None, 'collection_id': collection['id'], 'parameters': []})
+            for i in range(cards_per_dashboard):
+                if not card_ids:
+                    break
+                card_id = card_ids[(d * cards_per_dashboard + i) % len(card_ids)]
+                self.create_dashcard(dash['id'], {'cardId': card_id, 'row': i * 4, 'col': 0, 'sizeX': 4, 'sizeY': 4, 'parameter_mappings': [], 'visualization_settings': {}, 'series': []})
+        return database
+
+    def create_dashcard(self, dashboard_id, data):
+        dashcard = copy.deepcopy(data)
+        dashcard['card_id'] = dashcard.pop('cardId', dashcard.get('card_id'))
+        dashcard['id'] = self.new_id('dashcard')
+        dashcard['dashboard_id'] = dashboard_id
+        dashcard['created_at'] = self.now()
+        dashcard['updated_at'] = dashcard['created_at']
+        self.dashcards[dashcard['id']] = dashcard
+        return dashcard
+
+    def database_payload(self, database, include):
+        data = copy.deepcopy(database)
+        if include:
+            data['tables'] = []
+            for table in self.tables.values():
+                if table['db_id'] != database['id']:
+                    continue
+                t = copy.deepcopy(table)
+                if include == 'tables.fields':
+                    t['fields'] = [copy.deepcopy(f) for f in self.fields.values() if f['table_id'] == table['id']]
+                data['tables'].append(t)
+        return data
+
+    def dashboard_payload(self, dash):
+        data = copy.deepcopy(dash)
+        data['ordered_cards'] = []
+        for dashcard in self.dashcards.values():
+            if dashcard['dashboard_id'] != dash['id']:
+                continue
+            c = copy.deepcopy(dashcard)
+            c['card'] = copy.deepcopy(self.cards.get(dashcard['card_id'], {}))
+            data['ordered_cards'].append(c)
+        return data
+
+    def graph_update(self, graph, data):
+        if data.get('revision') != graph['revision']:
+            return [409, "Looks like someone else edited the permissions and your data is out of date. Please fetch new data and try again."]
+        for group_id in data.get('groups', {}).keys():
+            current = graph['groups'].setdefault(str(group_id), {})
+            for k in data['groups'][group_id].keys():
+                current[str(k)] = copy.deepcopy(data['groups'][group_id][k])
+        graph['revision'] += 1
+        return [200, copy.deepcopy(graph)]
+
+    def handle(self, method, path, params, data):
+        p = path.strip('/').split('/')
+        n = len(p)
+        def obj_or_404(store, obj_id):
+            obj = store.get(int(obj_id))
+            if obj is None:
+                return [404, "Not found."]
+            return None
+
+        if p[0] == 'session':
+            if method == 'POST':
+                token = str(uuid.uuid4())
+                self.sessions.add(token)
+                return [200, {'id': token}]
+            return [204, None]
+
+        if p[0] == 'database':
+            if n == 1 and method == 'GET':
+                return [200, {'data': [self.database_payload(d, params.get('include')) for d in self.databases.values()], 'total': len(self.databases)}]
+            if n == 1 and method == 'POST':
+                return [200, self.create_database(data['name'], data.get('engine'), data.get('details'))]
+            missing = obj_or_404(self.databases, p[1])
+            if missing:
+                return missing
+            database = self.databases[int(p[1])]
+            if n == 2 and method == 'GET':
+                return [200, self.database_payload(database, params.get('include'))]
+            if n == 2 and method == 'DELETE':
+                self.databases.pop(database['id'])
+                return [204, None]
+            if n == 3 and method == 'POST' and p[2] in ['sync_schema', 'rescan_values']:
+                return [200, {'status': 'ok'}]
+
+        if p[0] == 'table' and n == 1 and method == 'GET':
+            return [200, list(self.tables.values())]
+        if p[0] == 'table' and n == 3 and p[2] == 'query_metadata' and method == 'GET':
+            missing = obj_or_404(self.tables, p[1])
+            if missing:
+                return missing
+            table = copy.deepcopy(self.tables[int(p[1])])
+            table['fields'] = [copy.deepcopy(f) for f in self.fields.values() if f['table_id'] == table['id']]
+            return [200, table]
+
+        if p[0] == 'field' and n == 2:
+            missing = obj_or_404(self.fields, p[1])
+            if missing:
+                return missing
+            field = self.fields[int(p[1])]
+            if method == 'GET':
+                return [200, copy.deepcopy(field)]
+            if method == 'PUT':
+                for k in data.keys():
+                    if k in field and k not in ['id', 'table_id', 'name']:
+                        field[k] = data[k]
+                if data.get('fk_target_field_id'):
+                    field['fk_target_field_id'] = data['fk_target_field_id']
+                return [200, copy.deepcopy(field)]
+
+        for [prefix, store, kind] in [['card', self.cards, 'card'], ['metric', self.metrics, 'metric'], ['native-query-snippet', self.snippets, 'snippet'], ['collection', self.collections, 'collection']]:
+            if p[0] != prefix or (n == 2 and p[1] == 'graph'):
+                continue
+            if n == 1 and method == 'GET':
+                objects = list(store.values())
+                if kind == 'card' and params.get('f') == 'database':
+                    objects = [c for c in objects if str(c.get('database_id')) == params.get('model_id')]
+                return [200, copy.deepcopy(objects)]
+            if n == 1 and method == 'POST':
+                obj = self.create_object(store, kind, data)
+                if kind == 'card' and not obj.get('database_id'):
+                    obj['database_id'] = obj.get('dataset_query', {}).get('database')
+                if kind == 'metric' and not obj.get('database_id') and obj.get('table_id') in self.tables:
+                    obj['database_id'] = self.tables[obj['table_id']]['db_id']
+                return [200, copy.deepcopy(obj)]
+            missing = obj_or_404(store, p[1])
+            if missing:
+                return missing
+            if method == 'GET':
+                return [200, copy.deepcopy(store[int(p[1])])]
+            if method == 'PUT':
+                return [200, copy.deepcopy(self.update_object(store[int(p[1])], data))]
+            if method == 'DELETE':
+                store.pop(int(p[1]))
+                return [204, None]
+
+        if p[0] == 'dashboard':
+            if n == 1 and method == 'GET':
+                return [200, [{'id': d['id'], 'name': d['name'], 'collection_id': d.get('collection_id')} for d in self.dashboards.values()]]
+            if n == 1 and method == 'POST':
+                data = dict(data)
+                data.pop('ordered_cards', None)
+                return [200, copy.deepcopy(self.create_object(self.dashboards, 'dashboard', data))]
+            missing = obj_or_404(self.dashboards, p[1])
+            if missing:
+                return missing
+            dash = self.dashboards[int(p[1])]
+            if n == 2 and method == 'GET':
+                return [200, self.dashboard_payload(dash)]
+            if n == 2 and method == 'PUT':
+                data = dict(data)
+                data.pop('ordered_cards', None)
+                return [200, copy.deepcopy(self.update_object(dash, data))]
+            if n == 3 and p[2] == 'cards':
+                if method == 'POST':
+                    return [200, copy.deepcopy(self.create_dashcard(dash['id'], data))]
+                if method == 'DELETE':
+                    self.dashcards.pop(int(params.get('dashcardId')), None)
+                    return [204, None]
+                if method == 'PUT' and self.legacy_dashcards:
+                    for c in data['cards']:
+                        if c['id'] in self.dashcards and self.dashcards[c['id']]['dashboard_id'] == dash['id']:
+                            self.update_object(self.dashcards[c['id']], c)
+                    return [200, {'status': 'ok'}]
+                if method == 'PUT':
+                    kept = set()
+                    for c in data['cards']:
+                        if c['id'] < 0:
+                            kept.add(self.create_dashcard(dash['id'], c)['id'])
+                            continue
+                        if c['id'] in self.dashcards:
+                            self.update_object(self.dashcards[c['id']], c)
+                            kept.add(c['id'])
+                    for dashcard_id in list(self.dashcards.keys()):
+                        if self.dashcards[dashcard_id]['dashboard_id'] == dash['id'] and dashcard_id not in kept:
+                            self.dashcards.pop(dashcard_id)
+                    return [200, {'cards': [copy.deepcopy(self.dashcards[dashcard_id]) for dashcard_id in sorted(kept)]}]
+
+        if p[0] == 'permissions':
+            if n == 2 and p[1] == 'graph':
+                if method == 'GET':
+                    return [200, copy.deepcopy(self.permissions_graph)]
+                if method == 'PUT':
+                    return self.graph_update(self.permissions_graph, data)
+            if n == 2 and p[1] == 'group':
+                if method == 'GET':
+                    return [200, list(self.groups.values())]
+                if method == 'POST':
+                    return [200, self.create_group(data['name'])]
+            if n == 2 and p[1] == 'membership':
+                if method == 'GET':
+                    return [200, copy.deepcopy(self.memberships)]
+                if method == 'POST':
+                    membership = {'membership_id': self.new_id('membership'), 'group_id': data['group_id'], 'user_id': data['user_id']}
+                    self.memberships.setdefault(str(data['user_id']), []).append(membership)
+                    return [200, [membership]]
+
+        if p[0] == 'collection' and n == 2 and p[1] == 'graph':
+            if method == 'GET':
+                return [200, copy.deepcopy(self.collections_graph)]
+            if method == 'PUT':
+                return self.graph_update(self.collections_graph, data)
+
+        if p[0] == 'user':
+            if n == 1 and method == 'GET':
+                return [200, {'data': list(self.users.values()), 'total': len(self.users)}]
+            if n == 1 and method == 'POST':
+                user = {'id': self.new_id('user'), 'email': data['email'], 'first_name': data.get('first_name'), 'last_name': data.get('last_name'), 'is_active': True}
+                self.users[user['id']] = user
+                self.memberships.setdefault(str(user['id']), [])
+                return [200, copy.deepcopy(user)]
+            missing = obj_or_404(self.users, p[1])
+            if missing:
+                return missing
+            if n == 2 and method == 'PUT':
+                user = self.users[int(p[1])]
+                for k in ['email', 'first_name', 'last_name']:
+                    if k in data:
+                        user[k] = data[k]
+                return [200, copy.deepcopy(user)]
+            if n == 3 and p[2] == 'password' and method == 'PUT':
+                return [204, None]
+
+        return [404, "API endpoint does not exist."]
+
+class FakeMetabaseHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_method(self, method):
+        server = self.server
+        body = b''
+        if self.headers.get('Content-Length'):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if path.startswith(server.prefix):
+            path = path[len(server.prefix):]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        data = None
+        if body:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                data = json.loads(gzip.decompress(body))
+            else:
+                data = json.loads(body)
+        if server.latency:
+            time.sleep(server.latency)
+        with server.fake.lock:
+            server.count(method, path, len(body))
+            [status, payload] = server.fake.handle(method, path, params, data)
+        content = b''
+        if payload is not None:
+            content = json.dumps(payload).encode('utf-8')
+        # like Metabase, only the responses worth it are gzipped
+        gzipped = len(content) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            content = gzip.compress(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+class FakeMetabaseServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fake=None, host='127.0.0.1', port=0, latency=0, prefix='/api/'):
+        super().__init__((host, port), FakeMetabaseHandler)
+        self.fake = fake
+        if self.fake is None:
+            self.fake = FakeMetabase()
+        self.latency = latency
+        self.prefix = prefix
+        self.thread = None
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.requests = {}
+        self.request_bytes = 0
+
+    def count(self, method, path, size):
+        template = metabase.endpoint_template(method, path)
+        self.requests[template] = self.requests.get(template, 0) + 1
+        self.request_bytes += size
+
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def apiurl(self):
+        return 'http://'+self.server_address[0]+':'+str(self.server_address[1])+self.prefix
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
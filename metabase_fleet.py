@@ -0,0 +1,185 @@
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import metabase
+
+class MetabaseFleet:
+    # Runs the export or the import of many databases of one instance: each database gets
+    # its own MetabaseApi (metabase.MetabaseApi.tenant) sharing the session and the
+    # instance-wide caches, users and permissions are written in one go for the whole fleet
+    def __init__(self, api, workers=4):
+        self.api = api
+        self.workers = workers
+        self.tenants = {}
+        self.report = {}
+
+    def load_manifest(self, filename):
+        with open(filename) as jsonfile:
+            manifest = json.load(jsonfile)
+        for entry in manifest:
+            if not entry.get('database') or not entry.get('directory'):
+                raise ValueError('manifest entries need a database and a directory: '+json.dumps(entry))
+        return manifest
+
+    def tenant(self, entry):
+        if entry['database'] not in self.tenants:
+            self.tenants[entry['database']] = self.api.tenant()
+            self.report[entry['database']] = {'database': entry['database'], 'status': 'ok', 'seconds': 0.0, 'error': None}
+        return self.tenants[entry['database']]
+
+    def run_tenant(self, entry, step):
+        report = self.report[entry['database']]
+        if report['status'] != 'ok':
+            return
+        start = time.perf_counter()
+        try:
+            step(self.tenants[entry['database']], entry)
+        except Exception as e:
+            # whatever a tenant raises, a missing name or malformed data included, fails only that tenant
+            report['status'] = 'failed'
+            report['error'] = str(e) or type(e).__name__
+        report['seconds'] += time.perf_counter() - start
+
+    def run(self, manifest, step):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for f in [executor.submit(self.run_tenant, entry, step) for entry in manifest]:
+                f.result()
+
+    def fail(self, entry, error):
+        report = self.report[entry['database']]
+        if report['status'] == 'ok':
+            report['status'] = 'failed'
+            report['error'] = str(error)
+
+    def collections(self, entry):
+        collection = entry.get('collection')
+        if not collection:
+            return [None, None]
+        return [collection, entry.get('cards_collection', 'questions '+collection)]
+
+    def group(self, entry):
+        return entry.get('group', entry['database'])
+
+    def export_all(self, manifest, jobs=1, incremental=False):
+        self.api.create_session_if_needed()
+        self.api.load_databases()
+        for entry in manifest:
+            self.tenant(entry)
+
+        def export(api, entry):
+            if not entry['directory'].endswith(metabase.ExportBundle.SUFFIX):
+                os.makedirs(entry['directory'], exist_ok=True)
+            fields_written = api.export_fields_to_csv(entry['database'], entry['directory'], incremental, entry.get('compress', False))
+            files = api.export_all_to_json(entry['database'], entry['directory'], jobs, incremental, entry.get('compress', False))
+            files['written' if fields_written else 'skipped'] += 1
+            self.report[entry['database']]['files'] = files
+
+        self.run(manifest, export)
+        return self.report
+
+    def import_all(self, manifest, jobs=4, incremental=False):
+        self.api.create_session_if_needed()
+        self.api.load_databases()
+        for entry in manifest:
+            self.tenant(entry)
+
+        users = []
+        groups = []
+        memberships = []
+        for entry in manifest:
+            if entry.get('user'):
+                user = {'email': entry['user'], 'first_name': 'User', 'last_name': entry['database']}
+                if entry.get('password'):
+                    user['password'] = entry['password']
+                users.append(user)
+                groups.append(self.group(entry))
+                memberships.append([entry['user'], self.group(entry)])
+        if users:
+            failed_users = self.api.provision(users, groups, memberships, update_passwords=True, raise_errors=False)['failed_users']
+            for entry in manifest:
+                if entry.get('user') in failed_users:
+                    self.fail(entry, failed_users[entry['user']])
+
+        def create_collections(api, entry):
+            [collection, cards_collection] = self.collections(entry)
+            if collection and not api.collection_name2id(collection):
+                api.create_collection(collection)
+            if collection and not api.collection_name2id(cards_collection):
+                api.create_collection(cards_collection, collection)
+
+        self.run(manifest, create_collections)
+
+        permissions = self.api.permissions_batch()
+        for entry in manifest:
+            if not entry.get('user') or self.report[entry['database']]['status'] != 'ok':
+                continue
+            try:
+                permissions.set_database(self.group(entry), entry['database'], True, True)
+                for collection in self.collections(entry):
+                    if collection:
+                        permissions.set_collection(self.group(entry), collection, 'write')
+            except ValueError as e:
+                self.fail(entry, e)
+        try:
+            permissions.commit()
+        except ConnectionError as e:
+            for entry in manifest:
+                if entry.get('user'):
+                    self.fail(entry, e)
+
+        def import_objects(api, entry):
+            [collection, cards_collection] = self.collections(entry)
+            api.import_fields_from_csv(entry['database'], entry['directory'])
+            api.sync_scan_database(entry['database'])
+            api.import_all_from_json(entry['database'], entry['directory'], collection, cards_collection, jobs, incremental)
+
+        self.run(manifest, import_objects)
+        for database in self.tenants.keys():
+            self.report[database]['fields'] = self.tenants[database].reports.get('fields')
+            self.report[database]['import'] = self.tenants[database].reports.get('import')
+        for entry in manifest:
+            failed = (self.report[entry['database']]['fields'] or {}).get('failed')
+            if failed:
+                self.fail(entry, str(failed)+' fields not updated')
+        return self.report
+
+    def summary(self):
+        lines = ["%-30s %-7s %9s  %s" % ('database', 'status', 'time (s)', 'details')]
+        for database in self.report.keys():
+            r = self.report[database]
+            details = r['error'] or ''
+            if r['status'] == 'ok' and r.get('files'):
+                details = "files: %d written, %d skipped, %d deleted" % (r['files']['written'], r['files']['skipped'], r['files']['deleted'])
+            elif r['status'] == 'ok' and r.get('import') is not None:
+                details = "objects: %d created, %d updated, %d unchanged" % (r['import'].get('created', 0), r['import'].get('updated', 0), r['import'].get('unchanged', 0))
+            lines.append("%-30s %-7s %9.2f  %s" % (database, r['status'], r['seconds'], details))
+        return "\n".join(lines)
+
+if __name__ == '__main__':
+    opts = metabase.script_options(['--incremental'], {'--jobs': int, '--workers': int, '--report': str})
+
+    if len(sys.argv) != 6 or sys.argv[1] not in ['export', 'import']:
+        print("usage: metabase_fleet.py [--workers N] [--jobs N] [--incremental] [--report report.json] [--profile] [--profile-json profile.json] export|import metabase_apiurl username password manifest.json")
+        sys.exit(1)
+
+    mode = sys.argv[1]
+    ametabase = metabase.MetabaseApi(sys.argv[2], sys.argv[3], sys.argv[4])
+
+    metabase.print_profile_at_exit(ametabase, opts)
+
+    fleet = MetabaseFleet(ametabase, opts['workers'] or 4)
+    manifest = fleet.load_manifest(sys.argv[5])
+    if mode == 'export':
+        fleet.export_all(manifest, opts['jobs'] or 1, opts['incremental'])
+    else:
+        fleet.import_all(manifest, opts['jobs'] or 4, opts['incremental'])
+
+    print(fleet.summary())
+    print(ametabase.transport.summary())
+    if opts['report']:
+        with open(opts['report'], 'w') as jsonfile:
+            jsonfile.write(json.dumps(fleet.report, indent=2, sort_keys=True))
+    if [r for r in fleet.report.values() if r['status'] != 'ok']:
+        sys.exit(2)
@@ -1,6 +1,8 @@
 import metabase
 import sys
 
+opts = metabase.script_options(['--incremental', '--journal', '--resume'], {'--jobs': int})
+
 metabase_apiurl = sys.argv[1]
 metabase_username = sys.argv[2]
 metabase_password = sys.argv[3]
@@ -13,30 +15,33 @@ pass_to_create = sys.argv[8]
 ametabase = metabase.MetabaseApi(metabase_apiurl, metabase_username, metabase_password)
 #ametabase.debug = True
 
+metabase.print_profile_at_exit(ametabase, opts)
+
 #ametabase.delete_database('base')
 #
 ametabase.create_database(metabase_basename, 'sqlite', {'db': sqlite_database_path_to_create})
 
 user = user_to_create
-ametabase.create_user(user, metabase_basename, {'first_name': 'User', 'last_name': metabase_basename})
-ametabase.user_password(user, pass_to_create)
-ametabase.membership_add(user, metabase_basename)
-ametabase.permission_set_database(metabase_basename, metabase_basename, True, True)
+ametabase.provision([{'email': user, 'password': pass_to_create, 'first_name': 'User', 'last_name': metabase_basename}], [metabase_basename], [[user, metabase_basename]], update_passwords=True)
 
 print("fields (%s)\n" % metabase_basename)
 ametabase.import_fields_from_csv(metabase_basename, import_dir)
+report = ametabase.reports['fields']
+print("fields: %d unchanged, %d updated, %d failed, %d not found" % (report['unchanged'], report['updated'], report['failed'], report['missing']))
 
 print("collection and rights (%s)\n" % metabase_basename)
 ametabase.create_collection(metabase_basename)
 ametabase.create_collection('questions '+metabase_basename, metabase_basename)
-ametabase.permission_set_collection(metabase_basename, metabase_basename, 'write')
-ametabase.permission_set_collection(metabase_basename, 'questions '+metabase_basename, 'write')
-
-print("metrics (%s)\n" % metabase_basename)
-ametabase.import_metrics_from_json(metabase_basename, import_dir)
-print("snippets (%s)\n" % metabase_basename)
-ametabase.import_snippets_from_json(metabase_basename, import_dir, metabase_basename)
-print("cards (%s)\n" % metabase_basename)
-ametabase.import_cards_from_json(metabase_basename, import_dir, 'questions '+metabase_basename)
-print("dashboards (%s)\n" % metabase_basename)
-ametabase.import_dashboards_from_json(metabase_basename, import_dir, metabase_basename)
+with ametabase.permissions_batch() as permissions:
+    permissions.set_database(metabase_basename, metabase_basename, True, True)
+    permissions.set_collection(metabase_basename, metabase_basename, 'write')
+    permissions.set_collection(metabase_basename, 'questions '+metabase_basename, 'write')
+
+print("metrics, snippets, cards and dashboards (%s)\n" % metabase_basename)
+ametabase.import_all_from_json(metabase_basename, import_dir, metabase_basename, 'questions '+metabase_basename, opts['jobs'], opts['incremental'], opts['journal'], opts['resume'])
+report = ametabase.reports.get('import', {})
+print("objects: %d created, %d updated, %d unchanged, %d already imported" % (report.get('created', 0), report.get('updated', 0), report.get('unchanged', 0), report.get('resumed', 0)))
+
+print(ametabase.transport.summary())
+if ametabase.reports['fields']['failed']:
+    sys.exit(2)
@@ -1,6 +1,8 @@
 import metabase
 import sys
 
+opts = metabase.script_options(['--incremental', '--journal', '--resume'], {'--jobs': int, '--plan': str, '--apply': str})
+
 metabase_apiurl = sys.argv[1]
 metabase_username = sys.argv[2]
 metabase_password = sys.argv[3]
@@ -10,8 +12,36 @@ metabase_exportdir = sys.argv[5]
 ametabase = metabase.MetabaseApi(metabase_apiurl, metabase_username, metabase_password)
 #ametabase.debug = True
 
+metabase.print_profile_at_exit(ametabase, opts)
+
+if opts['plan']:
+    # nothing is written to the server, the plan is reviewed then given to --apply
+    plan = ametabase.plan_import(metabase_base, metabase_exportdir)
+    print(ametabase.plan_summary(plan))
+    ametabase.write_plan(plan, opts['plan'])
+    sys.exit(0)
+
+if opts['apply']:
+    plan = ametabase.read_plan(opts['apply'])
+    if plan['database'] != metabase_base or plan['directory'] != metabase_exportdir:
+        print("the plan "+opts['apply']+" was made for database "+plan['database']+" and directory "+plan['directory'])
+        sys.exit(1)
+    ametabase.apply_plan(plan, opts['jobs'], sync_scan=True)
+    report = ametabase.reports.get('import', {})
+    print("fields: %d updated, %d failed" % (ametabase.reports.get('fields', {}).get('updated', 0), ametabase.reports.get('fields', {}).get('failed', 0)))
+    print("objects: %d created, %d updated" % (report.get('created', 0), report.get('updated', 0)))
+    print(ametabase.transport.summary())
+    # the failed fields are reported above, the exit status tells the caller
+    sys.exit(2 if ametabase.reports.get('fields', {}).get('failed') else 0)
+
 ametabase.import_fields_from_csv(metabase_base, metabase_exportdir)
+report = ametabase.reports['fields']
+print("fields: %d unchanged, %d updated, %d failed, %d not found" % (report['unchanged'], report['updated'], report['failed'], report['missing']))
 ametabase.sync_scan_database(metabase_base)
-ametabase.import_metrics_from_json(metabase_base, metabase_exportdir)
-ametabase.import_cards_from_json(metabase_base, metabase_exportdir)
-ametabase.import_dashboards_from_json(metabase_base, metabase_exportdir)
+ametabase.import_all_from_json(metabase_base, metabase_exportdir, jobs=opts['jobs'], incremental=opts['incremental'], journal=opts['journal'], resume=opts['resume'])
+report = ametabase.reports.get('import', {})
+print("objects: %d created, %d updated, %d unchanged, %d already imported" % (report.get('created', 0), report.get('updated', 0), report.get('unchanged', 0), report.get('resumed', 0)))
+
+print(ametabase.transport.summary())
+if ametabase.reports['fields']['failed']:
+    sys.exit(2)
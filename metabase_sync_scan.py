@@ -1,6 +1,8 @@
 import metabase
 import sys
 
+opts = metabase.script_options()
+
 metabase_apiurl = sys.argv[1]
 metabase_username = sys.argv[2]
 metabase_password = sys.argv[3]
@@ -9,4 +11,8 @@ metabase_base = sys.argv[4]
 ametabase = metabase.MetabaseApi(metabase_apiurl, metabase_username, metabase_password)
 #ametabase.debug = True
 
+metabase.print_profile_at_exit(ametabase, opts)
+
 ametabase.sync_scan_database(metabase_base)
+
+print(ametabase.transport.summary())
@@ -0,0 +1,40 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metabase
+import metabase_fake_server
+
+SIZE = {'tables': 4, 'fields': 4, 'cards': 10, 'dashboards': 3, 'cards_per_dashboard': 3, 'metrics': 2, 'snippets': 2}
+
+@pytest.fixture
+def fake():
+    fake = metabase_fake_server.FakeMetabase()
+    fake.seed('src', **SIZE)
+    fake.seed('dst', with_objects=False, **SIZE)
+    return fake
+
+@pytest.fixture
+def server(fake):
+    with metabase_fake_server.FakeMetabaseServer(fake) as server:
+        yield server
+
+@pytest.fixture
+def api(server):
+    return metabase.MetabaseApi(server.apiurl(), 'test@example.org', 'test')
+
+def new_api(server):
+    return metabase.MetabaseApi(server.apiurl(), 'test@example.org', 'test')
+
+def database_id(fake, name):
+    return [d['id'] for d in fake.databases.values() if d['name'] == name][0]
+
+def cards_of(fake, name):
+    db = database_id(fake, name)
+    return dict([[c['name'], c] for c in fake.cards.values() if c.get('database_id') == db])
+
+def dashcards_of(fake, dashboard_name):
+    dash = [d for d in fake.dashboards.values() if d['name'] == dashboard_name][0]
+    return sorted([c['card_id'] for c in fake.dashcards.values() if c['dashboard_id'] == dash['id']])
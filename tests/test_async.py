@@ -0,0 +1,114 @@
+import asyncio
+import os
+import pytest
+from conftest import new_api, cards_of, database_id, dashcards_of
+
+metabase_async = pytest.importorskip('metabase_async')
+
+def test_async_import_matches_the_sync_import(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    api = new_api(server)
+    api.export_all_to_json('src', dirname, 1)
+    # a card only embedded in a dashboard is imported too
+    dash = api.export_store(dirname).read_json(api.export_store(dirname).names('dashboard_')[0])
+    embedded = dash['ordered_cards'][0]['card']['name']
+    os.remove(dirname+'/card_'+embedded+'.json')
+
+    async def run():
+        async with metabase_async.AsyncMetabaseApi(server.apiurl(), 'test@example.org', 'test') as api:
+            await api.import_all_from_json('dst', dirname)
+            return api.reports['import']
+    report = asyncio.run(run())
+    imported = cards_of(fake, 'dst')
+    assert embedded in imported
+    sync = new_api(server)
+    sync.import_all_from_json('dst', dirname, jobs=2, incremental=True)
+    assert sync.reports['import'].get('created', 0) == 0
+    assert sync.reports['import'].get('updated', 0) == 0
+    # the snippets are shared with src, they are updated
+    assert report['created'] + report.get('updated', 0) == sync.reports['import']['unchanged']
+
+def test_async_import_checks_the_references_first(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    new_api(server).export_all_to_json('src', dirname, 1)
+    dst = database_id(fake, 'dst')
+    fake.tables = dict([[k, t] for [k, t] in fake.tables.items() if t['name'] != 'table_0' or t['db_id'] != dst])
+
+    async def run():
+        async with metabase_async.AsyncMetabaseApi(server.apiurl(), 'test@example.org', 'test') as api:
+            await api.import_all_from_json('dst', dirname)
+    with pytest.raises(ValueError, match='unresolved references'):
+        asyncio.run(run())
+    assert cards_of(fake, 'dst') == {}
+
+def test_async_exports_and_single_imports_match_the_sync_client(fake, server, tmp_path):
+    sync_dir = str(tmp_path / 'sync')
+    async_dir = str(tmp_path / 'async')
+    os.mkdir(sync_dir)
+    os.mkdir(async_dir)
+    api = new_api(server)
+    api.export_metrics_to_json('src', sync_dir)
+    api.export_snippet_to_json('src', sync_dir)
+    card = dict(api.get_cards('src')[0])
+
+    async def run():
+        async with metabase_async.AsyncMetabaseApi(server.apiurl(), 'test@example.org', 'test') as client:
+            await client.export_metrics_to_json('src', async_dir)
+            await client.export_snippet_to_json('src', async_dir)
+            card['name'] = 'async card'
+            del card['id']
+            return await client.card_import('src', card)
+    created = asyncio.run(run())
+    assert sorted(os.listdir(async_dir)) == sorted(os.listdir(sync_dir))
+    for name in os.listdir(sync_dir):
+        assert open(async_dir+'/'+name).read() == open(sync_dir+'/'+name).read()
+    assert cards_of(fake, 'src')['async card']['id'] == created['id']
+
+def test_async_transport_retries_a_bad_gateway(fake, server):
+    handle = fake.handle
+    calls = []
+    def flaky(method, path, params, data):
+        if method == 'GET' and path.strip('/') == 'card':
+            calls.append(path)
+            if len(calls) < 3:
+                return [502, {'message': 'bad gateway'}]
+        return handle(method, path, params, data)
+    fake.handle = flaky
+
+    async def run():
+        transport = metabase_async.AsyncMetabaseTransport(backoff_factor=0)
+        async with metabase_async.AsyncMetabaseApi(server.apiurl(), 'test@example.org', 'test', transport=transport) as api:
+            return await api.get_cards('src')
+    assert len(asyncio.run(run())) == len(cards_of(fake, 'src'))
+    assert len(calls) == 3
+
+def test_async_transport_failure_is_a_connection_error():
+    async def run():
+        transport = metabase_async.AsyncMetabaseTransport(backoff_factor=0, connect_timeout=1)
+        try:
+            await transport.request('GET', 'http://127.0.0.1:1/api/card')
+        finally:
+            await transport.close()
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+
+class DroppingTransport(metabase_async.AsyncMetabaseTransport):
+    # the bulk dashcards update never reaches the server
+    async def request(self, method, url, data=None, headers=None):
+        if method == 'PUT' and url.endswith('/cards'):
+            url = 'http://127.0.0.1:1/api/dashboard/cards'
+        return await super().request(method, url, data, headers)
+
+def test_async_dashcards_fall_back_when_the_bulk_update_fails(fake, server):
+    # a lost bulk update only falls back for this dashboard, the next one tries it again
+    async def run():
+        async with metabase_async.AsyncMetabaseApi(server.apiurl(), 'test@example.org', 'test', transport=DroppingTransport(backoff_factor=0)) as api:
+            await api.preload('src')
+            dash = await api.get_dashboard('src', 'src dashboard 0')
+            kept = dash['ordered_cards'][1:]
+            await api.run_steps(api.api.dashboard_sync_cards_steps('src', 'src dashboard 0', kept))
+            return [api.api.bulk_dashcards, sorted([c['card_id'] for c in kept])]
+    [bulk, expected] = asyncio.run(run())
+    assert bulk is None
+    assert server.requests.get('DELETE dashboard/{id}/cards') == 1
+    assert dashcards_of(fake, 'src dashboard 0') == expected
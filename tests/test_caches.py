@@ -0,0 +1,64 @@
+import threading
+import metabase
+
+def test_invalidation_during_hydration_is_kept():
+    cache = metabase.DashboardCache()
+    [reset, stale] = cache.take_marks()
+    assert reset
+    # a write lands while the dashboards are fetched
+    cache.invalidate(3)
+    cache.load([[3, {'id': 1}], [None, {'id': 2}]])
+    assert not cache.is_fresh(3)
+    [reset, stale] = cache.take_marks()
+    assert not reset and 3 in stale
+    cache.drop_stale(set([1, 2]), stale)
+    assert cache.is_fresh(3)
+    assert cache.of_database(4) == []
+
+def test_full_invalidation_keeps_the_buckets_until_reloaded():
+    cache = metabase.DashboardCache()
+    cache.take_marks()
+    cache.load([[3, {'id': 1}]])
+    cache.invalidate()
+    cache.add([[3, {'id': 2}]])
+    assert not cache.is_fresh(3)
+    assert cache.take_marks()[0]
+
+def test_provision_reports_the_failed_users(fake, server, api):
+    handle = fake.handle
+    def failing(method, path, params, data):
+        if method == 'POST' and path.strip('/') == 'user' and data['email'] == 'ba@example.org':
+            return [400, {'errors': {'email': 'refused'}}]
+        return handle(method, path, params, data)
+    fake.handle = failing
+    users = [{'email': email, 'first_name': 'User', 'last_name': 'test'} for email in ['a@example.org', 'ba@example.org']]
+    report = api.provision(users, ['g'], [[u['email'], 'g'] for u in users], raise_errors=False)
+    assert list(report['failed_users'].keys()) == ['ba@example.org']
+    assert report['users_created'] == 1
+
+def test_schema_reload_never_shows_an_empty_index():
+    tables = [{'id': t, 'name': 't%d' % t, 'fields': [{'id': t * 10 + f, 'name': 'f%d' % f} for f in range(5)]} for t in range(1, 2001)]
+    database = {'id': 1, 'name': 'db', 'tables': tables}
+    index = metabase.SchemaIndex()
+    index.load_database(database)
+    misses = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            if index.field_names2field('t2000', 'f4') is None or index.table_name2id('t2000') is None:
+                misses.append(1)
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(20):
+        index.load_database(database)
+    done.set()
+    reader.join()
+    assert misses == []
+
+def test_provision_jobs_leave_the_write_budget_alone(fake, server, api):
+    maximum = api.transport.limiters['write'].maximum
+    users = [{'email': 'user%d@example.org' % i, 'first_name': 'User', 'last_name': 'test'} for i in range(4)]
+    report = api.provision(users, ['g'], [[u['email'], 'g'] for u in users], jobs=maximum+2)
+    assert report['users_created'] == 4
+    assert api.transport.limiters['write'].maximum == maximum
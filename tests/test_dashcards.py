@@ -0,0 +1,43 @@
+import pytest
+import metabase_fake_server
+from conftest import SIZE, new_api, dashcards_of, cards_of
+
+@pytest.mark.parametrize('legacy', [False, True])
+def test_dashcards_added_and_removed(legacy):
+    fake = metabase_fake_server.FakeMetabase(legacy_dashcards=legacy)
+    fake.seed('src', **SIZE)
+    with metabase_fake_server.FakeMetabaseServer(fake) as server:
+        api = new_api(server)
+        dash = api.get_dashboard('src', 'src dashboard 0')
+        kept = dash['ordered_cards'][1:]
+        added = [c['id'] for c in fake.cards.values() if c['id'] not in [d['card_id'] for d in dash['ordered_cards']]][0]
+        desired = [dict(c) for c in kept] + [{'card_id': added, 'row': 20, 'col': 0, 'sizeX': 4, 'sizeY': 4, 'parameter_mappings': [], 'visualization_settings': {}, 'series': []}]
+        server.reset_counts()
+        api.dashboard_sync_cards('src', 'src dashboard 0', desired)
+        assert dashcards_of(fake, 'src dashboard 0') == sorted([c['card_id'] for c in kept] + [added])
+        if legacy:
+            assert api.bulk_dashcards is False
+            assert server.requests.get('DELETE dashboard/{id}/cards') == 1
+            assert server.requests.get('POST dashboard/{id}/cards') == 1
+        else:
+            assert api.bulk_dashcards is True
+            assert server.requests.get('PUT dashboard/{id}/cards') == 1
+
+def test_unchanged_dashcards_send_nothing(fake, server, api):
+    dash = api.get_dashboard('src', 'src dashboard 1')
+    server.reset_counts()
+    assert api.dashboard_sync_cards('src', 'src dashboard 1', dash['ordered_cards']) == []
+    assert [k for k in server.requests.keys() if not k.startswith('GET')] == []
+
+def test_series_compared_by_card(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    dashcard = [c for c in fake.dashcards.values() if c['dashboard_id'] == [d['id'] for d in fake.dashboards.values() if d['name'] == 'src dashboard 0'][0]][0]
+    series_card = [c for c in fake.cards.values() if c['id'] != dashcard['card_id']][0]
+    dashcard['series'] = [dict(series_card)]
+    new_api(server).export_all_to_json('src', dirname, 1)
+    new_api(server).import_all_from_json('dst', dirname, jobs=1)
+    dst_card = cards_of(fake, 'dst')[series_card['name']]
+    assert [s['id'] for c in fake.dashcards.values() for s in c.get('series') or [] if c['card_id'] == cards_of(fake, 'dst')[fake.cards[dashcard['card_id']]['name']]['id']] == [dst_card['id']]
+    server.reset_counts()
+    new_api(server).import_all_from_json('dst', dirname, jobs=1)
+    assert not server.requests.get('PUT dashboard/{id}/cards')
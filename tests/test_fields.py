@@ -0,0 +1,47 @@
+import csv
+import os
+import subprocess
+import sys
+import pytest
+from conftest import new_api
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def changed_fields(server, tmp_path):
+    dirname = str(tmp_path)
+    new_api(server).export_fields_to_csv('src', dirname)
+    with open(dirname+'/fields.csv', newline='') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    for row in rows[:2]:
+        row['description'] = 'changed'
+    with open(dirname+'/fields.csv', 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    return dirname
+
+def fail_field_updates(fake):
+    handle = fake.handle
+    def failing(method, path, params, data):
+        if method == 'PUT' and path.strip('/').startswith('field/'):
+            return [400, {'errors': {'description': 'refused'}}]
+        return handle(method, path, params, data)
+    fake.handle = failing
+
+def test_failed_fields_are_reported(fake, server, changed_fields):
+    fail_field_updates(fake)
+    api = new_api(server)
+    api.import_fields_from_csv('dst', changed_fields)
+    assert api.reports['fields']['failed'] == 2
+    assert api.reports['fields']['updated'] == 0
+
+def test_programming_errors_are_not_swallowed(server, api):
+    with pytest.raises(TypeError):
+        api.put_fields({'t': [None]})
+
+def test_import_script_exits_non_zero_on_failed_fields(fake, server, changed_fields):
+    fail_field_updates(fake)
+    res = subprocess.run([sys.executable, ROOT+'/metabase_import.py', server.apiurl(), 'u', 'p', 'dst', changed_fields], capture_output=True, text=True)
+    assert '2 failed' in res.stdout
+    assert res.returncode == 2
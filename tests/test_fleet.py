@@ -0,0 +1,20 @@
+import os
+import metabase_fleet
+from conftest import new_api, database_id
+
+def test_a_tenant_raising_anything_fails_alone(fake, server, tmp_path):
+    broken = str(database_id(fake, 'src'))
+    handle = fake.handle
+    def malformed(method, path, params, data):
+        if method == 'GET' and path.strip('/') == 'card' and params.get('model_id') == broken:
+            return [200, [None]]
+        return handle(method, path, params, data)
+    fake.handle = malformed
+    manifest = [{'database': 'src', 'directory': str(tmp_path / 'src')}, {'database': 'dst', 'directory': str(tmp_path / 'dst')}]
+    fleet = metabase_fleet.MetabaseFleet(new_api(server), 2)
+    report = fleet.export_all(manifest)
+    assert report['src']['status'] == 'failed'
+    assert report['src']['error']
+    assert report['dst']['status'] == 'ok'
+    assert os.path.exists(str(tmp_path / 'dst' / 'fields.csv'))
+    assert 'src' in fleet.summary()
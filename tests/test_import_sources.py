@@ -0,0 +1,23 @@
+import metabase
+from conftest import new_api, cards_of
+
+def test_dashboard_file_parsed_once_for_its_cards(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    new_api(server).export_all_to_json('src', dirname, 1)
+    api = new_api(server)
+    store = api.export_store(dirname)
+    read_json = store.read_json
+    reads = {}
+    def counting(filename):
+        reads[filename] = reads.get(filename, 0) + 1
+        return read_json(filename)
+    store.read_json = counting
+    [entries, refs] = api.scan_import(dirname)
+    reads.clear()
+    sources = metabase.ImportSources(api, entries)
+    objects = [sources.load(entry) for entry in entries]
+    assert set(reads.values()) == set([1])
+    assert not sources.parsed
+    assert [o['name'] for o in objects] == [e['name'] for e in entries]
+    api.import_all_from_json('dst', dirname, jobs=2)
+    assert set(cards_of(fake, 'dst').keys()) == set(cards_of(fake, 'src').keys())
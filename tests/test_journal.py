@@ -0,0 +1,69 @@
+import json
+import os
+from conftest import new_api, cards_of
+
+def export(server, dirname):
+    api = new_api(server)
+    api.export_fields_to_csv('src', dirname)
+    api.export_all_to_json('src', dirname, 1)
+
+def test_import_writes_no_journal_unless_asked(server, tmp_path):
+    export(server, str(tmp_path))
+    new_api(server).import_all_from_json('dst', str(tmp_path), jobs=2)
+    assert not os.path.exists(str(tmp_path)+'/import_journal.jsonl')
+
+def test_resume_after_an_interrupted_import(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    export(server, dirname)
+    handle = fake.handle
+    posts = []
+    def failing(method, path, params, data):
+        if method == 'POST' and path.strip('/') == 'card':
+            posts.append(data['name'])
+            if len(posts) > 4:
+                return [500, {'message': 'boom', '_status': 500}]
+        return handle(method, path, params, data)
+    fake.handle = failing
+    try:
+        new_api(server).import_all_from_json('dst', dirname, jobs=1, journal=True)
+        assert False, 'the import should have failed'
+    except ValueError:
+        pass
+    fake.handle = handle
+    api = new_api(server)
+    api.import_all_from_json('dst', dirname, jobs=2, resume=True)
+    assert api.reports['import']['resumed'] > 0
+    assert len(cards_of(fake, 'dst')) == len(cards_of(fake, 'src'))
+
+def test_resume_does_not_use_the_id_of_a_deleted_object(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    export(server, dirname)
+    new_api(server).import_all_from_json('dst', dirname, jobs=2, journal=True)
+    # the card is deleted on the server and changed in the export since the journal recorded it
+    card = cards_of(fake, 'dst')['src card 1']
+    fake.cards.pop(card['id'])
+    with open(dirname+'/card_src card 1.json') as jsonfile:
+        data = json.load(jsonfile)
+    data['description'] = 'changed'
+    with open(dirname+'/card_src card 1.json', 'w') as jsonfile:
+        jsonfile.write(json.dumps(data))
+    server.reset_counts()
+    api = new_api(server)
+    api.import_all_from_json('dst', dirname, jobs=2, resume=True)
+    assert 'PUT card/{id}' not in server.requests
+    assert cards_of(fake, 'dst')['src card 1']['description'] == 'changed'
+
+def test_resume_imports_again_an_object_deleted_on_the_server(fake, server, tmp_path):
+    dirname = str(tmp_path)
+    export(server, dirname)
+    new_api(server).import_all_from_json('dst', dirname, jobs=2, journal=True)
+    card = cards_of(fake, 'dst')['src card 1']
+    fake.cards.pop(card['id'])
+    server.reset_counts()
+    api = new_api(server)
+    api.import_all_from_json('dst', dirname, jobs=2, resume=True)
+    assert api.reports['import']['created'] == 1
+    assert 'src card 1' in cards_of(fake, 'dst')
+    # the journaled ids are checked against one list per kind, not one GET each
+    assert 'GET card/{id}' not in server.requests
+    assert 'GET dashboard/{id}' not in server.requests
@@ -0,0 +1,34 @@
+import json
+import metabase
+
+DOCUMENT = {'id': 12, 'name': 'db "one"', 'tables': [{'id': 1, 'name': 'té', 'fields': [{'id': 10, 'ratio': -1.5e-3}, {'id': 11, 'ratio': 12345}]}, {'id': 2, 'name': 'u', 'fields': []}, 3.25, None, True], 'engine': 'h2', 'size': 1000}
+
+def chunked(text, size):
+    return [text[i:i+size] for i in range(0, len(text), size)]
+
+def test_items_at_every_chunk_boundary():
+    for indent in [None, 2]:
+        text = json.dumps(DOCUMENT, indent=indent)
+        for size in range(1, len(text) + 1):
+            stream = metabase.JsonStream(chunked(text, size), 'tables')
+            assert list(stream.items()) == DOCUMENT['tables'], size
+            assert stream.rest == {'id': 12, 'name': 'db "one"', 'engine': 'h2', 'size': 1000}, size
+
+def test_split_at_every_position():
+    text = json.dumps([1, 22, 333.5, {'a': [1, 2]}, 'x,y', 4444])
+    for i in range(len(text) + 1):
+        assert list(metabase.JsonStream([text[:i], text[i:]]).items()) == json.loads(text), i
+
+def test_object_under_key_yields_pairs():
+    text = json.dumps({'groups': {'1': {'a': 1}, '2': {'b': 2}}, 'revision': 7})
+    stream = metabase.JsonStream(chunked(text, 3), 'groups')
+    assert list(stream.items()) == [['1', {'a': 1}], ['2', {'b': 2}]]
+    assert stream.rest == {'revision': 7}
+
+def test_truncated_document_raises():
+    text = json.dumps(DOCUMENT)[:-20]
+    try:
+        list(metabase.JsonStream(chunked(text, 7), 'tables').items())
+        assert False, 'a truncated document should not parse'
+    except ValueError:
+        pass
@@ -0,0 +1,31 @@
+import metabase
+
+def run(limiter, seconds, count, endpoint='GET card'):
+    for i in range(count):
+        limiter.acquire()
+        limiter.release(seconds, False, endpoint)
+
+def test_one_fast_outlier_does_not_become_the_baseline():
+    limiter = metabase.AdaptiveLimiter(16, initial=16, window=20)
+    run(limiter, 0.001, 1)
+    run(limiter, 0.2, 40)
+    assert limiter.baselines['GET card'] == 0.2
+    assert limiter.decreases == 0
+    assert limiter.level() == 16
+
+def test_slower_requests_back_off():
+    limiter = metabase.AdaptiveLimiter(16, window=50)
+    run(limiter, 0.05, 50)
+    level = limiter.level()
+    run(limiter, 1.0, 20)
+    assert limiter.decreases > 0
+    assert limiter.level() < level
+
+def test_jobs_size_the_write_budget():
+    transport = metabase.MetabaseTransport(pool_size=10)
+    assert transport.concurrency()['write'] == 2
+    transport.size_writes(12)
+    assert transport.concurrency()['write'] == 12
+    transport = metabase.MetabaseTransport(pool_size=10, max_writes=3)
+    transport.size_writes(12)
+    assert transport.limiters['write'].maximum == 3
@@ -0,0 +1,47 @@
+import json
+import pytest
+from conftest import new_api, cards_of
+
+@pytest.fixture
+def exported(server, tmp_path):
+    api = new_api(server)
+    api.export_fields_to_csv('src', str(tmp_path))
+    api.export_all_to_json('src', str(tmp_path), 1)
+    return str(tmp_path)
+
+def test_plan_then_apply(fake, server, exported):
+    plan = new_api(server).plan_import('dst', exported)
+    # the snippets are shared by the databases, they already exist
+    assert set([e['action'] for e in plan['objects'] if e['kind'] != 'snippet']) == set(['create'])
+    server.reset_counts()
+    new_api(server).apply_plan(json.loads(json.dumps(plan)))
+    assert len(cards_of(fake, 'dst')) == len(cards_of(fake, 'src'))
+    plan = new_api(server).plan_import('dst', exported)
+    assert set([e['action'] for e in plan['objects']]) == set(['noop'])
+
+def test_apply_refuses_a_changed_export(server, exported):
+    plan = new_api(server).plan_import('dst', exported)
+    with open(exported+'/card_src card 2.json') as jsonfile:
+        data = json.load(jsonfile)
+    data['description'] = 'changed'
+    with open(exported+'/card_src card 2.json', 'w') as jsonfile:
+        jsonfile.write(json.dumps(data))
+    with pytest.raises(ValueError, match='the export changed'):
+        new_api(server).apply_plan(plan)
+
+def test_apply_refuses_a_changed_server(fake, server, exported):
+    new_api(server).import_all_from_json('dst', exported, jobs=2)
+    with open(exported+'/card_src card 2.json') as jsonfile:
+        data = json.load(jsonfile)
+    data['description'] = 'changed'
+    with open(exported+'/card_src card 2.json', 'w') as jsonfile:
+        jsonfile.write(json.dumps(data))
+    plan = new_api(server).plan_import('dst', exported)
+    # the card is recreated on the server after the plan: its planned id is stale
+    card = cards_of(fake, 'dst')['src card 2']
+    fake.cards.pop(card['id'])
+    fake.create_object(fake.cards, 'card', dict(card))
+    server.reset_counts()
+    with pytest.raises(ValueError, match='the server changed since the plan was made: card src card 2'):
+        new_api(server).apply_plan(plan)
+    assert [k for k in server.requests.keys() if not k.startswith('GET') and k != 'POST session'] == []
@@ -0,0 +1,15 @@
+import json
+import metabase
+
+def test_one_endpoint_template_for_every_counter():
+    assert metabase.endpoint_template('GET', 'card/12?f=all') == 'GET card/{id}'
+    assert metabase.endpoint_template('GET', '12/query_metadata') == 'GET {id}/query_metadata'
+    assert metabase.endpoint_template('DELETE', 'card/-3') == 'DELETE card/{id}'
+    assert metabase.endpoint_template('PUT', 'http://localhost:3000/api/dashboard/5/cards') == 'PUT http://localhost:3000/api/dashboard/{id}/cards'
+
+def test_received_bytes_are_the_gzipped_size(server, api):
+    api.load_schema('src', True)
+    stats = api.profile.report()['endpoints']['GET database/{id}']
+    decoded = len(json.dumps(api.database_export))
+    assert 0 < stats['received_bytes'] < decoded // 2
+    assert server.requests['GET database/{id}'] == 1
@@ -0,0 +1,85 @@
+import os
+import pytest
+import metabase
+from conftest import new_api, cards_of
+
+def export(server, database_name, dirname):
+    if not dirname.endswith('.bundle'):
+        os.mkdir(dirname)
+    api = new_api(server)
+    api.export_fields_to_csv(database_name, dirname)
+    api.export_all_to_json(database_name, dirname, 1)
+    return dirname
+
+def contents(server, dirname):
+    store = new_api(server).export_store(dirname)
+    return dict([[name, store.read_text(name)] for name in store.names('') if name != 'manifest.json'])
+
+@pytest.mark.parametrize('suffix', ['', '.bundle'])
+def test_export_import_export_gives_the_same_files(fake, server, tmp_path, suffix):
+    source = export(server, 'src', str(tmp_path / 'src')+suffix)
+    api = new_api(server)
+    api.import_fields_from_csv('dst', source)
+    api.import_all_from_json('dst', source, jobs=2)
+    assert api.reports['fields']['failed'] == 0
+    assert set(cards_of(fake, 'dst').keys()) == set(cards_of(fake, 'src').keys())
+    copy = export(server, 'dst', str(tmp_path / 'dst')+suffix)
+    assert len(contents(server, source)) > 10
+    assert contents(server, copy) == contents(server, source)
+
+@pytest.mark.parametrize('suffix', ['', '.bundle'])
+def test_import_again_changes_nothing(fake, server, tmp_path, suffix):
+    dirname = export(server, 'src', str(tmp_path / 'src')+suffix)
+    new_api(server).import_all_from_json('dst', dirname, jobs=2)
+    api = new_api(server)
+    api.import_all_from_json('dst', dirname, jobs=2, incremental=True)
+    assert api.reports['import'].get('created', 0) == 0
+    assert api.reports['import'].get('updated', 0) == 0
+    # a card embedded in a dashboard is also in its own file, it is imported once
+    objects = set([(entry['kind'], entry['name']) for entry in api.scan_import(dirname)[0]])
+    assert api.reports['import']['unchanged'] == len(objects)
+
+def test_streamed_responses_export_the_same_files(fake, server, tmp_path):
+    dirname = export(server, 'src', str(tmp_path / 'plain'))
+    api = metabase.MetabaseApi(server.apiurl(), 'test@example.org', 'test', stream_responses=True)
+    streamed = str(tmp_path / 'streamed')
+    os.mkdir(streamed)
+    api.export_fields_to_csv('src', streamed)
+    api.export_all_to_json('src', streamed, 1)
+    api.export_cards_to_json('src', str(tmp_path / 'cards.bundle'))
+    assert contents(server, streamed) == contents(server, dirname)
+    cards = contents(server, str(tmp_path / 'cards.bundle'))
+    assert cards == dict([[name, content] for [name, content] in contents(server, dirname).items() if name.startswith('card_')])
+
+@pytest.mark.parametrize('suffix', ['', '.bundle'])
+def test_unchanged_incremental_export_writes_nothing(server, tmp_path, suffix):
+    dirname = export(server, 'src', str(tmp_path / 'src')+suffix)
+    path = dirname if suffix else dirname+'/manifest.json'
+    before = [os.path.getsize(path), os.path.getmtime(path)]
+    api = new_api(server)
+    api.export_fields_to_csv('src', dirname, True)
+    report = api.export_all_to_json('src', dirname, 1, True)
+    assert report['written'] == 0 and report['deleted'] == 0
+    assert [os.path.getsize(path), os.path.getmtime(path)] == before
+
+def test_default_export_converts_in_process(fake, server, tmp_path, monkeypatch):
+    dirname = export(server, 'src', str(tmp_path / 'one'))
+    def no_pool(*args, **kwargs):
+        raise AssertionError('no process pool without --jobs')
+    monkeypatch.setattr(metabase.os, 'cpu_count', lambda: 4)
+    monkeypatch.setattr(metabase.concurrent.futures, 'ProcessPoolExecutor', no_pool)
+    default = str(tmp_path / 'default')
+    os.mkdir(default)
+    api = new_api(server)
+    api.export_fields_to_csv('src', default)
+    api.export_all_to_json('src', default)
+    assert contents(server, default) == contents(server, dirname)
+
+def test_export_with_jobs_converts_in_processes(fake, server, tmp_path):
+    dirname = export(server, 'src', str(tmp_path / 'one'))
+    pooled = str(tmp_path / 'pooled')
+    os.mkdir(pooled)
+    api = new_api(server)
+    api.export_fields_to_csv('src', pooled)
+    api.export_all_to_json('src', pooled, 2)
+    assert contents(server, pooled) == contents(server, dirname)
@@ -0,0 +1,46 @@
+import metabase
+
+def test_cards_referring_to_each_other_are_a_cycle():
+    scheduler = metabase.ImportScheduler(2)
+    scheduler.add(('card', 'a'), lambda: 'a', [('card', 'b')])
+    scheduler.add(('card', 'b'), lambda: 'b', [('card', 'c')])
+    scheduler.add(('card', 'c'), lambda: 'c', [('card', 'a')])
+    scheduler.add(('card', 'd'), lambda: 'd')
+    try:
+        scheduler.run()
+        assert False, 'the cycle should be detected'
+    except ValueError as e:
+        assert 'circular references' in str(e)
+        assert 'card a' in str(e) and 'card b' in str(e) and 'card c' in str(e)
+        assert 'card d' not in str(e)
+
+def test_later_kinds_and_missing_objects_are_not_waited_for():
+    scheduler = metabase.ImportScheduler(2)
+    scheduler.add(('card', 'a'), lambda: 'a', [('dashboard', 'x'), ('card', 'missing')])
+    scheduler.add(('dashboard', 'x'), lambda: 'x', [('card', 'a'), ('dashboard', 'y')])
+    scheduler.add(('dashboard', 'y'), lambda: 'y', [('dashboard', 'x')])
+    [waiting, dependents] = scheduler.graph()
+    assert waiting[('card', 'a')] == set()
+    assert waiting[('dashboard', 'x')] == set([('card', 'a')])
+    assert waiting[('dashboard', 'y')] == set()
+
+def test_dependents_of_a_failed_object_fail():
+    order = []
+    def run(name):
+        def f():
+            order.append(name)
+            if name == 'a':
+                raise ValueError('boom')
+            return name
+        return f
+    scheduler = metabase.ImportScheduler(4)
+    scheduler.add(('card', 'b'), run('b'), [('card', 'a')])
+    scheduler.add(('card', 'a'), run('a'))
+    scheduler.add(('card', 'c'), run('c'), [('card', 'b')])
+    scheduler.add(('metric', 'm'), run('m'))
+    [results, errors] = scheduler.run()
+    assert results == {('metric', 'm'): 'm'}
+    assert str(errors[('card', 'a')]) == 'boom'
+    assert 'depends on card a' in str(errors[('card', 'b')])
+    assert 'depends on card b' in str(errors[('card', 'c')])
+    assert sorted(order) == ['a', 'm']